@@ -1,8 +1,10 @@
 # agent_factory.py (обновленный)
-from typing import Dict, Any
+from typing import TYPE_CHECKING, Dict, Any, Optional
 from enum import Enum
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
+
+if TYPE_CHECKING:  # langchain импортируется лениво, при первом создании агента
+    from langchain_core.prompts import ChatPromptTemplate
+    from response_cache import ResponseCache
 
 class AgentType(str, Enum):
     RESEARCH = "research"
@@ -10,23 +12,44 @@ class AgentType(str, Enum):
     WRITING = "writing"
 
 class AgentFactory:
-    def __init__(self, llm_client):  # Теперь принимаем ChatOpenAI напрямую
+    def __init__(self, llm_client, cache: Optional["ResponseCache"] = None):  # Теперь принимаем ChatOpenAI напрямую
         self.llm = llm_client
+        self.cache = cache
         self.agents = {}
+
+    def _build(self, agent_type: "AgentType", prompt: "ChatPromptTemplate", with_retrieval: bool = False):
+        from response_cache import cached
+        from thinking import ThinkFilter, with_thinking
+        
+        # Политика рассуждений агента (thinking.py); блоки <think> вырезаются из потока ответа
+        chain = prompt | with_thinking(self.llm, agent_type.value) | ThinkFilter()
+        context_version = None
+        if with_retrieval:
+            # Записи локального индекса arXiv подставляются в промпт как {literature}
+            from literature_index import literature_version, with_literature
+            chain = with_literature(chain)
+            context_version = literature_version
+        model_name = getattr(self.llm, "model_name", "")
+        return cached(chain, self.cache, agent_type.value, prompt, model_name, context_version)
         
     def create_research_agent(self):
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
         prompt = ChatPromptTemplate.from_messages([
             ("system", """Ты - научный исследовательский ассистент. 
             Твои ответы должны быть:
             1. Структурированными и хорошо организованными
             2. Содержать релевантные ссылки на источники
             3. Основанными на актуальных исследованиях
-            4. С четкими выводами и рекомендациями"""),
-            ("human", "Исследовательский запрос: {question}")
+            4. С четкими выводами и рекомендациями
+            Ссылайся только на статьи из списка источников, номером [n] и ссылкой arXiv."""),
+            # История сессии (session_memory.py): после системного промпта, перед вопросом
+            MessagesPlaceholder("history", optional=True),
+            ("human", "Исследовательский запрос: {question}\n\nИсточники из локального индекса arXiv:\n{literature}")
         ])
-        return prompt | self.llm | StrOutputParser()
+        return self._build(AgentType.RESEARCH, prompt, with_retrieval=True)
     
     def create_coding_agent(self):
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
         prompt = ChatPromptTemplate.from_messages([
             ("system", """Ты - эксперт по программированию.
             Твои ответы должны:
@@ -34,11 +57,13 @@ class AgentFactory:
             2. Включать объяснения ключевых моментов
             3. Учитывать лучшие практики и производительность
             4. Предлагать альтернативные решения если уместно"""),
+            MessagesPlaceholder("history", optional=True),
             ("human", "Запрос на код: {question}")
         ])
-        return prompt | self.llm | StrOutputParser()
+        return self._build(AgentType.CODING, prompt)
     
     def create_writing_agent(self):
+        from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
         prompt = ChatPromptTemplate.from_messages([
             ("system", """Ты - профессиональный писатель и редактор.
             Твои ответы должны быть:
@@ -46,9 +71,10 @@ class AgentFactory:
             2. Хорошо структурированными
             3. Адаптированными под целевую аудиторию
             4. С правильной грамматикой и стилем"""),
+            MessagesPlaceholder("history", optional=True),
             ("human", "Текст для обработки: {question}")
         ])
-        return prompt | self.llm | StrOutputParser()
+        return self._build(AgentType.WRITING, prompt)
     
     def get_all_agents(self) -> Dict[AgentType, Any]:
         if not self.agents:
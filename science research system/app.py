@@ -1,8 +1,37 @@
+import time
+import uuid
 import streamlit as st
-from multi_agent_system import multi_agent_answer
+from multi_agent_system import astream_multi_agent_answer, get_response_cache
+from streaming import iterate_run, start_run
+from tracing import METRICS_PORT, get_tracer, start_metrics_server
+from llm_provider import run_sync
+from llm_scheduler import scheduling
+from service import AGENT_SERVICE_URL, astream_remote
 
 st.title("Мульти-агентная системa")
 
+response_cache = get_response_cache()
+if response_cache is not None:
+    with st.sidebar:
+        st.markdown("### Кэш ответов")
+        cache_stats = response_cache.stats()
+        st.metric("Попадания", cache_stats["hits"])
+        st.metric("Промахи", cache_stats["misses"])
+        st.caption(f"Доля попаданий: {cache_stats['hit_rate']*100:.1f}%")
+
+# Prometheus-эндпоинт /metrics (если задан METRICS_PORT), один на процесс
+@st.cache_resource
+def start_metrics_endpoint():
+    return run_sync(start_metrics_server(METRICS_PORT)) if METRICS_PORT else None
+
+start_metrics_endpoint()
+
+with st.sidebar:
+    st.markdown("### Стадии (мс)")
+    stage_stats = get_tracer().registry.snapshot()
+    if stage_stats:
+        st.dataframe(stage_stats, hide_index=True)
+
 question = st.text_input("Введите ваш запрос:")
 
 if st.button("Отправить"):
@@ -11,16 +40,37 @@ if st.button("Отправить"):
         log_container = st.empty()
         logs = []
 
-        def log_callback(log_message):
-            logs.append(log_message)
-            # Обновляем область с логами
-            log_container.text_area("Логи", value="\\n".join(logs), height=200)
+        st.subheader("Ответ:")
+        answer_container = st.empty()
+        answer = ""
 
-        # Вызываем нашу систему с log_callback
-        answer = multi_agent_answer(question, verbose=False, log_callback=log_callback)
+        # Потоковый вызов системы: логи маршрутизатора и токены ответа по мере генерации
+        render_seconds = 0.0
+        # Новый запрос сессии отменяет незавершённый прежний (и его генерацию на сервере)
+        session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+        # Сессия пользователя: планировщик LLM чередует запросы разных сессий,
+        # а агент видит прежние реплики сессии (session_memory.py)
+        with scheduling(session=session_id):
+            # С AGENT_SERVICE_URL ответ генерирует HTTP-сервис (service.py), приложение — тонкий клиент
+            stream = (astream_remote({"question": question, "session": session_id}) if AGENT_SERVICE_URL
+                      else astream_multi_agent_answer(question, session_id))
+            run = start_run(session_id, stream)
+        for event in iterate_run(run):
+            render_started = time.perf_counter()
+            if event.type == "log":
+                logs.append(event.content)
+                # Обновляем область с логами
+                log_container.text_area("Логи", value="\\n".join(logs), height=200)
+            elif event.type == "token":
+                answer += event.content
+                answer_container.markdown(answer + "▌")
+            elif event.type == "answer":
+                answer = event.content
+            render_seconds += time.perf_counter() - render_started
 
         # Выводим ответ
-        st.subheader("Ответ:")
-        st.text_area("", value=answer, height=300)
+        render_started = time.perf_counter()
+        answer_container.text_area("", value=answer, height=300)
+        get_tracer().observe("rendering", render_seconds + time.perf_counter() - render_started, app="app")
     else:
         st.warning("Пожалуйста, введите запрос.")
\ No newline at end of file
@@ -1,12 +1,43 @@
 # app_with_react.py
 import streamlit as st
-import asyncio
-import json
+import copy
 import os
+import time
+import uuid
 from typing import Optional
-from langchain_openai import ChatOpenAI
-from react_coordinator import ReActCoordinator, ReActState, AgentType
+from llm_provider import get_llm
+from react_coordinator import ReActCoordinator, AgentType
 from agent_factory import AgentFactory
+from response_cache import cache_from_env
+from streaming import cancel_run, iterate_run, start_run
+from llm_provider import run_sync
+from tracing import METRICS_PORT, get_tracer, start_metrics_server
+from code_sandbox import SANDBOX_ENABLED, available_sandbox_pool
+from llm_scheduler import scheduling
+from service import (AGENT_SERVICE_PUBLIC_URL, AGENT_SERVICE_URL, EXPORT_PORT, EXPORT_PUBLIC_URL, astream_remote,
+                     export_url, remote_forget, start_export_server)
+from session_memory import get_session_memory
+from run_journal import RunHandle, journal_from_env, journaled
+
+# Общий кэш ответов агентов для всех сессий
+@st.cache_resource
+def get_response_cache():
+    return cache_from_env()
+
+# Журнал запусков: история сессий пишется на диск, в session_state — только RunHandle
+@st.cache_resource
+def get_run_journal():
+    return journal_from_env()
+
+# Prometheus-эндпоинт /metrics (если задан METRICS_PORT), один на процесс
+@st.cache_resource
+def start_metrics_endpoint():
+    return run_sync(start_metrics_server(METRICS_PORT)) if METRICS_PORT else None
+
+# Выгрузка журнала без сервиса (если задан EXPORT_PORT), один эндпоинт на процесс
+@st.cache_resource
+def start_export_endpoint():
+    return run_sync(start_export_server(get_run_journal(), EXPORT_PORT))
 
 # Инициализация LLM (используем ваш способ подключения)
 @st.cache_resource
@@ -17,19 +48,18 @@ def initialize_system():
     OPENAI_API_BASE = st.secrets.get("OPENAI_API_BASE", os.getenv("OPENAI_API_BASE", "http://10.32.15.89:34000/v1"))
     
     
-    llm = ChatOpenAI(
-        model=MODEL_NAME,
-        openai_api_key=OPENAI_API_KEY,
-        openai_api_base=OPENAI_API_BASE,
-        temperature=0.1,
-        max_retries=3
-    )
+    # Общий клиент с пулом keep-alive соединений (тот же, что у multi_agent_system при тех же настройках)
+    llm = get_llm(MODEL_NAME, OPENAI_API_KEY, OPENAI_API_BASE)
     
     # Создаем фабрику агентов и координатор
-    agent_factory = AgentFactory(llm)
+    agent_factory = AgentFactory(llm, cache=get_response_cache())
     agents = agent_factory.get_all_agents()
     react_coordinator = ReActCoordinator(llm, agents)
     
+    # Прогреваем пул песочницы заранее: первая проверка кода не ждёт запуска интерпретаторов
+    if SANDBOX_ENABLED:
+        available_sandbox_pool()
+    
     return react_coordinator, agents, llm
 
 # Основной интерфейс Streamlit
@@ -69,20 +99,57 @@ with st.sidebar:
         help="Минимальный балл для принятия ответа"
     )
     
+    max_tokens_per_query = st.number_input(
+        "Бюджет токенов на запрос (0 — без лимита)",
+        min_value=0,
+        value=20000,
+        step=1000,
+        help="Суммарная оценка токенов агента и критика по всем итерациям"
+    )
+    
+    max_seconds_per_query = st.number_input(
+        "Лимит времени на запрос, с (0 — без лимита)",
+        min_value=0,
+        value=180,
+        step=10
+    )
+    
     show_reasoning = st.checkbox("Показать цепочку рассуждений", value=True)
     auto_mode = st.checkbox("Автоматический режим", value=True)
     
     st.divider()
     st.markdown("### 📊 Статистика")
-    if 'react_state' in st.session_state:
-        state: ReActState = st.session_state.react_state
+    if 'react_run' in st.session_state:
+        run_handle: RunHandle = st.session_state.react_run
         col1, col2 = st.columns(2)
         with col1:
-            st.metric("Итерации", state.current_iteration)
+            st.metric("Итерации", run_handle.iterations)
         with col2:
-            if state.agent_responses:
-                last_score = state.agent_responses[-1].confidence_score * 100
-                st.metric("Качество", f"{last_score:.1f}%")
+            if run_handle.last_score is not None:
+                st.metric("Качество", f"{run_handle.last_score * 100:.1f}%")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Токены (оценка)", run_handle.tokens_used)
+        with col2:
+            st.metric("Время, с", f"{run_handle.elapsed_seconds:.1f}")
+
+    response_cache = get_response_cache()
+    if response_cache is not None:
+        cache_stats = response_cache.stats()
+        col1, col2 = st.columns(2)
+        with col1:
+            st.metric("Кэш: попадания", cache_stats["hits"])
+        with col2:
+            st.metric("Кэш: промахи", cache_stats["misses"])
+        st.caption(f"Доля попаданий: {cache_stats['hit_rate']*100:.1f}%")
+    
+    st.markdown("### ⏱️ Стадии (мс)")
+    start_metrics_endpoint()
+    stage_stats = get_tracer().registry.snapshot()
+    if stage_stats:
+        st.dataframe(stage_stats, hide_index=True)
+    else:
+        st.caption("Данных пока нет")
 
 # Основная область
 query = st.text_area(
@@ -99,9 +166,10 @@ with col1:
         if not query.strip():
             st.error("Введите запрос")
         else:
-            # Инициализируем систему
-            with st.spinner("Инициализация системы..."):
-                react_coordinator, agents, llm = initialize_system()
+            # Инициализируем систему (в режиме тонкого клиента её держит HTTP-сервис)
+            if not AGENT_SERVICE_URL:
+                with st.spinner("Инициализация системы..."):
+                    react_coordinator, agents, llm = initialize_system()
             
             progress_bar = st.progress(0)
             status_text = st.empty()
@@ -111,16 +179,73 @@ with col1:
             reasoning_container = st.container()
             result_container = st.container()
             
-            # Запускаем ReAct Loop
+            # Запускаем ReAct Loop в потоковом режиме
             try:
-                async def run_react():
-                    # Устанавливаем максимальное количество итераций
+                if AGENT_SERVICE_URL:
+                    # Тонкий клиент: параметры уходят в запрос к сервису (service.py)
+                    stream_request = {
+                        "question": query,
+                        "mode": "react",
+                        "max_iterations": max_iterations,
+                        "quality_threshold": quality_threshold / 100,
+                        "max_tokens": max_tokens_per_query or None,
+                        "max_seconds": max_seconds_per_query or None,
+                    }
+                else:
+                    # Координатор общий для всех сессий процесса: лимиты этого запуска — на его копии
+                    # (агенты и критик общие), иначе ползунки одной сессии меняли бы чужие запуски
+                    react_coordinator = copy.copy(react_coordinator)
                     react_coordinator.max_iterations = max_iterations
-                    return await react_coordinator.run_react_loop(query)
+                    react_coordinator.quality_threshold = quality_threshold / 100
+                    react_coordinator.max_tokens_per_query = max_tokens_per_query or None
+                    react_coordinator.max_seconds_per_query = max_seconds_per_query or None
                 
-                # Запуск асинхронной функции
-                state = asyncio.run(run_react())
-                st.session_state.react_state = state
+                live_answer = st.empty()
+                streamed_answer = ""
+                state = None
+                run_id = None
+                render_seconds = 0.0
+                # Запуск — отменяемая задача сессии: «Остановить» или новый запрос прерывают его
+                session_id = st.session_state.setdefault("session_id", uuid.uuid4().hex)
+                # Сессия пользователя: планировщик LLM чередует запросы разных сессий
+                with scheduling(session=session_id):
+                    if AGENT_SERVICE_URL:
+                        stream = astream_remote(dict(stream_request, session=session_id))
+                    else:
+                        # Сессия Streamlit — она же сессия памяти диалога (session_memory.py)
+                        stream = react_coordinator.stream_react_loop(query, session_id)
+                        # Итерации пишутся в журнал по мере завершения (в режиме клиента это делает сервис)
+                        if get_run_journal() is not None:
+                            stream = journaled(stream, get_run_journal(), session_id, query)
+                    run = start_run(session_id, stream)
+                # Нажатие «Остановить» перезапускает скрипт, и запуск отменяется ещё до обработчика кнопки
+                st.session_state.react_active_run = run
+                for event in iterate_run(run):
+                    render_started = time.perf_counter()
+                    if event.type == "run":
+                        run_id = event.payload
+                    elif event.type == "log":
+                        status_text.text(event.content)
+                    elif event.type == "iteration":
+                        # Новая итерация — ответ генерируется заново
+                        streamed_answer = ""
+                        progress_bar.progress(min(int((event.payload - 1) / max_iterations * 100), 90))
+                    elif event.type == "token":
+                        streamed_answer += event.content
+                        live_answer.markdown(streamed_answer + "▌")
+                    elif event.type == "state":
+                        state = event.payload
+                    render_seconds += time.perf_counter() - render_started
+                if state is None:
+                    # Запуск отменён: кнопкой «Остановить» или новым запросом этой сессии
+                    live_answer.empty()
+                    st.warning("Запуск остановлен")
+                    st.stop()
+                render_started = time.perf_counter()
+                live_answer.empty()
+                progress_bar.progress(100)
+                # В сессии остаётся только сводка; полные ответы итераций — в журнале
+                st.session_state.react_run = RunHandle.from_state(run_id, state)
                 
                 # Отображение процесса
                 with process_container:
@@ -176,32 +301,8 @@ with col1:
                             if state.agent_responses:
                                 final_confidence = state.agent_responses[-1].confidence_score * 100
                                 st.metric("Итоговое качество", f"{final_confidence:.1f}%")
-                    
-                    # Кнопка для сохранения истории
-                    if st.button("💾 Сохранить историю процесса"):
-                        history = {
-                            "query": state.original_query,
-                            "iterations": state.current_iteration,
-                            "final_answer": state.final_answer,
-                            "reasoning_chain": state.reasoning_chain,
-                            "agent_responses": [
-                                {
-                                    "iteration": i+1,
-                                    "agent": r.agent_type.value,
-                                    "content": r.content,
-                                    "confidence": r.confidence_score,
-                                    "issues": r.issues
-                                }
-                                for i, r in enumerate(state.agent_responses)
-                            ]
-                        }
-                        
-                        st.download_button(
-                            label="Скачать JSON",
-                            data=json.dumps(history, ensure_ascii=False, indent=2),
-                            file_name="react_loop_history.json",
-                            mime="application/json"
-                        )
+                
+                get_tracer().observe("rendering", render_seconds + time.perf_counter() - render_started, app="app_with_react")
             
             except Exception as e:
                 st.error(f"Ошибка: {str(e)}")
@@ -209,17 +310,39 @@ with col1:
 
 with col2:
     if st.button("⏹️ Остановить", type="secondary", use_container_width=True):
-        st.info("Остановка процесса...")
-        if 'react_state' in st.session_state:
-            st.session_state.react_state.is_complete = True
+        # Отмена доходит до запроса к модели: генерация прерывается, а не досчитывается впустую
+        # Запуск, прерванный самим перезапуском скрипта, тоже считается остановленным
+        interrupted = st.session_state.pop("react_active_run", None)
+        if cancel_run(st.session_state.get("session_id", "")) or (interrupted is not None and interrupted.cancelled):
+            st.info("Запуск остановлен")
+        else:
+            st.info("Нет активного запуска")
 
 with col3:
     if st.button("🧹 Очистить", use_container_width=True):
-        for key in ['react_state', 'query_input']:
+        # Новый разговор: агент больше не видит прежние реплики сессии
+        session_id = st.session_state.get("session_id")
+        if session_id and AGENT_SERVICE_URL:
+            remote_forget(session_id)
+        elif session_id and get_session_memory() is not None:
+            get_session_memory().forget(session_id)
+        for key in ['react_run', 'react_active_run', 'query_input']:
             if key in st.session_state:
                 del st.session_state[key]
         st.rerun()
 
+# Экспорт истории сессии из журнала: браузер получает JSONL потоком по ссылке на /v1/runs/export,
+# а не через download_button — тот держал бы всю выгрузку в памяти процесса Streamlit
+if 'react_run' in st.session_state and (AGENT_SERVICE_URL or get_run_journal() is not None):
+    session_id = st.session_state.get("session_id", "")
+    if AGENT_SERVICE_URL:
+        st.link_button("💾 Скачать историю процесса (JSONL)", export_url(session_id, AGENT_SERVICE_PUBLIC_URL))
+    elif EXPORT_PORT:
+        start_export_endpoint()
+        st.link_button("💾 Скачать историю процесса (JSONL)", export_url(session_id, EXPORT_PUBLIC_URL))
+    else:
+        st.caption("Выгрузка истории из журнала доступна с EXPORT_PORT или через сервис (AGENT_SERVICE_URL)")
+
 # Панель с примерами запросов
 
 # Информация о системе
@@ -0,0 +1,74 @@
+# batching.py
+"""Общие примитивы пакетной обработки вопросов."""
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, List, Optional
+
+
+@dataclass
+class BatchResult:
+    """Результат обработки одного вопроса из пакета; ошибка не роняет весь пакет."""
+    index: int
+    question: str
+    agent: Optional[str] = None
+    answer: Any = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+async def merge_as_completed(streams: List[AsyncIterator[Any]]) -> AsyncIterator[Any]:
+    """Сливает несколько async-итераторов в один, отдавая элементы в порядке готовности."""
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+
+    async def pump(stream: AsyncIterator[Any]) -> None:
+        try:
+            async for item in stream:
+                await queue.put(item)
+        finally:
+            await queue.put(done)
+
+    tasks = [asyncio.create_task(pump(stream)) for stream in streams]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is done:
+                remaining -= 1
+                continue
+            yield item
+        # Пробрасываем исключения самих итераторов, если они были
+        for task in tasks:
+            task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def split_concurrency(sizes: List[int], max_concurrency: int) -> List[int]:
+    """Делит лимит одновременных запросов между группами пропорционально их размеру.
+
+    Каждой группе достаётся хотя бы один слот; сумма не превышает max_concurrency,
+    если групп не больше лимита.
+    """
+    total = sum(sizes)
+    spare = max(max_concurrency - len(sizes), 0)
+    return [1 + spare * size // total for size in sizes] if total else []
+
+
+@asynccontextmanager
+async def acquire_many(semaphore: asyncio.Semaphore, count: int) -> AsyncIterator[None]:
+    """Занимает count слотов семафора на время блока (для вызовов, которые сами держат count запросов)."""
+    acquired = 0
+    try:
+        for _ in range(count):
+            await semaphore.acquire()
+            acquired += 1
+        yield
+    finally:
+        for _ in range(acquired):
+            semaphore.release()
@@ -0,0 +1,54 @@
+# bench_import_time.py
+"""Проверка бюджета времени импорта модулей агентов.
+
+Каждый модуль импортируется в отдельном чистом процессе под `python -X importtime`,
+берётся медиана суммарного (cumulative) времени по нескольким запускам и сравнивается
+с бюджетом из import_budget.json. Код возврата 1 — бюджет превышен.
+
+Запуск: python bench_import_time.py [--runs 5] [--budget import_budget.json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def import_time_ms(module: str) -> float:
+    """Cumulative-время импорта модуля (мс) в свежем интерпретаторе."""
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=HERE, capture_output=True, text=True, check=True,
+    )
+    for line in completed.stderr.splitlines():
+        # Формат: "import time:  self [us] | cumulative | imported package"
+        parts = line.split("|")
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1]) / 1000
+    raise RuntimeError(f"Модуль {module} не найден в выводе -X importtime")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", default=os.path.join(HERE, "import_budget.json"))
+    args = parser.parse_args()
+
+    with open(args.budget, encoding="utf-8") as budget_file:
+        budget = {module: limit for module, limit in json.load(budget_file).items() if not module.startswith("_")}
+
+    failed = False
+    for module, limit_ms in budget.items():
+        samples = [import_time_ms(module) for _ in range(args.runs)]
+        median_ms = statistics.median(samples)
+        status = "OK" if median_ms <= limit_ms else "FAIL"
+        failed |= status == "FAIL"
+        print(f"{module:>20}: {median_ms:8.1f} мс (бюджет {limit_ms} мс) {status}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+# bench_keyword_router.py
+"""Микро-бенчмарк маршрутизатора по ключевым словам.
+
+Запуск: python bench_keyword_router.py [--queries 5000] [--extra-stems 300]
+"""
+import argparse
+import random
+import statistics
+import time
+
+from agent_factory import AgentType
+from keyword_router import DEFAULT_RULES, KeywordRouter, KeywordRule
+
+TEMPLATES = [
+    "Сделай научное исследование по теме {topic}, найди статьи на arxiv",
+    "Make a research about {topic} and provide links",
+    "Напиши код на Python для {topic}",
+    "Write a code of {topic} in C#",
+    "Объясни простыми словами, что такое {topic}",
+    "Rewrite this paragraph about {topic} in a clearer way",
+    "Make a science research about {topic}. Write an example implementation.",
+    "Сделай обзор литературы по {topic}, но без кода",
+]
+TOPICS = [
+    "object tracking", "трекинг объектов", "трансформеры", "graph neural networks",
+    "калькулятор", "диффузионные модели", "reinforcement learning", "обработка изображений",
+]
+
+
+def build_corpus(size: int, seed: int = 0):
+    rng = random.Random(seed)
+    return [rng.choice(TEMPLATES).format(topic=rng.choice(TOPICS)) for _ in range(size)]
+
+
+def synthetic_rules(count: int, seed: int = 0):
+    """Дополнительные «основы слов», чтобы проверить рост словаря до сотен записей."""
+    rng = random.Random(seed)
+    alphabet = "абвгдежзиклмнопрстуфхцчшщэюяabcdefghijklmnopqrstuvwxyz"
+    agents = list(AgentType)
+    return [
+        KeywordRule("".join(rng.choice(alphabet) for _ in range(rng.randint(4, 9))), rng.choice(agents))
+        for _ in range(count)
+    ]
+
+
+def linear_scan(rules, query: str):
+    """Эталон: отдельный поиск подстроки для каждого ключевого слова."""
+    query_lower = query.lower()
+    scores = {}
+    for rule in rules:
+        if rule.pattern.lower() in query_lower:
+            scores[rule.agent] = scores.get(rule.agent, 0.0) + (-rule.weight if rule.negated else rule.weight)
+    return scores
+
+
+def measure(fn, corpus):
+    timings = []
+    for query in corpus:
+        started = time.perf_counter_ns()
+        fn(query)
+        timings.append((time.perf_counter_ns() - started) / 1000)
+    timings.sort()
+    return {
+        "mean_us": statistics.fmean(timings),
+        "p50_us": timings[len(timings) // 2],
+        "p99_us": timings[int(len(timings) * 0.99) - 1],
+        "total_ms": sum(timings) / 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--extra-stems", type=int, default=300)
+    args = parser.parse_args()
+
+    rules = DEFAULT_RULES + synthetic_rules(args.extra_stems)
+    corpus = build_corpus(args.queries)
+
+    started = time.perf_counter()
+    router = KeywordRouter(rules)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    print(f"Правил: {len(rules)}, запросов: {len(corpus)}, сборка автомата: {build_ms:.2f} мс")
+    for name, fn in (("automaton", router.route), ("linear_scan", lambda q: linear_scan(rules, q))):
+        stats = measure(fn, corpus)
+        print(f"{name:>12}: mean={stats['mean_us']:.1f} мкс  p50={stats['p50_us']:.1f} мкс  "
+              f"p99={stats['p99_us']:.1f} мкс  total={stats['total_ms']:.1f} мс")
+
+
+if __name__ == "__main__":
+    main()
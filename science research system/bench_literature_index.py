@@ -0,0 +1,133 @@
+# bench_literature_index.py
+"""Бенчмарк локального BM25-индекса литературы: время сборки, размер на диске, задержка запросов.
+
+По умолчанию генерирует синтетический дамп в формате arxiv-metadata-oai-snapshot
+(словарь с распределением Ципфа, заголовок ~10 слов, аннотация ~150 слов); можно
+передать настоящий дамп через --source.
+
+Запуск: python bench_literature_index.py --records 2000000 --queries 1000 --output bench_literature.json
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import List
+
+import numpy as np
+
+from bench_load import summarize
+from literature_index import SEGMENT_DOCS, LiteratureIndex, tokenize
+
+
+def pseudo_words(count: int, rng: np.random.Generator) -> List[str]:
+    alphabet = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    lengths = rng.integers(3, 11, size=count)
+    words = {"".join(rng.choice(alphabet, size=length)) for length in lengths}
+    return sorted(words)
+
+
+def write_synthetic_dump(path: str, records: int, vocabulary_size: int = 200_000, seed: int = 0, start_id: int = 0) -> None:
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(pseudo_words(vocabulary_size, rng))
+    with open(path, "w", encoding="utf-8") as dump:
+        for first in range(0, records, 10_000):
+            batch = min(10_000, records - first)
+            # Ципф с обрезкой: редкие термины — хвост словаря, как в реальных аннотациях
+            ranks = np.minimum(rng.zipf(1.15, size=(batch, 160)), len(vocabulary)) - 1
+            for row, offset in zip(ranks, range(first, first + batch)):
+                words = vocabulary[row]
+                dump.write(json.dumps({
+                    "id": f"{2000 + (start_id + offset) // 100_000:04d}.{(start_id + offset) % 100_000:05d}",
+                    "authors": "A. Author, B. Author and C. Author",
+                    "title": " ".join(words[:10]),
+                    "abstract": " ".join(words[10:]),
+                    "categories": "cs.LG",
+                    "versions": [{"version": "v1", "created": "Mon, 2 Apr 2007 19:18:42 GMT"}],
+                }) + "\n")
+
+
+def sample_queries(index: LiteratureIndex, count: int, seed: int = 0) -> List[str]:
+    """Запросы из 2-4 слов заголовков проиндексированных записей."""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(count):
+        segment = index.segments[int(rng.integers(len(index.segments)))]
+        words = tokenize(segment.record(int(rng.integers(segment.size))).title)
+        if words:
+            queries.append(" ".join(rng.choice(words, size=min(len(words), int(rng.integers(2, 5))), replace=False)))
+    return queries
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--source", help="JSONL-дамп arXiv; по умолчанию синтетический")
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--incremental", type=int, default=10_000, help="Сколько записей дописать при повторной индексации")
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--segment-docs", type=int, default=SEGMENT_DOCS)
+    parser.add_argument("--output", help="Куда записать JSON-отчёт (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_literature_")
+    try:
+        source = args.source or os.path.join(workdir, "arxiv.jsonl")
+        if not args.source:
+            write_synthetic_dump(source, args.records)
+        index_path = os.path.join(workdir, "index")
+
+        started = time.perf_counter()
+        index = LiteratureIndex.open_or_create(index_path)
+        added = index.index_jsonl(source, args.segment_docs, limit=args.records)
+        build_seconds = time.perf_counter() - started
+        usage = index.disk_usage()
+
+        started = time.perf_counter()
+        index = LiteratureIndex(index_path)
+        open_ms = (time.perf_counter() - started) * 1000
+
+        queries = sample_queries(index, args.queries)
+        latencies = []
+        for query in queries:
+            started = time.perf_counter()
+            index.search(query, args.k)
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        incremental = {}
+        if args.incremental and not args.source:
+            # Дописываем в конец того же дампа: половина записей новые, половина — новые версии старых id
+            extra = os.path.join(workdir, "extra.jsonl")
+            write_synthetic_dump(extra, args.incremental, seed=1, start_id=args.records - args.incremental // 2)
+            with open(extra, "rb") as extra_file, open(source, "ab") as dump:
+                shutil.copyfileobj(extra_file, dump)
+            started = time.perf_counter()
+            incremental = {"records": index.index_jsonl(source, args.segment_docs), "seconds": round(time.perf_counter() - started, 3)}
+
+        report = {
+            "records": added,
+            "live_records": index.num_docs,
+            "segments": len(index.segments),
+            "build_seconds": round(build_seconds, 1),
+            "build_records_per_sec": round(added / build_seconds) if build_seconds else None,
+            "postings_mb": round(usage["postings_bytes"] / 2**20, 1),
+            "docs_mb": round(usage["docs_bytes"] / 2**20, 1),
+            "postings_bytes_per_record": round(usage["postings_bytes"] / max(added, 1), 1),
+            "open_ms": round(open_ms, 2),
+            "queries": len(queries),
+            "query_latency_ms": summarize(latencies),
+            "incremental": incremental,
+        }
+        output = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as output_file:
+                output_file.write(output)
+        else:
+            print(output)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
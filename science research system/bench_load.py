@@ -0,0 +1,197 @@
+# bench_load.py
+"""Офлайн нагрузочный бенчмарк multi_agent_answer и ReActCoordinator.
+
+Поднимает локальную заглушку OpenAI API (fake_openai_server.py), направляет на неё
+общий LLM-клиент и прогоняет корпус запросов на фиксированных уровнях параллелизма.
+Результат — JSON с p50/p95/p99 задержки, временем до первого токена и QPS.
+
+Запуск: python bench_load.py --queries 200 --concurrency 1,8,32 --output bench_load.json
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import threading
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from fake_openai_server import FakeOpenAIServer, FakeServerConfig
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(0, min(len(ordered) - 1, int(round(q / 100 * len(ordered) + 0.5)) - 1))
+    return round(ordered[rank], 2)
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {"p50": percentile(values, 50), "p95": percentile(values, 95), "p99": percentile(values, 99)}
+
+
+def load_corpus(path: Optional[str], size: int) -> List[str]:
+    if path:
+        with open(path, encoding="utf-8") as corpus_file:
+            lines = [line.strip() for line in corpus_file if line.strip()]
+        queries = [json.loads(line)["question"] if line.startswith("{") else line for line in lines]
+    else:
+        from bench_keyword_router import build_corpus
+        queries = build_corpus(size)
+    return (queries * (size // max(len(queries), 1) + 1))[:size]
+
+
+def start_fake_server(config: FakeServerConfig) -> FakeOpenAIServer:
+    """Сервер работает в собственном потоке и event loop, отдельно от клиента."""
+    server = FakeOpenAIServer(config)
+    ready = threading.Event()
+    loop = asyncio.new_event_loop()
+
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.start())
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=serve, name="fake-openai-server", daemon=True).start()
+    ready.wait()
+    return server
+
+
+async def measure_stream(stream: AsyncIterator[Any], is_token: Callable[[Any], bool], is_error: Callable[[Any], bool]) -> Dict[str, Any]:
+    started = time.perf_counter()
+    ttft = None
+    error = False
+    try:
+        async for event in stream:
+            if ttft is None and is_token(event):
+                ttft = time.perf_counter() - started
+            error = error or is_error(event)
+    except Exception:
+        error = True
+    return {"latency": time.perf_counter() - started, "ttft": ttft, "error": error}
+
+
+async def run_level(make_stream: Callable[[str], AsyncIterator[Any]], is_token, is_error, queries: List[str], concurrency: int) -> Dict[str, Any]:
+    queue: asyncio.Queue = asyncio.Queue()
+    for query in queries:
+        queue.put_nowait(query)
+    samples: List[Dict[str, Any]] = []
+
+    async def worker(user: int):
+        # Каждый воркер — отдельный пользователь для справедливой очереди планировщика LLM
+        from llm_scheduler import scheduling
+
+        with scheduling(session=f"user-{user}"):
+            while not queue.empty():
+                query = queue.get_nowait()
+                samples.append(await measure_stream(make_stream(query), is_token, is_error))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker(user) for user in range(concurrency)))
+    wall = time.perf_counter() - started
+    ok = [sample for sample in samples if not sample["error"]]
+    return {
+        "concurrency": concurrency,
+        "requests": len(samples),
+        "errors": len(samples) - len(ok),
+        "wall_seconds": round(wall, 3),
+        "qps": round(len(samples) / wall, 2) if wall else None,
+        "latency_ms": summarize([sample["latency"] * 1000 for sample in ok]),
+        "ttft_ms": summarize([sample["ttft"] * 1000 for sample in ok if sample["ttft"] is not None]),
+    }
+
+
+def entry_points() -> Dict[str, Dict[str, Any]]:
+    """Точки входа под нагрузкой; импорт после того, как OPENAI_API_BASE указывает на заглушку."""
+    from agent_factory import AgentFactory
+    from llm_provider import get_llm
+    from multi_agent_system import astream_multi_agent_answer
+    from react_coordinator import ReActCoordinator
+
+    llm = get_llm()
+    coordinator = ReActCoordinator(llm, AgentFactory(llm).get_all_agents())
+    return {
+        "multi_agent_answer": {
+            "stream": astream_multi_agent_answer,
+            "is_token": lambda event: event.type == "token",
+            "is_error": lambda event: False,
+        },
+        "react_loop": {
+            "stream": coordinator.stream_react_loop,
+            "is_token": lambda event: event.type == "token",
+            "is_error": lambda event: event.type == "state" and event.payload.stop_reason == "error",
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--corpus", help="Файл с запросами: по одному в строке или JSONL с полем question")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--concurrency", default="1,8,32")
+    parser.add_argument("--entry", default="multi_agent_answer,react_loop")
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-sec", type=float, default=200.0)
+    parser.add_argument("--completion-tokens", type=int, default=60)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--capacity", type=int, default=0, help="Одновременных запросов у заглушки до ответа 429 (0 — без ограничения)")
+    parser.add_argument("--spike-rate", type=float, default=0.0, help="Доля запросов с всплеском задержки у заглушки")
+    parser.add_argument("--spike-latency", type=float, default=2.0)
+    parser.add_argument("--think-tokens", type=int, default=0, help="Токенов рассуждения <think> в ответах заглушки")
+    parser.add_argument("--replicas", type=int, default=1, help="Сколько заглушек поднять; клиент балансирует между ними")
+    parser.add_argument("--slow-replica", type=float, default=0.0, help="Добавочная задержка первой реплики, с")
+    parser.add_argument("--output", help="Куда записать JSON-отчёт (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    config = FakeServerConfig(
+        latency=args.latency, tokens_per_sec=args.tokens_per_sec,
+        completion_tokens=args.completion_tokens, failure_rate=args.failure_rate,
+        capacity=args.capacity, spike_rate=args.spike_rate, spike_latency=args.spike_latency,
+        think_tokens=args.think_tokens, seed=0,
+    )
+    servers = [
+        start_fake_server(dataclasses.replace(
+            config, seed=replica, latency=config.latency + (args.slow_replica if replica == 0 else 0.0),
+        ))
+        for replica in range(args.replicas)
+    ]
+    # Бенчмарк меряет систему, а не кэш и журнал маршрутизатора
+    os.environ["OPENAI_API_BASE"] = ",".join(server.base_url for server in servers)
+    os.environ["RESPONSE_CACHE_ENABLED"] = "0"
+    os.environ["ROUTER_LOG_PATH"] = ""
+
+    from llm_provider import OPENAI_API_KEY, run_sync
+    from llm_scheduler import get_scheduler
+    from tracing import get_tracer
+
+    queries = load_corpus(args.corpus, args.queries)
+    entries = entry_points()
+    report = {"server": config.__dict__, "replicas": args.replicas, "slow_replica": args.slow_replica,
+              "queries": len(queries), "results": []}
+    for entry_name in args.entry.split(","):
+        entry = entries[entry_name]
+        for concurrency in (int(level) for level in args.concurrency.split(",")):
+            result = run_sync(run_level(entry["stream"], entry["is_token"], entry["is_error"], queries, concurrency))
+            result["entry"] = entry_name
+            result["scheduler"] = get_scheduler().snapshot()
+            # Токены рассуждений по стадиям (накопительно): цена рассуждений против задержки
+            result["reasoning_tokens"] = {row["stage"]: row["reasoning_tokens"]
+                                          for row in get_tracer().registry.snapshot() if row["reasoning_tokens"]}
+            if len(servers) > 1:
+                from endpoint_pool import get_endpoint_pool
+
+                result["endpoints"] = get_endpoint_pool(tuple(s.base_url for s in servers), OPENAI_API_KEY).snapshot()
+            report["results"].append(result)
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,608 @@
+# code_sandbox.py
+"""Песочница для проверки кода из ответов coding-агента.
+
+Из ответа извлекаются блоки ```python, которые выполняются в пуле заранее запущенных
+процессов-исполнителей: интерпретатор уже прогрет, поэтому проверка стоит миллисекунды,
+а не запуск Python на каждый фрагмент. Каждый исполнитель — отдельный процесс
+`python -I -S code_sandbox.py --worker` без ключей API в окружении. Он работает как
+fork-сервер: каждая задача выполняется в свежем потомке со своим tmpfs на /tmp и лимитами
+памяти, CPU и размера файлов, так что подмены builtins, модулей и файлы одной задачи
+следующей не достаются.
+
+Код из ответа модели — недоверенный, поэтому проверка выключена по умолчанию
+(SANDBOX_ENABLED=1 включает её). Исполнитель изолируется ядром, а не патчами модулей:
+- отдельные mount-, pid- и network-namespace (без сетевых интерфейсов): процессы
+  сервиса исполнителю не видны и сигналы им недоступны;
+- корень файловой системы — пустой tmpfs, куда только для чтения смонтированы /usr и
+  стандартная библиотека Python; каталоги проекта, журналы, память сессий, домашние
+  каталоги и /proc исполнителю не видны;
+- потомок с задачей становится nobody (запуск от root) или теряет все capabilities
+  (user namespace без root), no_new_privs запрещает их вернуть.
+Если ядро не даёт выполнить любой из шагов, исполнитель не запускается и код не выполняется.
+
+Исполнитель видит только стандартную библиотеку: модуль запускается с -I -S, без каталога
+проекта и site-packages в sys.path; импорт сторонних пакетов даёт замечание «не проверено».
+"""
+import asyncio
+import builtins
+import ctypes
+import io
+import json
+import logging
+import os
+import queue
+import re
+import select
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import redirect_stderr, redirect_stdout
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+SANDBOX_ENABLED = os.getenv("SANDBOX_ENABLED", "0") == "1"
+SANDBOX_WORKERS = int(os.getenv("SANDBOX_WORKERS", str(os.cpu_count() or 2)))
+SANDBOX_TIMEOUT = float(os.getenv("SANDBOX_TIMEOUT", "5"))
+SANDBOX_MEMORY_MB = int(os.getenv("SANDBOX_MEMORY_MB", "512"))
+# Размер tmpfs корня исполнителя и отдельного /tmp каждой задачи
+SANDBOX_TMPFS_MB = int(os.getenv("SANDBOX_TMPFS_MB", "64"))
+
+OUTPUT_LIMIT = 2000
+# Больше ответ задачи быть не может: stdout и stderr уже обрезаны до OUTPUT_LIMIT
+_REPLY_LIMIT = 2**20
+MAX_FILE_BYTES = 16 * 2**20
+
+_PYTHON_BLOCK_RE = re.compile(r"```[ \t]*(?:python3?|py)[^\n]*\n(.*?)```", re.DOTALL | re.IGNORECASE)
+# Ошибки, которые говорят об окружении песочницы, а не о коде
+_ENVIRONMENT_ERRORS = ("ModuleNotFoundError", "EOFError", "SandboxUnavailable", "WorkerCrashed")
+_LIMIT_ERRORS = ("TimeoutError", "CPUTimeLimitExceeded")
+
+logger = logging.getLogger(__name__)
+
+
+def extract_python_blocks(text: str) -> List[str]:
+    """Блоки ```python из ответа; REPL-примеры (>>>) сводятся к исполняемому коду."""
+    blocks = []
+    for block in _PYTHON_BLOCK_RE.findall(text):
+        lines = block.splitlines()
+        if any(line.startswith(">>>") for line in lines):
+            lines = [line[4:] for line in lines if line.startswith((">>> ", "... ", ">>>", "..."))]
+        code = "\n".join(lines).strip("\n")
+        if code.strip():
+            blocks.append(code)
+    return blocks
+
+
+@dataclass
+class ExecutionResult:
+    ok: bool
+    stdout: str = ""
+    stderr: str = ""
+    error_type: Optional[str] = None
+    error: Optional[str] = None
+    block: Optional[int] = None
+    timed_out: bool = False
+    duration_ms: float = 0.0
+
+
+_RESULT_FIELDS = frozenset(ExecutionResult.__dataclass_fields__)
+
+
+@dataclass
+class VerificationReport:
+    blocks: int
+    result: ExecutionResult
+    issues: List[str] = field(default_factory=list)
+    notes: List[str] = field(default_factory=list)
+
+    def summary(self) -> str:
+        status = "ошибок нет" if not self.issues else f"проблем: {len(self.issues)}"
+        notes = f"; {'; '.join(self.notes)}" if self.notes else ""
+        return f"блоков: {self.blocks}, {status}, {self.result.duration_ms:.0f} мс{notes}"
+
+
+# ---------------------------------------------------------------- исполнитель (дочерний процесс)
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWPID = 0x20000000
+CLONE_NEWNET = 0x40000000
+MS_RDONLY, MS_NOSUID, MS_NODEV, MS_NOEXEC = 0x1, 0x2, 0x4, 0x8
+MS_REMOUNT, MS_BIND, MS_REC, MS_PRIVATE = 0x20, 0x1000, 0x4000, 0x40000
+# Флаги точки монтирования, которые ядро запрещает снимать при перемонтировании bind (statvfs → mount)
+_LOCKED_MOUNT_FLAGS = {os.ST_NOSUID: MS_NOSUID, os.ST_NODEV: MS_NODEV, os.ST_NOEXEC: MS_NOEXEC,
+                       os.ST_NOATIME: 0x400, os.ST_NODIRATIME: 0x800, os.ST_RELATIME: 0x200000}
+PR_SET_PDEATHSIG = 1
+PR_SET_NO_NEW_PRIVS = 38
+NOBODY = 65534
+_DEVICES = ("null", "zero", "random", "urandom")
+
+
+class CPUTimeLimitExceeded(BaseException):
+    """BaseException: фрагмент с `except Exception` не должен проглотить лимит."""
+
+
+class SandboxUnavailable(RuntimeError):
+    """Ядро не дало изолировать исполнителя — код не выполняется."""
+
+
+def _libc_call(libc, name: str, *args) -> None:
+    if getattr(libc, name)(*args) != 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"{name}: {os.strerror(errno)}")
+
+
+def _write_file(path: str, data: str) -> None:
+    with open(path, "w") as f:
+        f.write(data)
+
+
+def _bind_readonly(libc, source: str, target: str) -> None:
+    os.makedirs(target, exist_ok=True)
+    _libc_call(libc, "mount", source.encode(), target.encode(), None, MS_BIND | MS_REC, None)
+    locked = os.statvfs(source).f_flag
+    flags = MS_BIND | MS_REMOUNT | MS_RDONLY
+    for statvfs_flag, mount_flag in _LOCKED_MOUNT_FLAGS.items():
+        if locked & statvfs_flag:
+            flags |= mount_flag
+    _libc_call(libc, "mount", None, target.encode(), None, flags, None)
+
+
+def _readonly_paths() -> List[str]:
+    """/usr (разделяемые библиотеки модулей расширения) и каталоги стандартной библиотеки из sys.path."""
+    paths = ["/usr"]
+    for path in sys.path:
+        path = os.path.realpath(path)
+        if os.path.isdir(path) and not any(path == p or path.startswith(p + "/") for p in paths):
+            paths.append(path)
+    return paths
+
+
+def _drop_capabilities(libc) -> None:
+    # struct __user_cap_header_struct {version, pid} и два __user_cap_data_struct по три u32 — все нули
+    header = (ctypes.c_uint32 * 2)(0x20080522, 0)
+    data = (ctypes.c_uint32 * 6)()
+    _libc_call(libc, "capset", header, data)
+
+
+def _isolate(tmpfs_mb: int) -> str:
+    """Изолирует процесс-сервер исполнителя; OSError — изоляция невозможна, код выполнять нельзя.
+
+    Сервер сам кода не выполняет: на каждую задачу он порождает потомка (_run_task),
+    который теряет привилегии до запуска фрагмента.
+    """
+    libc = ctypes.CDLL(None, use_errno=True)
+    uid, gid = os.getuid(), os.getgid()
+    # Без root остальные namespace доступны только внутри собственного user namespace
+    flags = CLONE_NEWNS | CLONE_NEWNET | CLONE_NEWPID
+    _libc_call(libc, "unshare", flags | (0 if uid == 0 else CLONE_NEWUSER))
+    if uid != 0:
+        _write_file("/proc/self/setgroups", "deny")
+        _write_file("/proc/self/uid_map", f"{uid} {uid} 1")
+        _write_file("/proc/self/gid_map", f"{gid} {gid} 1")
+    # Новый pid namespace действует для потомков: сервер — pid 1, процессов снаружи задачи
+    # не видят и сигналов им не шлют; внешний процесс только ждёт сервер
+    child = os.fork()
+    if child:
+        _, status = os.waitpid(child, 0)
+        os._exit(os.waitstatus_to_exitcode(status) & 0xFF)
+    # Своя сессия: kill(0, ...) не достаёт группу процессов сервиса
+    os.setsid()
+    # Монтирования исполнителя не видны снаружи, а внешние — не распространяются внутрь
+    _libc_call(libc, "mount", None, b"/", None, MS_REC | MS_PRIVATE, None)
+    readonly = _readonly_paths()
+    # Новый корень — tmpfs поверх /tmp: снаружи namespace после исполнителя ничего не остаётся
+    root = "/tmp"
+    _libc_call(libc, "mount", b"tmpfs", root.encode(), b"tmpfs", MS_NOSUID | MS_NODEV,
+               f"size={tmpfs_mb}m,mode=755".encode())
+    for path in readonly:
+        _bind_readonly(libc, path, root + path)
+    for name in ("bin", "lib", "lib32", "lib64", "sbin"):
+        if os.path.islink(f"/{name}"):
+            os.symlink(os.readlink(f"/{name}"), f"{root}/{name}")
+    os.makedirs(f"{root}/dev")
+    for device in _DEVICES:
+        _write_file(f"{root}/dev/{device}", "")
+        _libc_call(libc, "mount", f"/dev/{device}".encode(), f"{root}/dev/{device}".encode(), None, MS_BIND, None)
+    # Точка монтирования /tmp задачи; свой tmpfs на ней монтирует каждая задача
+    os.makedirs(f"{root}/tmp")
+    os.chroot(root)
+    os.chdir("/")
+    # Корень только для чтения: задача не оставит файлов следующей
+    _libc_call(libc, "mount", None, b"/", None, MS_REMOUNT | MS_BIND | MS_RDONLY | MS_NOSUID | MS_NODEV, None)
+    # Гибель внешнего процесса (таймаут пула) убивает сервер, а с ним и весь pid namespace
+    _libc_call(libc, "prctl", PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0)
+    identity = f"uid {NOBODY}" if uid == 0 else f"uid {uid}, no capabilities"
+    return f"namespace+chroot, process per task ({identity})"
+
+
+def _enter_task(libc, tmpfs_mb: int, memory_mb: int) -> None:
+    """Потомок сервера перед запуском задачи: свой /tmp, затем потеря привилегий и лимиты."""
+    # Свой mount namespace с чистым tmpfs на /tmp исчезает вместе с задачей
+    _libc_call(libc, "unshare", CLONE_NEWNS)
+    _libc_call(libc, "mount", b"tmpfs", b"/tmp", b"tmpfs", MS_NOSUID | MS_NODEV,
+               f"size={tmpfs_mb}m,mode=1777".encode())
+    os.chdir("/tmp")
+    if os.getuid() == 0:
+        os.setgroups([])
+        os.setgid(NOBODY)
+        os.setuid(NOBODY)
+    else:
+        # Без CAP_SYS_CHROOT и CAP_SYS_ADMIN из chroot не выйти и новые монтирования не сделать
+        _drop_capabilities(libc)
+    _libc_call(libc, "prctl", PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)
+    _apply_limits(memory_mb)
+
+
+def _apply_limits(memory_mb: int) -> None:
+    import resource
+
+    memory = memory_mb * 2**20
+    resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+    resource.setrlimit(resource.RLIMIT_FSIZE, (MAX_FILE_BYTES, MAX_FILE_BYTES))
+    resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+
+    def on_cpu_limit(signum, frame):
+        raise CPUTimeLimitExceeded("CPU time limit exceeded")
+
+    signal.signal(signal.SIGXCPU, on_cpu_limit)
+
+
+def _set_cpu_budget(seconds: float) -> None:
+    """Мягкий RLIMIT_CPU задачи; целочисленный, поэтому округляется вниз и срабатывает раньше таймаута."""
+    import resource
+
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    soft = max(int(used) + 1, int(used + seconds))
+    resource.setrlimit(resource.RLIMIT_CPU, (soft if hard == resource.RLIM_INFINITY else min(soft, hard), hard))
+
+
+def _execute(blocks: List[str], cpu_seconds: float) -> Dict[str, Any]:
+    """Блоки выполняются по порядку в общем пространстве имён: поздние блоки используют ранние."""
+    namespace: Dict[str, Any] = {"__name__": "__main__", "__builtins__": builtins}
+    stdout, stderr = io.StringIO(), io.StringIO()
+    result: Dict[str, Any] = {"ok": True}
+    started = time.perf_counter()
+    _set_cpu_budget(cpu_seconds)
+    try:
+        with redirect_stdout(stdout), redirect_stderr(stderr):
+            for number, code in enumerate(blocks, 1):
+                result["block"] = number
+                exec(compile(code, f"<block {number}>", "exec"), namespace)
+        result.pop("block")
+    except BaseException as e:  # SystemExit и KeyboardInterrupt из фрагмента тоже должны дать ответ
+        if isinstance(e, SystemExit) and e.code in (None, 0):
+            result.pop("block", None)
+        else:
+            lines = traceback.format_exception(type(e), e, e.__traceback__)
+            result.update(ok=False, error_type=type(e).__name__, error=_snippet_traceback(lines))
+    result.update(
+        stdout=stdout.getvalue()[-OUTPUT_LIMIT:],
+        stderr=stderr.getvalue()[-OUTPUT_LIMIT:],
+        duration_ms=round((time.perf_counter() - started) * 1000, 3),
+    )
+    return result
+
+
+def _snippet_traceback(lines: List[str]) -> str:
+    """Из трассировки оставляем кадры фрагмента и само исключение, без кадров песочницы."""
+    kept = [line for line in lines if "<block " in line]
+    kept.append(lines[-1])
+    return "".join(kept)[-OUTPUT_LIMIT:]
+
+
+def _run_task(task: Dict[str, Any], memory_mb: int, tmpfs_mb: int, protocol_fds: List[int]) -> Dict[str, Any]:
+    """Выполняет задачу в свежем потомке прогретого сервера и дожидается его ответа.
+
+    Потомок получает копию уже импортированного интерпретатора, поэтому старт стоит fork,
+    а подмены builtins, модулей и файлы в /tmp умирают вместе с ним.
+    """
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        # Потомок ни при каком исходе не возвращается в цикл сервера
+        try:
+            os.close(read_fd)
+            # Протокол с пулом задаче недоступен: подделать ответ за чужую задачу она не может
+            for fd in protocol_fds:
+                os.close(fd)
+            try:
+                _enter_task(ctypes.CDLL(None, use_errno=True), tmpfs_mb, memory_mb)
+            except OSError as e:
+                reply = {"ok": False, "error_type": "SandboxUnavailable", "error": f"task isolation failed: {e}"}
+            else:
+                try:
+                    reply = _execute(task["blocks"], task["cpu_seconds"])
+                except MemoryError:
+                    reply = {"ok": False, "error_type": "MemoryError", "error": "Memory limit exceeded"}
+            data = json.dumps(reply, ensure_ascii=False).encode("utf-8")
+            while data:
+                data = data[os.write(write_fd, data):]
+        finally:
+            os._exit(0)
+    os.close(write_fd)
+    # Конец задачи — выход потомка, а не EOF канала: его копию может держать порождённый задачей процесс
+    exited = os.pidfd_open(pid)
+    os.set_blocking(read_fd, False)
+    chunks: List[bytes] = []
+    size = 0
+    deadline = time.monotonic() + task["timeout"]
+    timed_out = False
+    try:
+        while size < _REPLY_LIMIT:
+            ready, _, _ = select.select([read_fd, exited], [], [], max(deadline - time.monotonic(), 0))
+            if not ready:
+                timed_out = True
+                break
+            if read_fd in ready:
+                chunk = os.read(read_fd, 65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                size += len(chunk)
+            elif exited in ready:
+                # Потомок вышел: остаток ответа уже лежит в канале
+                try:
+                    while size < _REPLY_LIMIT:
+                        chunk = os.read(read_fd, 65536)
+                        if not chunk:
+                            break
+                        chunks.append(chunk)
+                        size += len(chunk)
+                except BlockingIOError:
+                    pass
+                break
+    finally:
+        os.close(read_fd)
+        os.close(exited)
+        # Задача и всё, что она породила; kill(-1) безопасен только для pid 1 своего namespace,
+        # которому этот сигнал и не доставляется
+        try:
+            os.kill(-1 if os.getpid() == 1 else pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        _, status = os.waitpid(pid, 0)
+        _reap()
+    if timed_out:
+        return {"ok": False, "timed_out": True, "error_type": "TimeoutError",
+                "error": f"Execution did not finish within {task['cpu_seconds']:g} s"}
+    try:
+        reply = json.loads(b"".join(chunks))
+        return {key: value for key, value in reply.items() if key in _RESULT_FIELDS}
+    except (ValueError, AttributeError):
+        return {"ok": False, "error_type": "WorkerCrashed",
+                "error": f"sandbox task exited without a result (status {os.waitstatus_to_exitcode(status)})"}
+
+
+def _reap() -> None:
+    """pid 1 namespace подбирает осиротевших потомков задачи."""
+    while True:
+        try:
+            os.waitpid(-1, 0)
+        except ChildProcessError:
+            return
+
+
+def _worker_main(memory_mb: int, tmpfs_mb: int) -> None:
+    # Протокол идёт через копии дескрипторов stdin/stdout; сами 0/1/2 уходят в /dev/null,
+    # чтобы запись фрагмента в fd 1 не ломала протокол
+    protocol_in = os.fdopen(os.dup(0), "r", encoding="utf-8")
+    protocol_out = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    sys.stdin = io.StringIO("")
+    try:
+        isolation = _isolate(tmpfs_mb)
+    except OSError as e:
+        protocol_out.write(json.dumps({"ready": False, "error": f"isolation failed: {e}"}) + "\n")
+        protocol_out.flush()
+        return
+    protocol_out.write(json.dumps({"ready": True, "isolation": isolation}) + "\n")
+    protocol_out.flush()
+    protocol_fds = [protocol_in.fileno(), protocol_out.fileno()]
+    for line in protocol_in:
+        reply = _run_task(json.loads(line), memory_mb, tmpfs_mb, protocol_fds)
+        protocol_out.write(json.dumps(reply, ensure_ascii=False) + "\n")
+        protocol_out.flush()
+
+
+# ---------------------------------------------------------------- пул (родительский процесс)
+
+class _Worker:
+    def __init__(self, memory_mb: int):
+        env = {
+            "PATH": os.environ.get("PATH", "/usr/bin:/bin"),
+            "LANG": os.environ.get("LANG", "C.UTF-8"),
+            "HOME": tempfile.gettempdir(),
+            # Один поток BLAS на исполнитель: параллелизм даёт сам пул, а RLIMIT_AS не съедают буферы потоков
+            "OPENBLAS_NUM_THREADS": "1",
+            "OMP_NUM_THREADS": "1",
+            "MKL_NUM_THREADS": "1",
+        }
+        self.process = subprocess.Popen(
+            [sys.executable, "-I", "-S", os.path.abspath(__file__), "--worker", str(memory_mb), str(SANDBOX_TMPFS_MB)],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=tempfile.gettempdir(), env=env, text=True, encoding="utf-8",
+        )
+        self.isolation: Optional[str] = None
+
+    def wait_ready(self, timeout: float) -> None:
+        try:
+            reply = self._read(timeout)
+        except (TimeoutError, EOFError, ValueError) as e:
+            raise SandboxUnavailable(f"sandbox worker did not start: {e or type(e).__name__}")
+        if not reply.get("ready"):
+            raise SandboxUnavailable(reply.get("error", "sandbox worker is not isolated"))
+        self.isolation = reply["isolation"]
+
+    def run(self, blocks: List[str], seconds: float) -> Dict[str, Any]:
+        # CPU-лимит задачи срабатывает первым; таймаут по часам (sleep, ожидание) сервер отсчитывает сам
+        task = {"blocks": blocks, "cpu_seconds": seconds, "timeout": seconds + 1.0}
+        self.process.stdin.write(json.dumps(task) + "\n")
+        self.process.stdin.flush()
+        # Пул ждёт дольше сервера: его таймаут — только на случай зависшего сервера
+        return self._read(seconds + 3.0)
+
+    def _read(self, timeout: float) -> Dict[str, Any]:
+        ready, _, _ = select.select([self.process.stdout], [], [], timeout)
+        if not ready:
+            raise TimeoutError
+        line = self.process.stdout.readline()
+        if not line:
+            raise EOFError("sandbox worker exited")
+        return json.loads(line)
+
+    def kill(self) -> None:
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        # Закрытый протокол завершает и потомка-исполнителя, если тот ждёт задачу
+        for stream in (self.process.stdin, self.process.stdout):
+            stream.close()
+
+
+class SandboxPool:
+    """Пул прогретых исполнителей; число одновременных проверок равно числу исполнителей.
+
+    Исполнитель — fork-сервер: каждая задача идёт в свежем потомке, поэтому задачи не видят
+    состояния друг друга, а сам исполнитель живёт, пока не упадёт или не зависнет.
+    """
+
+    def __init__(self, workers: int = SANDBOX_WORKERS, timeout: float = SANDBOX_TIMEOUT,
+                 memory_mb: int = SANDBOX_MEMORY_MB):
+        self.timeout = timeout
+        self.memory_mb = memory_mb
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._closed = False
+        # Исполнители стартуют параллельно; готовность ждём здесь, чтобы первая проверка была тёплой
+        starting = [_Worker(memory_mb) for _ in range(max(1, workers))]
+        try:
+            for worker in starting:
+                worker.wait_ready(30.0)
+        except SandboxUnavailable:
+            for worker in starting:
+                worker.kill()
+            raise
+        for worker in starting:
+            self._idle.put(worker)
+        self.isolation = starting[0].isolation
+
+    def run(self, blocks: List[str], timeout: Optional[float] = None) -> ExecutionResult:
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        worker = self._idle.get()
+        healthy = True
+        started = time.perf_counter()
+        try:
+            result = ExecutionResult(**worker.run(blocks, timeout))
+        except TimeoutError:
+            healthy = False
+            result = ExecutionResult(ok=False, timed_out=True, error_type="TimeoutError",
+                                     error=f"Execution did not finish within {timeout:g} s")
+        except (EOFError, OSError, ValueError, TypeError) as e:
+            # Упал или сломался сам сервер исполнителя — это проблема окружения, а не кода
+            healthy = False
+            result = ExecutionResult(ok=False, error_type="WorkerCrashed", error=str(e) or "sandbox worker crashed")
+        if not result.duration_ms:
+            result.duration_ms = round((time.perf_counter() - started) * 1000, 3)
+        if healthy:
+            self._idle.put(worker)
+        else:
+            worker.kill()
+            # Замена поднимается в фоне: вызывающий не ждёт старта интерпретатора
+            threading.Thread(target=self._replace, name="sandbox-respawn", daemon=True).start()
+        return result
+
+    def _replace(self) -> None:
+        if self._closed:
+            return
+        for _ in range(2):
+            worker = _Worker(self.memory_mb)
+            try:
+                worker.wait_ready(30.0)
+            except SandboxUnavailable:
+                worker.kill()
+                continue
+            self._idle.put(worker)
+            return
+        # Неизолированный исполнитель в пул не попадает; пул работает с оставшимися
+        logger.error("Sandbox worker could not be restarted with isolation")
+
+    async def arun(self, blocks: List[str], timeout: Optional[float] = None) -> ExecutionResult:
+        return await asyncio.to_thread(self.run, blocks, timeout)
+
+    def close(self) -> None:
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                break
+
+
+@lru_cache(maxsize=None)
+def get_sandbox_pool() -> SandboxPool:
+    """Общий пул процесса; создаётся при первой проверке кода. SandboxUnavailable — изоляции нет."""
+    return SandboxPool()
+
+
+_unavailable: Optional[str] = None
+
+
+def available_sandbox_pool() -> Optional[SandboxPool]:
+    """Общий пул или None, если изоляция недоступна; неудачный запуск пула не повторяется."""
+    global _unavailable
+    if _unavailable is not None:
+        return None
+    try:
+        return get_sandbox_pool()
+    except SandboxUnavailable as e:
+        _unavailable = str(e)
+        logger.error("Sandbox disabled, code will not be executed: %s", e)
+        return None
+
+
+def build_report(blocks: List[str], result: ExecutionResult) -> VerificationReport:
+    """Переводит результат исполнения в замечания для ReActState: ошибки кода — issues, проблемы окружения — notes."""
+    report = VerificationReport(blocks=len(blocks), result=result)
+    if result.ok:
+        return report
+    where = f" (блок {result.block})" if result.block else ""
+    lines = (result.error or "").strip().splitlines()
+    error = lines[-1] if lines else (result.error_type or "ошибка")
+    if result.error_type in _ENVIRONMENT_ERRORS:
+        report.notes.append(f"не проверено{where}: {error}")
+    elif result.timed_out or result.error_type in _LIMIT_ERRORS:
+        report.issues.append(f"Код не завершился за отведённое время{where}: убери бесконечные циклы и ожидание ввода")
+    else:
+        report.issues.append(f"Ошибка при запуске кода{where}: {error}")
+    return report
+
+
+async def averify_code(answer: str, timeout: Optional[float] = None) -> Optional[VerificationReport]:
+    """Запускает Python-блоки ответа в песочнице; None, если проверка выключена или кода нет."""
+    if not SANDBOX_ENABLED:
+        return None
+    blocks = extract_python_blocks(answer)
+    if not blocks:
+        return None
+    from tracing import get_tracer
+
+    pool = await asyncio.to_thread(available_sandbox_pool)
+    if pool is None:
+        return build_report(blocks, ExecutionResult(ok=False, error_type="SandboxUnavailable", error=_unavailable))
+    with get_tracer().span("sandbox", blocks=len(blocks)) as span:
+        result = await pool.arun(blocks, timeout)
+        span["ok"] = result.ok
+    return build_report(blocks, result)
+
+
+if __name__ == "__main__" and sys.argv[1:2] == ["--worker"]:
+    _worker_main(int(sys.argv[2]), int(sys.argv[3]))
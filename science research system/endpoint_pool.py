@@ -0,0 +1,393 @@
+# endpoint_pool.py
+"""Пул OpenAI-совместимых эндпоинтов (реплик vLLM) за одним LLM-клиентом.
+
+OPENAI_API_BASE может содержать несколько URL через запятую. Тогда get_llm() ставит в
+httpx-клиент PooledTransport, и каждый HTTP-запрос уходит на одну из реплик:
+- балансировка по числу незавершённых запросов (LLM_LB_POLICY=least_outstanding)
+  или по EWMA задержки до первого байта с поправкой на загрузку (LLM_LB_POLICY=ewma);
+- пассивное исключение: после LLM_EJECT_AFTER сбоев подряд (обрыв соединения, 5xx)
+  реплика выводится из ротации с растущим интервалом; активная проверка GET /models
+  раз в LLM_HEALTH_INTERVAL секунд возвращает её или исключает упавшую;
+- если соединиться не удалось, запрос сразу уходит на другую реплику (он не был отправлен);
+- хеджирование коротких вызовов (маршрутизатор, блок hedging()): если за p95 задержки
+  первый байт не пришёл, тот же запрос отправляется на другую реплику, проигравший отменяется.
+Агенты, цепочки и планировщик (llm_scheduler.py) о пуле не знают.
+"""
+import asyncio
+import contextvars
+import os
+import random
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, AsyncIterator, Deque, Dict, Iterator, List, Optional, Sequence, Tuple
+
+import httpx
+
+from llm_provider import get_background_loop
+
+LLM_LB_POLICY = os.getenv("LLM_LB_POLICY", "least_outstanding")
+LLM_EWMA_ALPHA = float(os.getenv("LLM_EWMA_ALPHA", "0.3"))
+LLM_EJECT_AFTER = int(os.getenv("LLM_EJECT_AFTER", "3"))
+LLM_EJECT_SECONDS = float(os.getenv("LLM_EJECT_SECONDS", "10"))
+LLM_EJECT_MAX_SECONDS = float(os.getenv("LLM_EJECT_MAX_SECONDS", "120"))
+LLM_HEALTH_INTERVAL = float(os.getenv("LLM_HEALTH_INTERVAL", "5"))
+LLM_HEDGE = os.getenv("LLM_HEDGE", "1") == "1"
+# Фиксированная задержка хеджа в секундах; 0 — p95 недавних хеджируемых запросов
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "0"))
+
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 0.5  # пока p95 не набран
+HEDGE_MIN_DELAY = 0.02
+HEALTH_TIMEOUT = 2.0
+
+_hedge: contextvars.ContextVar[bool] = contextvars.ContextVar("llm_hedge", default=False)
+
+
+@contextmanager
+def hedging() -> Iterator[None]:
+    """HTTP-запросы к модели внутри блока хеджируются (только короткие вызовы: ответ дублируется)."""
+    token = _hedge.set(True)
+    try:
+        yield
+    finally:
+        _hedge.reset(token)
+
+
+@dataclass
+class Endpoint:
+    url: str
+    outstanding: int = 0
+    ewma: float = 0.0  # секунды до первого байта тела ответа
+    requests: int = 0
+    failures: int = 0
+    consecutive_failures: int = 0
+    ejections: int = 0
+    ejected_until: float = 0.0
+    unreachable: bool = False  # исключена активной проверкой, а не по сбоям запросов
+
+    @property
+    def ejected(self) -> bool:
+        return self.unreachable or time.monotonic() < self.ejected_until
+
+    def observe_latency(self, seconds: float) -> None:
+        self.ewma = seconds if self.ewma == 0.0 else self.ewma + LLM_EWMA_ALPHA * (seconds - self.ewma)
+
+    def cost(self, policy: str) -> Tuple[float, ...]:
+        if policy == "ewma":
+            # Peak-EWMA: задержка, умноженная на очередь, которую запрос застанет на реплике
+            return (self.ewma * (self.outstanding + 1), self.outstanding)
+        return (self.outstanding, self.ewma)
+
+
+@dataclass
+class EndpointPool:
+    urls: Sequence[str]
+    api_key: str = ""
+    policy: str = LLM_LB_POLICY
+    endpoints: List[Endpoint] = field(init=False)
+    hedge_latencies: Deque[float] = field(default_factory=lambda: deque(maxlen=500))
+    stats: Dict[str, int] = field(default_factory=lambda: {"hedged": 0, "hedge_wins": 0, "failovers": 0, "ejections": 0})
+
+    def __post_init__(self):
+        self.endpoints = [Endpoint(url) for url in self.urls]
+        self._health_task: Optional["asyncio.Future"] = None
+        # Синхронный транспорт работает из потоков Streamlit, асинхронный — из фонового loop
+        self._lock = threading.Lock()
+
+    # ---- выбор реплики
+
+    def pick(self, exclude: Sequence[Endpoint] = ()) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e not in exclude]
+        healthy = [e for e in candidates if not e.ejected]
+        # Все исключены — лучше попробовать реплику, чем отказать (panic mode)
+        candidates = healthy or candidates
+        if not candidates:
+            return None
+        best = min(endpoint.cost(self.policy) for endpoint in candidates)
+        return random.choice([e for e in candidates if e.cost(self.policy) == best])
+
+    def started(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+
+    def finished(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+
+    def succeeded(self, endpoint: Endpoint, latency: Optional[float], hedgeable: bool = False) -> None:
+        endpoint.consecutive_failures = 0
+        if latency is not None:
+            endpoint.observe_latency(latency)
+            if hedgeable:
+                self.hedge_latencies.append(latency)
+
+    def failed(self, endpoint: Endpoint) -> None:
+        endpoint.failures += 1
+        endpoint.consecutive_failures += 1
+        if endpoint.consecutive_failures >= LLM_EJECT_AFTER and not endpoint.ejected:
+            self.eject(endpoint)
+
+    def eject(self, endpoint: Endpoint) -> None:
+        # Повторные исключения всё дольше: реплика, которая падает снова и снова, не мешает подолгу
+        seconds = min(LLM_EJECT_MAX_SECONDS, LLM_EJECT_SECONDS * 2 ** endpoint.ejections)
+        endpoint.ejected_until = time.monotonic() + seconds
+        endpoint.ejections += 1
+        self.stats["ejections"] += 1
+
+    def restore(self, endpoint: Endpoint) -> None:
+        endpoint.ejected_until = 0.0
+        endpoint.consecutive_failures = 0
+        endpoint.unreachable = False
+
+    def hedge_delay(self) -> float:
+        if LLM_HEDGE_DELAY > 0:
+            return LLM_HEDGE_DELAY
+        if len(self.hedge_latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.hedge_latencies)
+        return max(HEDGE_MIN_DELAY, ordered[int(0.95 * (len(ordered) - 1))])
+
+    # ---- активные проверки
+
+    def start_health_checks(self) -> None:
+        if self._health_task is None and len(self.endpoints) > 1 and LLM_HEALTH_INTERVAL > 0:
+            self._health_task = asyncio.run_coroutine_threadsafe(self._health_loop(), get_background_loop())
+
+    async def _health_loop(self) -> None:
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        async with httpx.AsyncClient(timeout=HEALTH_TIMEOUT, headers=headers) as client:
+            while True:
+                await asyncio.gather(*(self._check(client, endpoint) for endpoint in self.endpoints))
+                await asyncio.sleep(LLM_HEALTH_INTERVAL)
+
+    async def _check(self, client: httpx.AsyncClient, endpoint: Endpoint) -> None:
+        try:
+            response = await client.get(f"{endpoint.url}/models")
+            alive = response.status_code < 500
+        except httpx.HTTPError:
+            alive = False
+        # Живой /models не отменяет исключение по сбоям запросов: реплика может отвечать 5xx на генерацию
+        if alive and endpoint.unreachable:
+            self.restore(endpoint)
+        elif not alive and not endpoint.ejected:
+            self.eject(endpoint)
+            endpoint.unreachable = True
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(self.stats, hedge_delay_ms=round(self.hedge_delay() * 1000, 1), endpoints=[
+            {"url": e.url, "outstanding": e.outstanding, "ewma_ms": round(e.ewma * 1000, 1), "requests": e.requests,
+             "failures": e.failures, "ejected": e.ejected}
+            for e in self.endpoints
+        ])
+
+
+@lru_cache(maxsize=None)
+def get_endpoint_pool(urls: Tuple[str, ...], api_key: str = "") -> EndpointPool:
+    """Один пул на набор реплик: синхронный и асинхронный клиенты делят счётчики и статистику."""
+    pool = EndpointPool(urls, api_key)
+    pool.start_health_checks()
+    return pool
+
+
+def _retarget(request: httpx.Request, base: httpx.URL, endpoint: Endpoint) -> httpx.Request:
+    """Тот же запрос на другую реплику: путь после базового URL клиента переносится на базу реплики."""
+    suffix = request.url.raw_path.decode("ascii")[len(base.raw_path.rstrip(b"/")):]
+    url = httpx.URL(endpoint.url + suffix)
+    headers = request.headers.copy()
+    headers["Host"] = url.netloc.decode("ascii")
+    return httpx.Request(request.method, url, headers=headers, content=request.content, extensions=request.extensions)
+
+
+_FAILOVER_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout)
+
+
+class _TrackedAsyncStream(httpx.AsyncByteStream):
+    """Тело ответа с уже прочитанным первым фрагментом; закрытие освобождает реплику."""
+
+    def __init__(self, pool: EndpointPool, endpoint: Endpoint, stream: httpx.AsyncByteStream, first: bytes, rest: AsyncIterator[bytes]):
+        self.pool, self.endpoint, self.stream = pool, endpoint, stream
+        self.first, self.rest = first, rest
+        self.closed = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        if self.first:
+            yield self.first
+        try:
+            async for chunk in self.rest:
+                yield chunk
+        except httpx.TransportError:
+            self.pool.failed(self.endpoint)
+            raise
+
+    async def aclose(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.pool.finished(self.endpoint)
+            await self.stream.aclose()
+
+
+class _TrackedSyncStream(httpx.SyncByteStream):
+    def __init__(self, pool: EndpointPool, endpoint: Endpoint, stream: httpx.SyncByteStream, first: bytes, rest: Iterator[bytes]):
+        self.pool, self.endpoint, self.stream = pool, endpoint, stream
+        self.first, self.rest = first, rest
+        self.closed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        if self.first:
+            yield self.first
+        try:
+            yield from self.rest
+        except httpx.TransportError:
+            self.pool.failed(self.endpoint)
+            raise
+
+    def close(self) -> None:
+        if not self.closed:
+            self.closed = True
+            self.pool.finished(self.endpoint)
+            self.stream.close()
+
+
+class PooledAsyncTransport(httpx.AsyncBaseTransport):
+    def __init__(self, pool: EndpointPool, base_url: str, transport: httpx.AsyncBaseTransport):
+        self.pool = pool
+        self.base = httpx.URL(base_url)
+        self.transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        await request.aread()
+        hedgeable = LLM_HEDGE and _hedge.get() and len(self.pool.endpoints) > 1
+        if hedgeable:
+            return await self._hedged(request)
+        return await self._send(request, self.pool.pick(), hedgeable=False)
+
+    async def _send(self, request: httpx.Request, endpoint: Endpoint, hedgeable: bool,
+                    tried: Tuple[Endpoint, ...] = ()) -> httpx.Response:
+        """Отправка с переходом на другую реплику, если соединиться не удалось."""
+        while True:
+            try:
+                return await self._attempt(request, endpoint, hedgeable)
+            except _FAILOVER_ERRORS:
+                tried += (endpoint,)
+                endpoint = self.pool.pick(exclude=tried)
+                if endpoint is None:
+                    raise
+                self.pool.stats["failovers"] += 1
+
+    async def _attempt(self, request: httpx.Request, endpoint: Endpoint, hedgeable: bool) -> httpx.Response:
+        """Запрос к одной реплике до первого фрагмента тела: так меряется задержка и выбирается победитель хеджа."""
+        self.pool.started(endpoint)
+        started = time.monotonic()
+        response = None
+        try:
+            response = await self.transport.handle_async_request(_retarget(request, self.base, endpoint))
+            rest = response.stream.__aiter__()
+            first = await rest.__anext__()
+        except StopAsyncIteration:
+            first = b""
+        except BaseException as e:
+            self.pool.finished(endpoint)
+            if response is not None:
+                await response.aclose()
+            if isinstance(e, httpx.TransportError):
+                self.pool.failed(endpoint)
+            raise
+        if response.status_code >= 500:
+            self.pool.failed(endpoint)
+        elif response.status_code < 400:
+            self.pool.succeeded(endpoint, time.monotonic() - started, hedgeable)
+        response.stream = _TrackedAsyncStream(self.pool, endpoint, response.stream, first, rest)
+        return response
+
+    async def _hedged(self, request: httpx.Request) -> httpx.Response:
+        primary = self.pool.pick()
+        tasks = [asyncio.ensure_future(self._send(request, primary, hedgeable=True))]
+        winner = None
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.pool.hedge_delay())
+            secondary = None if done else self.pool.pick(exclude=(primary,))
+            if secondary is not None:
+                self.pool.stats["hedged"] += 1
+                tasks.append(asyncio.ensure_future(self._send(request, secondary, hedgeable=True, tried=(primary,))))
+            winner = await self._first_good(tasks)
+            if winner is not tasks[0]:
+                self.pool.stats["hedge_wins"] += 1
+            return winner.result()
+        finally:
+            # Проигравший отменяется: незавершённый запрос прерывается, готовый ответ закрывается
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    await task.result().aclose()
+
+    @staticmethod
+    async def _first_good(tasks) -> "asyncio.Future":
+        """Первый ответ без 5xx; если таких нет — последний завершившийся (ошибка пробросится из него)."""
+        pending = set(tasks)
+        last = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                last = task
+                if task.exception() is None and task.result().status_code < 500:
+                    return task
+        return last
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+class PooledSyncTransport(httpx.BaseTransport):
+    """Синхронный вариант (invoke/stream из потоков): балансировка и переход на другую реплику, без хеджа."""
+
+    def __init__(self, pool: EndpointPool, base_url: str, transport: httpx.BaseTransport):
+        self.pool = pool
+        self.base = httpx.URL(base_url)
+        self.transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        request.read()
+        tried: Tuple[Endpoint, ...] = ()
+        endpoint = self.pool.pick()
+        while True:
+            try:
+                return self._attempt(request, endpoint)
+            except _FAILOVER_ERRORS:
+                tried += (endpoint,)
+                endpoint = self.pool.pick(exclude=tried)
+                if endpoint is None:
+                    raise
+                self.pool.stats["failovers"] += 1
+
+    def _attempt(self, request: httpx.Request, endpoint: Endpoint) -> httpx.Response:
+        self.pool.started(endpoint)
+        started = time.monotonic()
+        response = None
+        try:
+            response = self.transport.handle_request(_retarget(request, self.base, endpoint))
+            rest = iter(response.stream)
+            first = next(rest, b"")
+        except BaseException as e:
+            self.pool.finished(endpoint)
+            if response is not None:
+                response.close()
+            if isinstance(e, httpx.TransportError):
+                self.pool.failed(endpoint)
+            raise
+        if response.status_code >= 500:
+            self.pool.failed(endpoint)
+        elif response.status_code < 400:
+            self.pool.succeeded(endpoint, time.monotonic() - started)
+        response.stream = _TrackedSyncStream(self.pool, endpoint, response.stream, first, rest)
+        return response
+
+    def close(self) -> None:
+        self.transport.close()
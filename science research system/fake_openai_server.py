@@ -0,0 +1,224 @@
+# fake_openai_server.py
+"""Локальная заглушка OpenAI-совместимого /v1/chat/completions для офлайн-бенчмарков.
+
+Эмулирует задержку до первого токена, скорость генерации (токенов/с), потоковую
+выдачу (SSE) и инъекцию ошибок. Ответы правдоподобны для каждого звена системы:
+маршрутизатор получает JSON с next_agent, критик — JSON с оценкой, планировщик — план.
+
+Запуск: python fake_openai_server.py --port 8001 --latency 0.2 --tokens-per-sec 80
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+
+from keyword_router import get_keyword_router
+
+_ROUTER_LABELS = {"research": "science research", "coding": "coding", "writing": "writing"}
+_FILLER = (
+    "Результаты последних работ показывают устойчивый прогресс в данной области "
+    "and recent arXiv papers report consistent improvements on standard benchmarks"
+).split()
+
+
+@dataclass
+class FakeServerConfig:
+    latency: float = 0.2  # секунды до первого токена
+    latency_jitter: float = 0.05
+    tokens_per_sec: float = 80.0
+    completion_tokens: int = 120
+    failure_rate: float = 0.0
+    failure_status: int = 503
+    # Сколько запросов сервер обслуживает одновременно; сверх — 429 с Retry-After (0 — без ограничения)
+    capacity: int = 0
+    retry_after: float = 1.0
+    # Доля запросов с всплеском задержки до первого токена (вытеснение, GC) — хвост для хеджирования
+    spike_rate: float = 0.0
+    spike_latency: float = 2.0
+    # Токенов рассуждения <think>…</think> перед ответом, как у qwen3 (0 — без рассуждений);
+    # chat_template_kwargs.enable_thinking=false их отключает
+    think_tokens: int = 0
+    seed: Optional[int] = None
+
+
+class FakeOpenAIServer:
+    def __init__(self, config: Optional[FakeServerConfig] = None):
+        self.config = config or FakeServerConfig()
+        self.random = random.Random(self.config.seed)
+        self.requests_total = 0
+        self.failures_total = 0
+        self.cancelled_total = 0
+        self.throttled_total = 0
+        self.active = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url: Optional[str] = None
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self.chat_completions)
+        app.router.add_get("/v1/models", self.models)
+        app.router.add_get("/health", self.health)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Запускает сервер в текущем event loop; port=0 — любой свободный порт."""
+        self._runner = web.AppRunner(self.make_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        bound_host, bound_port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{bound_host}:{bound_port}/v1"
+        return self.base_url
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "status": "ok", "requests": self.requests_total, "failures": self.failures_total, "cancelled": self.cancelled_total,
+            "throttled": self.throttled_total, "active": self.active,
+        })
+
+    async def models(self, request: web.Request) -> web.Response:
+        return web.json_response({"object": "list", "data": [{"id": "fake-model", "object": "model"}]})
+
+    async def chat_completions(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        self.requests_total += 1
+        config = self.config
+        if config.failure_rate and self.random.random() < config.failure_rate:
+            self.failures_total += 1
+            return web.json_response(
+                {"error": {"message": "Injected failure", "type": "server_error", "code": config.failure_status}},
+                status=config.failure_status,
+            )
+        if config.capacity and self.active >= config.capacity:
+            self.throttled_total += 1
+            return web.json_response(
+                {"error": {"message": "Rate limit exceeded", "type": "rate_limit_error", "code": 429}},
+                status=429, headers={"Retry-After": f"{config.retry_after:g}"},
+            )
+        self.active += 1
+        try:
+            return await self.respond(request, body)
+        finally:
+            self.active -= 1
+
+    async def respond(self, request: web.Request, body: Dict[str, Any]) -> web.StreamResponse:
+        config = self.config
+        messages: List[Dict[str, Any]] = body.get("messages", [])
+        structured = (body.get("response_format") or {}).get("type") == "json_schema"
+        tokens = self.completion_tokens(messages, body.get("max_tokens") or body.get("max_completion_tokens"), structured)
+        thinking = (body.get("chat_template_kwargs") or {}).get("enable_thinking", True)
+        # Продолжение сообщения ассистента (continue_final_message) идёт уже после закрытого </think>
+        if config.think_tokens and thinking and not structured and not body.get("continue_final_message"):
+            tokens = ["<think>", "\n"] + [f"{self.random.choice(_FILLER)} " for _ in range(config.think_tokens)] + ["</think>", "\n\n"] + tokens
+        model = body.get("model", "fake-model")
+        latency = config.latency + self.random.uniform(-config.latency_jitter, config.latency_jitter)
+        if config.spike_rate and self.random.random() < config.spike_rate:
+            latency += config.spike_latency
+        await asyncio.sleep(max(0.0, latency))
+        if body.get("stream"):
+            return await self.stream_response(request, model, tokens, body.get("stream_options") or {})
+
+        await asyncio.sleep(len(tokens) / config.tokens_per_sec)
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in messages)
+        return web.json_response({
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)},
+        })
+
+    async def stream_response(self, request: web.Request, model: str, tokens: List[str], stream_options: Dict[str, Any]) -> web.StreamResponse:
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        delay = 1.0 / self.config.tokens_per_sec
+
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> bytes:
+            payload = {
+                "id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+            }
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        try:
+            await response.prepare(request)
+            await response.write(chunk({"role": "assistant", "content": ""}))
+            for token in tokens:
+                await asyncio.sleep(delay)
+                await response.write(chunk({"content": token}))
+        except ConnectionResetError:
+            # Клиент закрыл поток досрочно (ранний выход маршрутизатора, отмена запроса)
+            self.cancelled_total += 1
+            return response
+        await response.write(chunk({}, "stop"))
+        if stream_options.get("include_usage"):
+            usage = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model,
+                     "choices": [], "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}}
+            await response.write(f"data: {json.dumps(usage)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    def completion_tokens(self, messages: List[Dict[str, Any]], max_tokens: Optional[int], structured: bool = False) -> List[str]:
+        """Правдоподобный ответ под тип запроса, разбитый на «токены»; structured — как при response_format=json_schema."""
+        system = " ".join(str(m.get("content", "")) for m in messages if m.get("role") == "system")
+        user = " ".join(str(m.get("content", "")) for m in messages if m.get("role") in ("user", "human"))
+        if "router between" in system:
+            # Только сам вопрос: шаблон промпта перечисляет все метки и сбил бы ключевые слова
+            question = user.split("User question:", 1)[-1].split("\n\n", 1)[0]
+            agent = get_keyword_router().route(question).agent.value
+            decision = {"next_agent": _ROUTER_LABELS[agent]}
+            if not structured:
+                decision["reason"] = "fake router: " + " ".join(self.random.choice(_FILLER) for _ in range(20))
+            text = json.dumps(decision, ensure_ascii=False)
+        elif "рецензент" in system:
+            text = json.dumps({"score": 0.9, "issues": []})
+        elif "sub-tasks" in system:
+            text = json.dumps({"tasks": [
+                {"id": "t1", "agent": "research", "task": user, "depends_on": []},
+                {"id": "t2", "agent": "coding", "task": user, "depends_on": []},
+            ]})
+        else:
+            count = self.config.completion_tokens if not max_tokens else min(self.config.completion_tokens, int(max_tokens))
+            return [f"{self.random.choice(_FILLER)} " for _ in range(count)]
+        # JSON отдаём кусками по ~4 символа, как настоящий токенизатор
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI-compatible chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--latency", type=float, default=0.2)
+    parser.add_argument("--tokens-per-sec", type=float, default=80.0)
+    parser.add_argument("--completion-tokens", type=int, default=120)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--failure-status", type=int, default=503)
+    parser.add_argument("--capacity", type=int, default=0, help="Одновременных запросов до ответа 429 (0 — без ограничения)")
+    parser.add_argument("--spike-rate", type=float, default=0.0)
+    parser.add_argument("--spike-latency", type=float, default=2.0)
+    parser.add_argument("--think-tokens", type=int, default=0, help="Токенов рассуждения <think> перед ответом")
+    args = parser.parse_args()
+    server = FakeOpenAIServer(FakeServerConfig(
+        latency=args.latency, tokens_per_sec=args.tokens_per_sec, completion_tokens=args.completion_tokens,
+        failure_rate=args.failure_rate, failure_status=args.failure_status,
+        capacity=args.capacity, spike_rate=args.spike_rate, spike_latency=args.spike_latency,
+        think_tokens=args.think_tokens,
+    ))
+    web.run_app(server.make_app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
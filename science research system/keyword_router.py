@@ -0,0 +1,237 @@
+# keyword_router.py
+"""Однопроходный маршрутизатор запросов по ключевым словам.
+
+Все ключевые слова всех агентов компилируются в один автомат Ахо-Корасик,
+поэтому запрос просматривается ровно один раз независимо от размера словаря.
+"""
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from agent_factory import AgentType
+
+# Порядок, в котором разрешаются равные баллы (как в исходной цепочке if/elif)
+AGENT_PRIORITY: Tuple[AgentType, ...] = (AgentType.RESEARCH, AgentType.CODING, AgentType.WRITING)
+# Латинские термины не длиннее этого должны совпадать целым словом («rust» ≠ «trust», «java» ≠ «javascript»)
+SHORT_TERM_LEN = 4
+
+
+@dataclass(frozen=True)
+class KeywordRule:
+    """Ключевое слово (или основа слова) с весом для конкретного агента."""
+    pattern: str
+    agent: AgentType
+    weight: float = 1.0
+    negated: bool = False
+    # Общее слово («найди», «search»): влияет на выбор агента, но само по себе не делает
+    # запрос задачей этого агента — is_composite его не учитывает
+    generic: bool = False
+
+
+@dataclass
+class KeywordRouteDecision:
+    """Результат маршрутизации: выбранный агент, уверенность и баллы всех агентов."""
+    agent: AgentType
+    confidence: float
+    scores: Dict[AgentType, float] = field(default_factory=dict)
+    matched: List[str] = field(default_factory=list)
+
+    @property
+    def ranked(self) -> List[Tuple[AgentType, float]]:
+        return sorted(self.scores.items(), key=lambda item: (-item[1], AGENT_PRIORITY.index(item[0])))
+
+
+class KeywordAutomaton:
+    """Автомат Ахо-Корасик над строками в нижнем регистре."""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[int]] = [[]]
+        # Собственные шаблоны узла; _output = они же плюс выходы по суффиксным ссылкам
+        self._own: List[List[int]] = [[]]
+        self._patterns: List[str] = []
+        self._built = False
+
+    def add(self, pattern: str) -> int:
+        """Добавляет шаблон и возвращает его индекс."""
+        pattern = pattern.lower()
+        if not pattern:
+            raise ValueError("Пустой шаблон недопустим")
+        node = 0
+        for char in pattern:
+            next_node = self._goto[node].get(char)
+            if next_node is None:
+                next_node = len(self._goto)
+                self._goto[node][char] = next_node
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._own.append([])
+            node = next_node
+        index = len(self._patterns)
+        self._patterns.append(pattern)
+        self._own[node].append(index)
+        self._built = False
+        return index
+
+    def build(self) -> "KeywordAutomaton":
+        """Строит суффиксные ссылки обходом в ширину; повторный вызов пересчитывает их с нуля."""
+        self._output = [list(own) for own in self._own]
+        queue = list(self._goto[0].values())
+        for node in queue:
+            self._fail[node] = 0
+        head = 0
+        while head < len(queue):
+            node = queue[head]
+            head += 1
+            for char, child in self._goto[node].items():
+                queue.append(child)
+                fallback = self._fail[node]
+                while fallback and char not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                candidate = self._goto[fallback].get(char, 0)
+                self._fail[child] = candidate if candidate != child else 0
+                self._output[child] = self._output[child] + self._output[self._fail[child]]
+        self._built = True
+        return self
+
+    def iter_matches(self, text: str) -> Iterator[Tuple[int, int]]:
+        """Возвращает пары (позиция конца совпадения, индекс шаблона)."""
+        if not self._built:
+            self.build()
+        goto, fail, output = self._goto, self._fail, self._output
+        node = 0
+        for position, char in enumerate(text.lower()):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for index in output[node]:
+                yield position, index
+
+    def pattern(self, index: int) -> str:
+        return self._patterns[index]
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+def _word_bounds(pattern: str) -> Tuple[bool, bool]:
+    """Нужна ли граница слова перед и после латинского шаблона.
+
+    Латинский шаблон должен начинаться с начала слова («search» не находится в «research»),
+    а короткий — ещё и заканчиваться на границе («sota» в «Minnesota», «java» в «javascript»).
+    Русские шаблоны — основы слов с приставками и окончаниями, их границы не проверяются.
+    """
+    if not pattern.isascii():
+        return False, False
+    start = _is_word_char(pattern[0])
+    end = _is_word_char(pattern[-1]) and len(pattern.strip()) <= SHORT_TERM_LEN
+    return start, end
+
+
+class KeywordRouter:
+    """Взвешенный маршрутизатор: каждый агент получает балл за найденные ключевые слова."""
+
+    def __init__(self, rules: Iterable[KeywordRule], default_agent: AgentType = AgentType.WRITING):
+        self.default_agent = default_agent
+        self.rules: List[KeywordRule] = list(rules)
+        self._automaton = KeywordAutomaton()
+        # Один шаблон может встречаться в нескольких правилах (например, для разных агентов)
+        self._rules_by_pattern: Dict[int, List[KeywordRule]] = {}
+        self._bounds: Dict[int, Tuple[bool, bool]] = {}
+        pattern_index: Dict[str, int] = {}
+        for rule in self.rules:
+            key = rule.pattern.lower()
+            if key not in pattern_index:
+                pattern_index[key] = self._automaton.add(key)
+                self._bounds[pattern_index[key]] = _word_bounds(key)
+            self._rules_by_pattern.setdefault(pattern_index[key], []).append(rule)
+        self._automaton.build()
+
+    def score(self, query: str, generic: bool = True) -> Tuple[Dict[AgentType, float], List[str]]:
+        """Считает баллы агентов за один проход; каждое слово учитывается один раз.
+
+        generic=False — без общих слов (KeywordRule.generic).
+        """
+        scores = {agent: 0.0 for agent in AGENT_PRIORITY}
+        seen = set()
+        text = query.lower()
+        for end, index in self._automaton.iter_matches(text):
+            if index in seen or not self._at_word_bounds(text, end, index):
+                continue
+            seen.add(index)
+            for rule in self._rules_by_pattern[index]:
+                if rule.generic and not generic:
+                    continue
+                scores[rule.agent] = scores.get(rule.agent, 0.0) + (-rule.weight if rule.negated else rule.weight)
+        matched = [self._automaton.pattern(index) for index in sorted(seen)]
+        return scores, matched
+
+    def _at_word_bounds(self, text: str, end: int, index: int) -> bool:
+        need_start, need_end = self._bounds[index]
+        start = end - len(self._automaton.pattern(index)) + 1
+        if need_start and start > 0 and _is_word_char(text[start - 1]):
+            return False
+        if need_end and end + 1 < len(text) and _is_word_char(text[end + 1]):
+            return False
+        return True
+
+    def route(self, query: str) -> KeywordRouteDecision:
+        scores, matched = self.score(query)
+        decision = KeywordRouteDecision(agent=self.default_agent, confidence=0.0, scores=scores, matched=matched)
+        best_agent, best_score = decision.ranked[0]
+        positive_total = sum(value for value in scores.values() if value > 0)
+        if best_score > 0:
+            decision.agent = best_agent
+            decision.confidence = round(best_score / positive_total, 4)
+        return decision
+
+
+def _rules(agent: AgentType, weight: float, patterns: Iterable[str], negated: bool = False,
+           generic: bool = False) -> List[KeywordRule]:
+    return [KeywordRule(pattern, agent, weight, negated, generic) for pattern in patterns]
+
+
+DEFAULT_RULES: List[KeywordRule] = [
+    *_rules(AgentType.RESEARCH, 2.0, ["arxiv", "science research", "научное исследование", "научн", "literature review", "state of the art", "sota"]),
+    *_rules(AgentType.RESEARCH, 1.0, [
+        "research", "science", "scientific", "paper", "article", "survey",
+        "статья", "статьи", "статей", "исследован", "публикац", "литератур",
+    ]),
+    # «Найди ошибку в коде», «binary search», «code review» — не литературный поиск
+    # Половинный вес: при равенстве с предметным словом («код») выигрывает предметное
+    *_rules(AgentType.RESEARCH, 0.5, ["review", "study", "обзор", "анализ", "источник", "найди", "search"], generic=True),
+    *_rules(AgentType.RESEARCH, 3.0, ["без обзора", "без литератур", "без исследован", "no research", "without research",
+                                      "no literature", "without literature"], negated=True),
+    *_rules(AgentType.CODING, 2.0, ["a code", "write code", "напиши код", "реализуй", "implement", "source code"]),
+    *_rules(AgentType.CODING, 1.0, [
+        "код", "програм", "алгоритм", "функци", "библиотек", "импорт", "скрипт", "класс",
+        "python", "java", "c++", "c#", "rust", "golang", "pytorch", "tensorflow", "numpy",
+        "coding", "programme", "program", "function", "script", "class ", "debug", "отлад",
+    ]),
+    *_rules(AgentType.CODING, 3.0, ["не код", "без кода", "no code", "not a code", "without code"], negated=True),
+    *_rules(AgentType.WRITING, 1.0, [
+        "объясни", "перепиши", "перефразируй", "расскажи", "что такое", "сформулируй", "текст",
+        "explain", "rewrite", "rephrase", "what is", "summarize", "essay", "letter",
+    ]),
+]
+
+_default_router: Optional[KeywordRouter] = None
+
+
+def get_keyword_router() -> KeywordRouter:
+    """Общий (скомпилированный один раз) маршрутизатор со словарём по умолчанию."""
+    global _default_router
+    if _default_router is None:
+        _default_router = KeywordRouter(DEFAULT_RULES)
+    return _default_router
+
+
+def is_composite(query: str) -> bool:
+    """Составной запрос: ключевые слова указывают сразу на исследование и на код.
+
+    Общие слова не считаются: «найди» или «search» в вопросе о коде не делают его исследованием.
+    """
+    scores, _ = get_keyword_router().score(query, generic=False)
+    return scores.get(AgentType.RESEARCH, 0) > 0 and scores.get(AgentType.CODING, 0) > 0
@@ -0,0 +1,234 @@
+# learned_router.py
+"""Локальный обучаемый маршрутизатор: TF-IDF + мультиномиальный наивный Байес на NumPy.
+
+Обучается офлайн на журнале решений LLM-маршрутизатора (question, RoutingDecision)
+и отвечает за микросекунды; при низкой уверенности вызывающий код идёт в router_chain.
+
+Обучение:   python learned_router.py train router_log.jsonl --model router_model.npz
+Проверка:   python learned_router.py report router_log.jsonl --model router_model.npz
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import time
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from agent_factory import AgentType
+from streaming_router import match_agent_label
+
+ROUTER_LOG_PATH = os.getenv("ROUTER_LOG_PATH", "router_log.jsonl")
+ROUTER_MODEL_PATH = os.getenv("LEARNED_ROUTER_MODEL", "router_model.npz")
+LEARNED_ROUTER_THRESHOLD = float(os.getenv("LEARNED_ROUTER_THRESHOLD", "0.85"))
+
+_TOKEN_RE = re.compile(r"[\w+#]+", re.UNICODE)
+_CLASSES: Tuple[AgentType, ...] = (AgentType.RESEARCH, AgentType.CODING, AgentType.WRITING)
+
+
+def agent_from_label(label: str) -> Optional[AgentType]:
+    """Сводит метку LLM-маршрутизатора (в т.ч. с опечатками) к AgentType; None, если метка не распознана."""
+    return match_agent_label(label)
+
+
+def extract_features(text: str) -> List[str]:
+    """Слова + префиксы длиной 4-6 символов (грубая замена стемминга для русского)."""
+    features = []
+    for token in _TOKEN_RE.findall(text.lower()):
+        features.append(token)
+        for length in range(4, min(len(token), 6) + 1):
+            if length < len(token):
+                features.append(token[:length] + "~")
+    return features
+
+
+@dataclass
+class LocalRouteDecision:
+    agent: AgentType
+    confidence: float
+
+
+class LearnedRouter:
+    """TF-IDF-взвешенный мультиномиальный наивный Байес."""
+
+    def __init__(self, vocabulary: Dict[str, int], idf: np.ndarray, log_prob: np.ndarray, log_prior: np.ndarray):
+        self.vocabulary = vocabulary
+        self.idf = idf
+        self.log_prob = log_prob  # (n_classes, n_features)
+        self.log_prior = log_prior  # (n_classes,)
+
+    @classmethod
+    def fit(cls, questions: Sequence[str], labels: Sequence[AgentType], alpha: float = 0.1, min_df: int = 1) -> "LearnedRouter":
+        documents = [extract_features(question) for question in questions]
+        document_frequency: Dict[str, int] = {}
+        for features in documents:
+            for feature in set(features):
+                document_frequency[feature] = document_frequency.get(feature, 0) + 1
+        vocabulary = {
+            feature: index
+            for index, feature in enumerate(sorted(f for f, df in document_frequency.items() if df >= min_df))
+        }
+        n_documents = len(documents)
+        idf = np.ones(len(vocabulary), dtype=np.float32)
+        for feature, index in vocabulary.items():
+            idf[index] = math.log((1 + n_documents) / (1 + document_frequency[feature])) + 1.0
+
+        class_index = {agent: i for i, agent in enumerate(_CLASSES)}
+        feature_mass = np.zeros((len(_CLASSES), len(vocabulary)), dtype=np.float64)
+        class_counts = np.zeros(len(_CLASSES), dtype=np.float64)
+        for features, label in zip(documents, labels):
+            row = class_index[label]
+            class_counts[row] += 1
+            indices, weights = cls._tfidf(features, vocabulary, idf)
+            np.add.at(feature_mass[row], indices, weights)
+
+        smoothed = feature_mass + alpha
+        log_prob = np.log(smoothed / smoothed.sum(axis=1, keepdims=True)).astype(np.float32)
+        log_prior = np.log((class_counts + 1.0) / (class_counts.sum() + len(_CLASSES))).astype(np.float32)
+        return cls(vocabulary, idf, log_prob, log_prior)
+
+    @staticmethod
+    def _tfidf(features: Iterable[str], vocabulary: Dict[str, int], idf: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        counts: Dict[int, int] = {}
+        for feature in features:
+            index = vocabulary.get(feature)
+            if index is not None:
+                counts[index] = counts.get(index, 0) + 1
+        indices = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+        weights = np.fromiter(counts.values(), dtype=np.float32, count=len(counts)) * idf[indices]
+        norm = float(np.linalg.norm(weights))
+        return indices, (weights / norm if norm else weights)
+
+    def predict(self, question: str) -> LocalRouteDecision:
+        indices, weights = self._tfidf(extract_features(question), self.vocabulary, self.idf)
+        joint = self.log_prior + self.log_prob[:, indices] @ weights
+        probabilities = np.exp(joint - joint.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        # Без единого известного признака модели нечего сказать — уверенность нулевая
+        confidence = float(probabilities[best]) if len(indices) else 0.0
+        return LocalRouteDecision(agent=_CLASSES[best], confidence=confidence)
+
+    def save(self, path: str) -> None:
+        features = sorted(self.vocabulary, key=self.vocabulary.get)
+        np.savez_compressed(
+            path,
+            features=np.array(features, dtype=str),
+            idf=self.idf,
+            log_prob=self.log_prob,
+            log_prior=self.log_prior,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "LearnedRouter":
+        with np.load(path) as data:
+            vocabulary = {str(feature): index for index, feature in enumerate(data["features"])}
+            return cls(vocabulary, data["idf"], data["log_prob"], data["log_prior"])
+
+
+def load_learned_router(path: str = ROUTER_MODEL_PATH) -> Optional[LearnedRouter]:
+    """Загружает модель, если она обучена; иначе маршрутизация идёт только через LLM."""
+    if not os.path.exists(path):
+        return None
+    return LearnedRouter.load(path)
+
+
+def log_routing_decision(question: str, next_agent: str, reason: str, path: str = ROUTER_LOG_PATH) -> None:
+    """Дописывает решение LLM-маршрутизатора в журнал для последующего обучения."""
+    if not path:
+        return
+    record = {"ts": time.time(), "question": question, "next_agent": next_agent, "reason": reason}
+    with open(path, "a", encoding="utf-8") as log_file:
+        log_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+async def alog_routing_decision(question: str, next_agent: str, reason: str, path: str = ROUTER_LOG_PATH) -> None:
+    """log_routing_decision для event loop: запись в файл идёт в потоке."""
+    if path:
+        await asyncio.to_thread(log_routing_decision, question, next_agent, reason, path)
+
+
+def read_routing_log(path: str) -> Tuple[List[str], List[AgentType]]:
+    """Примеры для обучения; записи с нераспознанной меткой пропускаются, а не считаются writing."""
+    questions, labels = [], []
+    with open(path, encoding="utf-8") as log_file:
+        for line in log_file:
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            label = agent_from_label(record["next_agent"])
+            if label is None:
+                continue
+            questions.append(record["question"])
+            labels.append(label)
+    return questions, labels
+
+
+def agreement_report(router: LearnedRouter, questions: Sequence[str], labels: Sequence[AgentType], threshold: float) -> Dict[str, float]:
+    """Согласие с LLM-маршрутизатором: в целом и на запросах выше порога уверенности."""
+    agree = confident = confident_agree = 0
+    started = time.perf_counter()
+    for question, label in zip(questions, labels):
+        decision = router.predict(question)
+        agree += decision.agent == label
+        if decision.confidence >= threshold:
+            confident += 1
+            confident_agree += decision.agent == label
+    elapsed = time.perf_counter() - started
+    total = max(len(questions), 1)
+    return {
+        "samples": len(questions),
+        "agreement": agree / total,
+        "coverage": confident / total,
+        "agreement_above_threshold": confident_agree / confident if confident else 0.0,
+        "mean_predict_us": elapsed / total * 1e6,
+    }
+
+
+def cross_validate(questions: Sequence[str], labels: Sequence[AgentType], threshold: float, folds: int = 5, seed: int = 0) -> Dict[str, float]:
+    order = list(range(len(questions)))
+    random.Random(seed).shuffle(order)
+    totals: Dict[str, float] = {}
+    used_folds = 0
+    for fold in range(folds):
+        test = set(order[fold::folds])
+        train = [i for i in order if i not in test]
+        if not test or not train:
+            continue
+        router = LearnedRouter.fit([questions[i] for i in train], [labels[i] for i in train])
+        report = agreement_report(router, [questions[i] for i in test], [labels[i] for i in test], threshold)
+        for key, value in report.items():
+            totals[key] = totals.get(key, 0.0) + value
+        used_folds += 1
+    return {key: value / used_folds for key, value in totals.items()} if used_folds else {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Обучение и проверка локального маршрутизатора")
+    parser.add_argument("command", choices=["train", "report"])
+    parser.add_argument("log", nargs="?", default=ROUTER_LOG_PATH, help="JSONL-журнал решений LLM-маршрутизатора")
+    parser.add_argument("--model", default=ROUTER_MODEL_PATH)
+    parser.add_argument("--threshold", type=float, default=LEARNED_ROUTER_THRESHOLD)
+    parser.add_argument("--folds", type=int, default=5)
+    args = parser.parse_args()
+
+    questions, labels = read_routing_log(args.log)
+    if args.command == "train":
+        report = cross_validate(questions, labels, args.threshold, folds=args.folds)
+        LearnedRouter.fit(questions, labels).save(args.model)
+        print(f"Модель сохранена в {args.model} ({len(questions)} примеров)")
+        print("Кросс-валидация (согласие с LLM-маршрутизатором):")
+    else:
+        report = agreement_report(LearnedRouter.load(args.model), questions, labels, args.threshold)
+        print(f"Согласие модели {args.model} с журналом {args.log}:")
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
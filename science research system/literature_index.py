@@ -0,0 +1,429 @@
+# literature_index.py
+"""Локальный офлайн-индекс научной литературы: BM25 по дампу метаданных arXiv (JSONL).
+
+Индекс — каталог сегментов. Словарь сегмента хранится как отсортированный массив
+64-битных хэшей терминов, постинги и длины документов — в .npy-файлах, которые
+открываются через memory map: открытие индекса почти бесплатно, а с диска читаются
+только постинги терминов запроса. Повторный запуск build дочитывает дамп с места
+последней остановки и дописывает новые сегменты; записи с уже известным id
+замещают старые версии (старые помечаются удалёнными).
+
+Сборка:   python literature_index.py build arxiv-metadata-oai-snapshot.jsonl --index literature_index
+Поиск:    python literature_index.py search "object tracking with transformers" -k 5
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from array import array
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from tracing import get_tracer
+
+LITERATURE_INDEX_PATH = os.getenv("LITERATURE_INDEX_PATH", "literature_index")
+LITERATURE_TOP_K = int(os.getenv("LITERATURE_TOP_K", "5"))
+# Сколько символов аннотации попадает в промпт: контекст должен оставаться коротким
+LITERATURE_SNIPPET_CHARS = int(os.getenv("LITERATURE_SNIPPET_CHARS", "300"))
+
+SEGMENT_DOCS = 200_000
+STORED_ABSTRACT_CHARS = 600
+TITLE_WEIGHT = 2  # слова заголовка учитываются как несколько вхождений (упрощённый BM25F)
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+META_FILE = "meta.json"
+NO_SOURCES = "(в локальном индексе arXiv нет подходящих записей — не выдумывай ссылки)"
+
+_TOKEN_RE = re.compile(r"[a-zа-яё0-9]+")
+_YEAR_RE = re.compile(r"(19|20)\d\d")
+_STOPWORDS = frozenset(
+    "a an and are as at be by for from has have in into is it its of on or our that the their this to "
+    "we with which these those using via based can not such than also between over under".split()
+)
+
+
+def tokenize(text: str) -> List[str]:
+    return [token for token in _TOKEN_RE.findall(text.lower()) if token not in _STOPWORDS and len(token) > 1]
+
+
+def term_hash(term: str) -> int:
+    """Стабильный между процессами 64-битный хэш термина (встроенный hash() рандомизирован)."""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+@dataclass
+class LiteratureRecord:
+    id: str
+    title: str
+    authors: str
+    year: str
+    abstract: str
+    categories: str = ""
+
+    @property
+    def url(self) -> str:
+        return f"https://arxiv.org/abs/{self.id}"
+
+    @classmethod
+    def from_arxiv(cls, raw: Dict[str, Any]) -> "LiteratureRecord":
+        """Запись из arxiv-metadata-oai-snapshot.json (поля id, title, authors, abstract, versions ...)."""
+        authors = [name.strip() for name in _clean(raw.get("authors", "")).replace(" and ", ", ").split(",") if name.strip()]
+        versions = raw.get("versions") or []
+        dated = (versions[0].get("created", "") if versions else "") or raw.get("update_date", "")
+        year = _YEAR_RE.search(dated or "")
+        return cls(
+            id=str(raw["id"]),
+            title=_clean(raw.get("title", "")),
+            authors=", ".join(authors[:3]) + (" et al." if len(authors) > 3 else ""),
+            year=year.group(0) if year else "",
+            abstract=_clean(raw.get("abstract", "")),
+            categories=raw.get("categories", ""),
+        )
+
+
+def _clean(text: str) -> str:
+    return " ".join((text or "").split())
+
+
+@dataclass
+class SearchHit:
+    score: float
+    record: LiteratureRecord
+
+
+class _SegmentBuilder:
+    """Накопитель постингов одного сегмента в компактных array, без словаря списков."""
+
+    def __init__(self):
+        self.vocabulary: Dict[str, int] = {}
+        self.terms = array("I")
+        self.docs = array("I")
+        self.tfs = array("H")
+        self.doc_lens = array("I")
+        self.ids: Dict[str, int] = {}
+        self.deleted: List[int] = []
+        self.stored: List[bytes] = []
+
+    def __len__(self) -> int:
+        return len(self.stored)
+
+    def add(self, record: LiteratureRecord) -> None:
+        local = len(self.stored)
+        previous = self.ids.get(record.id)
+        if previous is not None:
+            self.deleted.append(previous)
+        self.ids[record.id] = local
+
+        counts = Counter(tokenize(record.abstract))
+        for token in tokenize(record.title):
+            counts[token] += TITLE_WEIGHT
+        vocabulary = self.vocabulary
+        for term in counts:
+            if term not in vocabulary:
+                vocabulary[term] = len(vocabulary)
+        # Пакетные extend вместо поэлементных append: сборка упирается в этот цикл
+        self.terms.extend(map(vocabulary.__getitem__, counts))
+        self.docs.extend([local] * len(counts))
+        tfs = list(counts.values())
+        self.tfs.extend(tfs if not tfs or max(tfs) <= 65535 else [min(tf, 65535) for tf in tfs])
+        self.doc_lens.append(sum(tfs))
+        stored = dict(vars(record), abstract=record.abstract[:STORED_ABSTRACT_CHARS])
+        self.stored.append(json.dumps(stored, ensure_ascii=False).encode("utf-8") + b"\n")
+
+    def write(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        hashes = np.fromiter((term_hash(term) for term in self.vocabulary), dtype=np.uint64, count=len(self.vocabulary))
+        posting_hashes = hashes[np.frombuffer(self.terms, dtype=np.uint32)]
+        docs = np.frombuffer(self.docs, dtype=np.uint32)
+        order = np.lexsort((docs, posting_hashes))
+        sorted_hashes = posting_hashes[order]
+        unique_hashes, starts = np.unique(sorted_hashes, return_index=True)
+        np.save(os.path.join(path, "term_hashes.npy"), unique_hashes)
+        np.save(os.path.join(path, "term_offsets.npy"), np.append(starts, len(sorted_hashes)).astype(np.int64))
+        np.save(os.path.join(path, "postings_docs.npy"), docs[order])
+        np.save(os.path.join(path, "postings_tf.npy"), np.frombuffer(self.tfs, dtype=np.uint16)[order])
+        np.save(os.path.join(path, "doc_lens.npy"), np.frombuffer(self.doc_lens, dtype=np.uint32))
+
+        id_hashes = np.fromiter((term_hash(doc_id) for doc_id in self.ids), dtype=np.uint64, count=len(self.ids))
+        id_docs = np.fromiter(self.ids.values(), dtype=np.uint32, count=len(self.ids))
+        id_order = np.argsort(id_hashes)
+        np.save(os.path.join(path, "id_hashes.npy"), id_hashes[id_order])
+        np.save(os.path.join(path, "id_docs.npy"), id_docs[id_order])
+
+        offsets = np.zeros(len(self.stored) + 1, dtype=np.int64)
+        np.cumsum([len(line) for line in self.stored], out=offsets[1:])
+        np.save(os.path.join(path, "doc_offsets.npy"), offsets)
+        with open(os.path.join(path, "docs.jsonl"), "wb") as docs_file:
+            docs_file.writelines(self.stored)
+        deleted = np.zeros(len(self.stored), dtype=bool)
+        deleted[self.deleted] = True
+        np.save(os.path.join(path, "deleted.npy"), deleted)
+
+
+class _Segment:
+    def __init__(self, path: str):
+        self.path = path
+
+        def load(name: str) -> np.ndarray:
+            return np.load(os.path.join(path, name), mmap_mode="r")
+
+        self.term_hashes = load("term_hashes.npy")
+        self.term_offsets = load("term_offsets.npy")
+        self.postings_docs = load("postings_docs.npy")
+        self.postings_tf = load("postings_tf.npy")
+        self.doc_lens = load("doc_lens.npy")
+        self.id_hashes = load("id_hashes.npy")
+        self.id_docs = load("id_docs.npy")
+        self.doc_offsets = load("doc_offsets.npy")
+        # Маска удалённых небольшая и перезаписывается при обновлениях — держим её в памяти
+        self.deleted = np.load(os.path.join(path, "deleted.npy"))
+        self.dirty = False
+        self.size = len(self.doc_lens)
+
+    def postings(self, hashed: int) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        position = int(np.searchsorted(self.term_hashes, np.uint64(hashed)))
+        if position == len(self.term_hashes) or int(self.term_hashes[position]) != hashed:
+            return None
+        start, end = int(self.term_offsets[position]), int(self.term_offsets[position + 1])
+        return self.postings_docs[start:end], self.postings_tf[start:end]
+
+    def find(self, doc_id: str) -> Optional[int]:
+        hashed = term_hash(doc_id)
+        position = int(np.searchsorted(self.id_hashes, np.uint64(hashed)))
+        if position < len(self.id_hashes) and int(self.id_hashes[position]) == hashed:
+            local = int(self.id_docs[position])
+            return None if self.deleted[local] else local
+        return None
+
+    def record(self, local: int) -> LiteratureRecord:
+        start, end = int(self.doc_offsets[local]), int(self.doc_offsets[local + 1])
+        with open(os.path.join(self.path, "docs.jsonl"), "rb") as docs_file:
+            docs_file.seek(start)
+            return LiteratureRecord(**json.loads(docs_file.read(end - start)))
+
+    def save_deleted(self) -> None:
+        np.save(os.path.join(self.path, "deleted.npy"), self.deleted)
+
+
+class LiteratureIndex:
+    """BM25-индекс из сегментов с memory-mapped постингами."""
+
+    def __init__(self, path: str = LITERATURE_INDEX_PATH):
+        self.path = path
+        with open(os.path.join(path, META_FILE), encoding="utf-8") as meta_file:
+            self.meta = json.load(meta_file)
+        self.segments = [_Segment(os.path.join(path, name)) for name in self.meta["segments"]]
+
+    @classmethod
+    def open_or_create(cls, path: str) -> "LiteratureIndex":
+        if not os.path.exists(os.path.join(path, META_FILE)):
+            os.makedirs(path, exist_ok=True)
+            cls._write_meta(path, {"segments": [], "num_docs": 0, "total_length": 0, "sources": {}})
+        return cls(path)
+
+    @staticmethod
+    def _write_meta(path: str, meta: Dict[str, Any]) -> None:
+        # Атомарная замена: прерванная индексация оставляет индекс в последнем целостном состоянии
+        tmp_path = os.path.join(path, META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, os.path.join(path, META_FILE))
+
+    @property
+    def num_docs(self) -> int:
+        return self.meta["num_docs"]
+
+    @property
+    def version(self) -> str:
+        """Меняется с каждым сегментом и каждой заменённой записью; для ключей кэша ответов."""
+        last = self.meta["segments"][-1] if self.meta["segments"] else "empty"
+        return f"{last}:{self.meta['num_docs']}:{self.meta['total_length']}"
+
+    def search(self, query: str, k: int = LITERATURE_TOP_K) -> List[SearchHit]:
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.num_docs or k <= 0:
+            return []
+        n_docs = self.num_docs
+        avg_length = self.meta["total_length"] / n_docs
+        postings = [[segment.postings(term_hash(term)) for segment in self.segments] for term in terms]
+        # df суммируется по сегментам и включает ещё не вычищенные удалённые версии — как в Lucene
+        idf = []
+        for per_segment in postings:
+            df = sum(len(found[0]) for found in per_segment if found is not None)
+            idf.append(math.log(1 + (n_docs - df + 0.5) / (df + 0.5)))
+
+        candidates: List[Tuple[float, int, int]] = []
+        for segment_index, segment in enumerate(self.segments):
+            scores = None
+            for term_index, per_segment in enumerate(postings):
+                found = per_segment[segment_index]
+                if found is None:
+                    continue
+                docs = np.asarray(found[0])
+                tf = np.asarray(found[1], dtype=np.float32)
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * segment.doc_lens[docs] / avg_length)
+                if scores is None:
+                    scores = np.zeros(segment.size, dtype=np.float32)
+                # В постингах термина документ встречается один раз, поэтому += по индексам корректен
+                scores[docs] += idf[term_index] * tf * (BM25_K1 + 1) / (tf + norm)
+            if scores is None:
+                continue
+            scores[segment.deleted] = 0
+            top = min(k, int(np.count_nonzero(scores)))
+            if top == 0:
+                continue
+            best = np.argpartition(-scores, top - 1)[:top]
+            candidates += [(float(scores[local]), segment_index, int(local)) for local in best]
+
+        candidates.sort(reverse=True)
+        return [SearchHit(score, self.segments[segment_index].record(local)) for score, segment_index, local in candidates[:k]]
+
+    def index_jsonl(self, source: str, segment_docs: int = SEGMENT_DOCS, limit: Optional[int] = None,
+                    progress: Optional[Callable[[int], None]] = None) -> int:
+        """Индексирует ещё не прочитанную часть дампа; возвращает число добавленных записей.
+
+        Позиция в файле сохраняется после каждого сегмента, поэтому дописанный дамп
+        (или прерванная сборка) доиндексируется без повторного чтения начала файла.
+        """
+        source_key = os.path.abspath(source)
+        offset = self.meta["sources"].get(source_key, 0)
+        builder = _SegmentBuilder()
+        added = 0
+        with open(source, "rb") as source_file:
+            source_file.seek(offset)
+            for line in source_file:
+                if not line.endswith(b"\n"):
+                    break  # недописанная последняя строка — дочитаем в следующий раз
+                offset += len(line)
+                if not line.strip():
+                    continue
+                record = LiteratureRecord.from_arxiv(json.loads(line))
+                self._supersede(record.id)
+                builder.add(record)
+                added += 1
+                if len(builder) >= segment_docs:
+                    self._flush(builder, source_key, offset)
+                    builder = _SegmentBuilder()
+                    if progress is not None:
+                        progress(added)
+                if limit is not None and added >= limit:
+                    break
+        self._flush(builder, source_key, offset)
+        return added
+
+    def _supersede(self, doc_id: str) -> None:
+        for segment in self.segments:
+            local = segment.find(doc_id)
+            if local is not None:
+                segment.deleted[local] = True
+                segment.dirty = True
+                self.meta["num_docs"] -= 1
+                self.meta["total_length"] -= int(segment.doc_lens[local])
+
+    def _flush(self, builder: _SegmentBuilder, source_key: str, offset: int) -> None:
+        if len(builder):
+            name = f"segment_{len(self.meta['segments']):05d}"
+            builder.write(os.path.join(self.path, name))
+            live = len(builder) - len(builder.deleted)
+            lengths = np.frombuffer(builder.doc_lens, dtype=np.uint32).astype(np.int64)
+            self.meta["segments"].append(name)
+            self.meta["num_docs"] += live
+            self.meta["total_length"] += int(lengths.sum() - lengths[builder.deleted].sum())
+        for segment in self.segments:
+            if segment.dirty:
+                segment.save_deleted()
+                segment.dirty = False
+        self.meta["sources"][source_key] = offset
+        self._write_meta(self.path, self.meta)
+        if len(builder):
+            self.segments.append(_Segment(os.path.join(self.path, self.meta["segments"][-1])))
+
+    def disk_usage(self) -> Dict[str, int]:
+        """Размер индекса на диске: постинги/словарь отдельно от хранилища записей."""
+        usage = {"postings_bytes": 0, "docs_bytes": 0}
+        for segment in self.segments:
+            for name in os.listdir(segment.path):
+                size = os.path.getsize(os.path.join(segment.path, name))
+                usage["docs_bytes" if name in ("docs.jsonl", "doc_offsets.npy") else "postings_bytes"] += size
+        return usage
+
+
+@lru_cache(maxsize=None)
+def get_literature_index() -> Optional[LiteratureIndex]:
+    """Общий индекс процесса; None, если индекс ещё не собран."""
+    if not os.path.exists(os.path.join(LITERATURE_INDEX_PATH, META_FILE)):
+        return None
+    return LiteratureIndex(LITERATURE_INDEX_PATH)
+
+
+def literature_version() -> str:
+    """Версия индекса, из которого with_literature берёт контекст; "none", если индекса нет."""
+    index = get_literature_index()
+    return index.version if index is not None else "none"
+
+
+def format_literature(hits: Sequence[SearchHit], snippet_chars: int = LITERATURE_SNIPPET_CHARS) -> str:
+    if not hits:
+        return NO_SOURCES
+    lines = []
+    for number, hit in enumerate(hits, 1):
+        record = hit.record
+        snippet = record.abstract[:snippet_chars].rsplit(" ", 1)[0] + "…" if len(record.abstract) > snippet_chars else record.abstract
+        lines.append(f"[{number}] {record.title} ({record.authors}, {record.year}) {record.url}\n    {snippet}")
+    return "\n".join(lines)
+
+
+def literature_context(question: str, k: int = LITERATURE_TOP_K) -> str:
+    """Top-k записей индекса для вопроса в виде короткого блока для промпта."""
+    index = get_literature_index()
+    if index is None:
+        return NO_SOURCES
+    with get_tracer().span("retrieval") as span:
+        hits = index.search(question, k)
+        span["hits"] = len(hits)
+    return format_literature(hits)
+
+
+def with_literature(chain):
+    """Перед вызовом агента добавляет во вход поле literature с найденными записями."""
+    from langchain_core.runnables import RunnablePassthrough
+
+    return RunnablePassthrough.assign(literature=lambda inputs: literature_context(inputs["question"])) | chain
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный BM25-индекс метаданных arXiv")
+    parser.add_argument("command", choices=["build", "search"])
+    parser.add_argument("argument", help="build: JSONL-дамп метаданных arXiv; search: текст запроса")
+    parser.add_argument("--index", default=LITERATURE_INDEX_PATH)
+    parser.add_argument("--segment-docs", type=int, default=SEGMENT_DOCS)
+    parser.add_argument("--limit", type=int, help="Не больше N новых записей за запуск")
+    parser.add_argument("-k", type=int, default=LITERATURE_TOP_K)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        index = LiteratureIndex.open_or_create(args.index)
+        started = time.perf_counter()
+        added = index.index_jsonl(args.argument, args.segment_docs, args.limit,
+                                  progress=lambda count: print(f"  проиндексировано {count} записей"))
+        print(f"Добавлено {added} записей за {time.perf_counter() - started:.1f} с; всего в индексе {index.num_docs}")
+        print(json.dumps(index.disk_usage(), indent=2))
+    else:
+        index = LiteratureIndex(args.index)
+        started = time.perf_counter()
+        hits = index.search(args.argument, args.k)
+        print(f"{len(hits)} записей за {(time.perf_counter() - started) * 1000:.1f} мс")
+        for hit in hits:
+            print(f"{hit.score:6.2f}  {hit.record.id}  {hit.record.title} ({hit.record.year})")
+
+
+if __name__ == "__main__":
+    main()
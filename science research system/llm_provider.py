@@ -0,0 +1,147 @@
+# llm_provider.py
+"""Единый поставщик LLM-клиента и долгоживущего event loop.
+
+Все модули (AgentFactory, ReActCoordinator, multi_agent_answer) используют один
+ChatOpenAI с явно настроенным пулом keep-alive соединений httpx, а все async-вызовы
+выполняются в одном фоновом event loop, который переживает перезапуски скрипта Streamlit.
+Так соединения пула остаются пригодными между запросами пользователя.
+"""
+import asyncio
+import importlib.util
+import os
+import threading
+from typing import TYPE_CHECKING, Any, Coroutine, Dict, Optional, Tuple
+
+if TYPE_CHECKING:  # тяжёлые импорты откладываются до первого get_llm()
+    import httpx
+    from langchain_openai import ChatOpenAI
+
+# Модель
+MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "qwen3-32b")
+OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "sk-fhMGj3XMTsnLDUe__ClMLA")
+# Несколько реплик — через запятую: запросы балансируются между ними (endpoint_pool.py)
+OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "http://10.32.15.89:34000/v1")
+
+# Пул соединений
+POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "64"))
+POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "32"))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv("LLM_POOL_KEEPALIVE_EXPIRY", "120"))
+# "auto" — HTTP/2, если установлен пакет h2; "0"/"1" — принудительно
+HTTP2_MODE = os.getenv("LLM_HTTP2", "auto")
+# "1" — вызовы идут через общий планировщик (llm_scheduler.py), повторы делает он;
+# "0" — обычный ChatOpenAI со встроенными повторами SDK
+LLM_SCHEDULER = os.getenv("LLM_SCHEDULER", "1") == "1"
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+_clients: Dict[Tuple[str, str, str], "ChatOpenAI"] = {}
+_clients_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """Один event loop на процесс в фоновом daemon-потоке."""
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=_loop.run_forever, name="llm-event-loop", daemon=True)
+            thread.start()
+        return _loop
+
+
+def adopt_event_loop(loop: asyncio.AbstractEventLoop) -> None:
+    """Делает уже работающий loop общим (HTTP-сервис: loop aiohttp в главном потоке).
+
+    Вызывается до первого обращения к get_background_loop(), иначе клиенты и пул
+    соединений окажутся привязаны к другому loop.
+    """
+    global _loop
+    with _loop_lock:
+        if _loop is not None and not _loop.is_closed() and _loop is not loop:
+            raise RuntimeError("Shared event loop is already running; adopt_event_loop() must be called first")
+        _loop = loop
+
+
+def in_background_loop() -> bool:
+    """True в потоке общего loop: блокирующий run_sync там привёл бы к взаимоблокировке."""
+    try:
+        return asyncio.get_running_loop() is _loop
+    except RuntimeError:
+        return False
+
+
+def run_sync(coroutine: Coroutine[Any, Any, Any]) -> Any:
+    """Выполняет корутину в фоновом loop и ждёт результата (вместо asyncio.run)."""
+    return asyncio.run_coroutine_threadsafe(coroutine, get_background_loop()).result()
+
+
+def http2_enabled() -> bool:
+    if HTTP2_MODE == "auto":
+        return importlib.util.find_spec("h2") is not None
+    return HTTP2_MODE == "1"
+
+
+def _pool_limits() -> "httpx.Limits":
+    import httpx
+
+    return httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+    )
+
+
+def _http_clients(api_base: str, api_key: str) -> Tuple[str, "httpx.Client", "httpx.AsyncClient"]:
+    """httpx-клиенты для ChatOpenAI; несколько URL через запятую — пул реплик (endpoint_pool.py)."""
+    import httpx
+
+    http2 = http2_enabled()
+    timeout = httpx.Timeout(120.0, connect=10.0)
+    urls = [url.strip().rstrip("/") for url in api_base.split(",") if url.strip()]
+    if len(urls) == 1:
+        return (urls[0],
+                httpx.Client(limits=_pool_limits(), http2=http2, timeout=timeout),
+                httpx.AsyncClient(limits=_pool_limits(), http2=http2, timeout=timeout))
+
+    from endpoint_pool import PooledAsyncTransport, PooledSyncTransport, get_endpoint_pool
+
+    # Базовый URL клиента — первая реплика; транспорт переносит каждый запрос на выбранную
+    pool = get_endpoint_pool(tuple(urls), api_key)
+    sync_transport = PooledSyncTransport(pool, urls[0], httpx.HTTPTransport(limits=_pool_limits(), http2=http2))
+    async_transport = PooledAsyncTransport(pool, urls[0], httpx.AsyncHTTPTransport(limits=_pool_limits(), http2=http2))
+    return (urls[0],
+            httpx.Client(transport=sync_transport, timeout=timeout),
+            httpx.AsyncClient(transport=async_transport, timeout=timeout))
+
+
+def get_llm(model_name: Optional[str] = None, api_key: Optional[str] = None, api_base: Optional[str] = None) -> "ChatOpenAI":
+    """Общий ChatOpenAI для заданных настроек; повторные вызовы возвращают тот же клиент."""
+    from langchain_openai import ChatOpenAI
+    from tracing import get_callback_handler
+
+    key = (model_name or MODEL_NAME, api_key or OPENAI_API_KEY, api_base or OPENAI_API_BASE)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            api_base, http_client, http_async_client = _http_clients(key[2], key[1])
+            if LLM_SCHEDULER:
+                from llm_scheduler import get_scheduled_chat_model_class
+
+                # Повторы SDK отключены: их делает планировщик с бюджетом и учётом Retry-After
+                model_class, max_retries = get_scheduled_chat_model_class(), 0
+            else:
+                model_class, max_retries = ChatOpenAI, 3
+            client = model_class(
+                model=key[0],
+                openai_api_key=key[1],
+                openai_api_base=api_base,
+                temperature=0.1,
+                max_retries=max_retries,
+                # usage в потоковых ответах нужен трассировке (tracing.py) для подсчёта токенов
+                stream_usage=True,
+                callbacks=[get_callback_handler()],
+                http_client=http_client,
+                http_async_client=http_async_client,
+            )
+            _clients[key] = client
+        return client
@@ -0,0 +1,472 @@
+# llm_scheduler.py
+"""Общий планировщик запросов к LLM-эндпоинту: допуск, приоритеты, справедливость, повторы.
+
+Все вызовы модели (маршрутизатор, агенты, критик, планировщик DAG) проходят через один
+LLMScheduler в фоновом event loop:
+- token bucket по запросам/с и токенам/с (LLM_RATE_RPS, LLM_RATE_TPS; 0 — без ограничения);
+- классы приоритета: короткие служебные вызовы (router, critic, planner) обгоняют длинные
+  генерации агентов, пакетная обработка идёт последней;
+- внутри класса — круговая очередь по сессиям, одна сессия не занимает весь эндпоинт;
+- ограниченная очередь: при переполнении или долгом ожидании — SchedulerOverloaded сразу,
+  а не лавина запросов на эндпоинт;
+- число одновременных запросов адаптивное (AIMD): 429/503 урезают его вдвое, успехи
+  постепенно возвращают, поэтому очередь копится у нас, а не на перегруженном сервере;
+- повторы при 429/5xx с экспоненциальной задержкой и полным джиттером, с учётом Retry-After
+  и бюджетом повторов, чтобы они не умножали перегрузку.
+"""
+import asyncio
+import contextvars
+import os
+import random
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from enum import IntEnum
+from functools import lru_cache
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+from llm_provider import get_background_loop, in_background_loop, run_sync
+from streaming import on_run_cancel
+from tracing import get_tracer
+
+LLM_RATE_RPS = float(os.getenv("LLM_RATE_RPS", "0"))
+LLM_RATE_TPS = float(os.getenv("LLM_RATE_TPS", "0"))
+LLM_BURST_SECONDS = float(os.getenv("LLM_BURST_SECONDS", "2"))
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", "32"))
+LLM_MAX_QUEUE = int(os.getenv("LLM_MAX_QUEUE", "256"))
+LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "60"))
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "4"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_CAP = float(os.getenv("LLM_BACKOFF_CAP", "20"))
+# Доля повторов от успешных запросов, которую планировщик готов потратить
+LLM_RETRY_BUDGET_RATIO = float(os.getenv("LLM_RETRY_BUDGET_RATIO", "0.2"))
+
+# Оценка длины ответа, если max_tokens не задан: уточняется фактическим usage после вызова
+DEFAULT_COMPLETION_TOKENS = 512
+RETRYABLE_STATUSES = (429, 500, 502, 503, 504)
+OVERLOAD_STATUSES = (429, 503)
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0  # маршрутизатор, критик, планировщик: короткие и блокируют ответ
+    AGENT = 1        # генерации агентов
+    BATCH = 2        # пакетная обработка
+
+
+INTERACTIVE_STAGES = ("router", "critic", "planner")
+
+
+class SchedulerOverloaded(RuntimeError):
+    """Очередь к LLM переполнена или ожидание превысило LLM_QUEUE_TIMEOUT (backpressure)."""
+
+
+_session: contextvars.ContextVar[str] = contextvars.ContextVar("llm_session", default="default")
+_priority: contextvars.ContextVar[Optional[Priority]] = contextvars.ContextVar("llm_priority", default=None)
+
+
+@contextmanager
+def scheduling(session: Optional[str] = None, priority: Optional[Priority] = None) -> Iterator[None]:
+    """Помечает LLM-вызовы внутри блока сессией и/или приоритетом.
+
+    Контекст переносится в фоновый loop через run_sync/iterate_sync (run_coroutine_threadsafe
+    копирует contextvars вызывающего потока), поэтому блок можно открывать в скрипте Streamlit.
+    """
+    tokens = []
+    if session is not None:
+        tokens.append((_session, _session.set(session)))
+    if priority is not None:
+        tokens.append((_priority, _priority.set(priority)))
+    try:
+        yield
+    finally:
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def priority_for_stage(stage: Optional[str]) -> Priority:
+    override = _priority.get()
+    if override is not None:
+        return override
+    if stage and stage.startswith(INTERACTIVE_STAGES):
+        return Priority.INTERACTIVE
+    return Priority.AGENT
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst_seconds: float = LLM_BURST_SECONDS):
+        self.rate = rate
+        self.capacity = max(1.0, rate * burst_seconds)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Сколько ждать, пока в ведре наберётся amount (не больше ёмкости)."""
+        self._refill()
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+    def consume(self, amount: float) -> None:
+        self._refill()
+        # Уровень может уйти в минус: фактический расход сверх оценки задерживает следующие запросы
+        self.level -= amount
+
+
+@dataclass
+class Ticket:
+    priority: Priority
+    session: str
+    tokens: int
+    enqueued: float = field(default_factory=time.monotonic)
+    future: Optional[asyncio.Future] = None
+    granted: float = 0.0
+
+
+class LLMScheduler:
+    """Живёт в фоновом event loop; все методы, кроме *_threadsafe, вызываются из него."""
+
+    def __init__(self, rate_rps: float = LLM_RATE_RPS, rate_tps: float = LLM_RATE_TPS,
+                 max_in_flight: int = LLM_MAX_IN_FLIGHT, max_queue: int = LLM_MAX_QUEUE,
+                 queue_timeout: float = LLM_QUEUE_TIMEOUT, retry_budget_ratio: float = LLM_RETRY_BUDGET_RATIO):
+        self.requests = TokenBucket(rate_rps) if rate_rps > 0 else None
+        self.tokens = TokenBucket(rate_tps) if rate_tps > 0 else None
+        self.max_in_flight = max_in_flight
+        self.limit = float(max_in_flight)
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.queued = 0
+        self._queues: List["OrderedDict[str, Deque[Ticket]]"] = [OrderedDict() for _ in Priority]
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._last_decrease = 0.0
+        self.retry_budget_ratio = retry_budget_ratio
+        self.retry_credit = 10.0
+        self.stats = {"granted": 0, "rejected": 0, "timed_out": 0, "retries": 0, "overloads": 0}
+
+    # ---- допуск
+
+    async def acquire(self, priority: Priority, session: str, tokens: int) -> Ticket:
+        if self.queued >= self.max_queue:
+            self.stats["rejected"] += 1
+            raise SchedulerOverloaded(f"LLM queue is full ({self.queued} waiting)")
+        ticket = Ticket(priority, session, tokens, future=asyncio.get_running_loop().create_future())
+        self._queues[priority].setdefault(session, deque()).append(ticket)
+        self.queued += 1
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.future), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if self._remove(ticket):
+                self.stats["timed_out"] += 1
+                raise SchedulerOverloaded(f"LLM queue wait exceeded {self.queue_timeout:g} s") from None
+            # Допуск выдан в момент таймаута — пользуемся им
+        except asyncio.CancelledError:
+            if not self._remove(ticket):
+                self.release(ticket, ok=False)
+            raise
+        return ticket
+
+    def _remove(self, ticket: Ticket) -> bool:
+        sessions = self._queues[ticket.priority]
+        waiting = sessions.get(ticket.session)
+        if waiting is None or ticket not in waiting:
+            return False
+        waiting.remove(ticket)
+        if not waiting:
+            del sessions[ticket.session]
+        self.queued -= 1
+        return True
+
+    def _next(self) -> Optional[Ticket]:
+        """Первый ожидающий из старшего непустого класса; сессии внутри класса — по кругу."""
+        for sessions in self._queues:
+            if sessions:
+                return next(iter(sessions.values()))[0]
+        return None
+
+    def _dispatch(self) -> None:
+        while self.in_flight < int(self.limit):
+            ticket = self._next()
+            if ticket is None:
+                return
+            delay = max(
+                self.requests.delay(1) if self.requests else 0.0,
+                self.tokens.delay(ticket.tokens) if self.tokens else 0.0,
+            )
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+                return
+            sessions = self._queues[ticket.priority]
+            waiting = sessions[ticket.session]
+            waiting.popleft()
+            # Сессия уходит в конец круга, даже если у неё остались запросы
+            del sessions[ticket.session]
+            if waiting:
+                sessions[ticket.session] = waiting
+            self.queued -= 1
+            if self.requests:
+                self.requests.consume(1)
+            if self.tokens:
+                self.tokens.consume(ticket.tokens)
+            self.in_flight += 1
+            self.stats["granted"] += 1
+            ticket.granted = time.monotonic()
+            ticket.future.set_result(None)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    # ---- завершение и адаптация
+
+    def release(self, ticket: Ticket, actual_tokens: Optional[int] = None, overloaded: bool = False, ok: bool = True) -> None:
+        self.in_flight -= 1
+        if self.tokens is not None and actual_tokens is not None:
+            self.tokens.consume(actual_tokens - ticket.tokens)
+        if overloaded:
+            self.stats["overloads"] += 1
+            # Мультипликативное уменьшение раз на «окно»: 429 запросов, допущенных до прошлого
+            # урезания, — последствия того же всплеска и лимит повторно не уменьшают
+            if ticket.granted > self._last_decrease:
+                self.limit = max(1.0, self.limit / 2)
+                self._last_decrease = time.monotonic()
+        elif ok:
+            self.limit = min(float(self.max_in_flight), self.limit + 1.0 / self.limit)
+            self.retry_credit = min(10.0, self.retry_credit + self.retry_budget_ratio)
+        self._dispatch()
+
+    def release_threadsafe(self, ticket: Ticket, **kwargs: Any) -> None:
+        get_background_loop().call_soon_threadsafe(lambda: self.release(ticket, **kwargs))
+
+    def allow_retry(self) -> bool:
+        if self.retry_credit < 1.0:
+            return False
+        self.retry_credit -= 1.0
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        return dict(self.stats, in_flight=self.in_flight, queued=self.queued, concurrency_limit=round(self.limit, 1))
+
+
+@lru_cache(maxsize=None)
+def get_scheduler() -> LLMScheduler:
+    """Один планировщик на процесс: все сессии Streamlit делят эндпоинт через него."""
+    return LLMScheduler()
+
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None,
+                  base: float = LLM_BACKOFF_BASE, cap: float = LLM_BACKOFF_CAP) -> float:
+    """Экспоненциальная задержка с полным джиттером; Retry-After сервера — нижняя граница."""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    return max(delay, retry_after or 0.0)
+
+
+def _error_status(error: BaseException) -> Optional[int]:
+    status = getattr(error, "status_code", None)
+    if status is None:
+        response = getattr(error, "response", None)
+        status = getattr(response, "status_code", None)
+    return status
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        return min(float(value), LLM_BACKOFF_CAP) if value else None
+    except ValueError:
+        return None
+
+
+def _is_retryable(error: BaseException) -> bool:
+    if _error_status(error) in RETRYABLE_STATUSES:
+        return True
+    # Обрыв соединения/таймаут без HTTP-статуса (APIConnectionError, APITimeoutError, httpx.TransportError)
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError") or "Transport" in type(error).__name__
+
+
+def estimate_request_tokens(messages: List[Any], max_tokens: Optional[int]) -> int:
+    prompt_chars = sum(len(str(getattr(message, "content", ""))) for message in messages)
+    return prompt_chars // 4 + (max_tokens or DEFAULT_COMPLETION_TOKENS)
+
+
+def _usage_tokens(usage: Optional[Dict[str, Any]]) -> Optional[int]:
+    if not usage:
+        return None
+    return usage.get("total_tokens") or (usage.get("input_tokens", 0) + usage.get("output_tokens", 0)) or None
+
+
+class _Admission:
+    """Допуск одного логического вызова модели со всеми его повторами."""
+
+    def __init__(self, model: Any, messages: List[Any], run_manager: Any, kwargs: Dict[str, Any]):
+        metadata = getattr(run_manager, "metadata", None) or {}
+        self.stage = metadata.get("stage")
+        self.priority = priority_for_stage(self.stage)
+        self.session = _session.get()
+        self.tokens = estimate_request_tokens(messages, kwargs.get("max_tokens") or getattr(model, "max_tokens", None))
+        self.scheduler = get_scheduler()
+        self.ticket: Optional[Ticket] = None
+        self.attempt = 0
+        # Синхронный путь из потока самого общего loop ждать не может — там допуск не применяется
+        self.bypass = in_background_loop()
+
+    def _observe_wait(self) -> None:
+        if self.ticket is not None:
+            # Ожидание в очереди — отдельная стадия по классу приоритета: queue:interactive, queue:agent, queue:batch
+            get_tracer().observe(f"queue:{self.priority.name.lower()}", self.ticket.granted - self.ticket.enqueued,
+                                 llm_stage=self.stage, session=self.session)
+
+    async def acquire(self) -> None:
+        self.ticket = await self.scheduler.acquire(self.priority, self.session, self.tokens)
+        self._observe_wait()
+
+    def acquire_sync(self) -> None:
+        if not self.bypass:
+            self.ticket = run_sync(self.scheduler.acquire(self.priority, self.session, self.tokens))
+            self._observe_wait()
+
+    def _release(self, threadsafe: bool, **kwargs: Any) -> None:
+        ticket, self.ticket = self.ticket, None
+        if ticket is None:
+            return
+        if threadsafe:
+            self.scheduler.release_threadsafe(ticket, **kwargs)
+        else:
+            self.scheduler.release(ticket, **kwargs)
+
+    def succeeded(self, actual_tokens: Optional[int], threadsafe: bool = False) -> None:
+        self._release(threadsafe, actual_tokens=actual_tokens)
+
+    def abandon(self, threadsafe: bool = False) -> None:
+        """Вызов прерван (ранний выход из потока, отмена): место освобождается без адаптации."""
+        self._release(threadsafe, ok=False)
+
+    def retry_delay(self, error: BaseException, threadsafe: bool = False) -> float:
+        """Освобождает место и возвращает задержку перед повтором; если повторять нельзя — пробрасывает ошибку."""
+        overloaded = _error_status(error) in OVERLOAD_STATUSES
+        self._release(threadsafe, overloaded=overloaded, ok=False)
+        self.attempt += 1
+        if not _is_retryable(error) or self.attempt >= LLM_MAX_ATTEMPTS:
+            raise error
+        # Повтор после 429/503 и так сдерживается урезанным лимитом и Retry-After;
+        # бюджет повторов тратят только сбои сервера и обрывы соединения
+        if not overloaded:
+            allowed = (run_sync(_allow_retry(self.scheduler)) if threadsafe and not self.bypass
+                       else self.scheduler.allow_retry())
+            if not allowed:
+                raise error
+        self.scheduler.stats["retries"] += 1
+        return backoff_delay(self.attempt - 1, _retry_after(error))
+
+
+async def _allow_retry(scheduler: LLMScheduler) -> bool:
+    return scheduler.allow_retry()
+
+
+@lru_cache(maxsize=None)
+def get_scheduled_chat_model_class():
+    """ChatOpenAI, чьи вызовы проходят через общий планировщик (langchain импортируется лениво)."""
+    from langchain_openai import ChatOpenAI
+
+    class ScheduledChatOpenAI(ChatOpenAI):
+        # В каждом методе finally освобождает место при отмене, раннем выходе из потока
+        # (GeneratorExit) и ошибке после первых токенов; после успеха или повтора это no-op
+
+        async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+            admission = _Admission(self, messages, run_manager, kwargs)
+            try:
+                while True:
+                    await admission.acquire()
+                    try:
+                        result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                    except Exception as e:
+                        await asyncio.sleep(admission.retry_delay(e))
+                        continue
+                    admission.succeeded(_usage_tokens((result.llm_output or {}).get("token_usage")))
+                    return result
+            finally:
+                admission.abandon()
+
+        async def _astream(self, messages, stop=None, run_manager=None, **kwargs):
+            admission = _Admission(self, messages, run_manager, kwargs)
+            inner = None
+
+            async def abort() -> None:
+                # Отмена запуска застала поток на yield: закрываем HTTP-поток и освобождаем место
+                if inner is not None:
+                    try:
+                        await inner.aclose()
+                    except RuntimeError:
+                        pass  # поток исполняется — отмена дойдёт до него сама
+                admission.abandon()
+
+            remove_abort = on_run_cancel(abort)
+            try:
+                while True:
+                    await admission.acquire()
+                    emitted = False
+                    usage = None
+                    inner = super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs)
+                    try:
+                        async for chunk in inner:
+                            emitted = True
+                            usage = _usage_tokens(getattr(chunk.message, "usage_metadata", None)) or usage
+                            yield chunk
+                    except Exception as e:
+                        if emitted:
+                            raise  # часть ответа уже отдана — повтор продублировал бы токены
+                        await asyncio.sleep(admission.retry_delay(e))
+                        continue
+                    finally:
+                        await inner.aclose()
+                    admission.succeeded(usage)
+                    return
+            finally:
+                remove_abort()
+                admission.abandon()
+
+        def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+            admission = _Admission(self, messages, run_manager, kwargs)
+            try:
+                while True:
+                    admission.acquire_sync()
+                    try:
+                        result = super()._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+                    except Exception as e:
+                        time.sleep(admission.retry_delay(e, threadsafe=True))
+                        continue
+                    admission.succeeded(_usage_tokens((result.llm_output or {}).get("token_usage")), threadsafe=True)
+                    return result
+            finally:
+                admission.abandon(threadsafe=True)
+
+        def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+            admission = _Admission(self, messages, run_manager, kwargs)
+            try:
+                while True:
+                    admission.acquire_sync()
+                    emitted = False
+                    usage = None
+                    try:
+                        for chunk in super()._stream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                            emitted = True
+                            usage = _usage_tokens(getattr(chunk.message, "usage_metadata", None)) or usage
+                            yield chunk
+                    except Exception as e:
+                        if emitted:
+                            raise
+                        time.sleep(admission.retry_delay(e, threadsafe=True))
+                        continue
+                    admission.succeeded(usage, threadsafe=True)
+                    return
+            finally:
+                admission.abandon(threadsafe=True)
+
+    return ScheduledChatOpenAI
@@ -1,110 +1,449 @@
 import os
-from typing_extensions import TypedDict
-from langgraph.graph import StateGraph, START, END
-from langchain_core.messages import SystemMessage, HumanMessage
-from langchain_openai import ChatOpenAI
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
-from pydantic import BaseModel, Field
+import asyncio
 import json
+from functools import lru_cache
+from typing import Any, AsyncIterator, Dict, List, Optional
+from pydantic import BaseModel, Field
+from agent_factory import AgentType
+from keyword_router import get_keyword_router, is_composite
+from streaming import StreamEvent
+from batching import BatchResult, acquire_many, merge_as_completed, split_concurrency
+from llm_provider import MODEL_NAME, run_sync
+from tracing import agent_stage, get_tracer, stage_config
+from streaming_router import ROUTER_LABELS, ROUTER_MODE, match_agent_label
+from code_sandbox import averify_code
+from llm_scheduler import Priority, scheduling
+from session_memory import MemoryContext, amemory_context, aremember_turn, memory_context, remember_turn
+
+# Клиенты, цепочки и тяжёлые зависимости (langchain_openai, langgraph, numpy)
+# создаются лениво при первом обращении через get_* функции ниже.
 
-# Модель
-MODEL_NAME = os.getenv("OPENAI_MODEL_NAME", "qwen3-32b")
-OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "sk-fhMGj3XMTsnLDUe__ClMLA")
-OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "http://10.32.15.89:34000/v1")
-
-llm = ChatOpenAI(
-    model=MODEL_NAME,
-    openai_api_key=OPENAI_API_KEY,
-    openai_api_base=OPENAI_API_BASE,
-    temperature=0.1,
-    max_retries=3
-)
-
-# Промпты и цепочки
-science_research_prompt = ChatPromptTemplate.from_messages([
-    ("system", "You are a scientific research assistant. Your task is to find relevant research articles on a given topic and provide summaries and links."),
-    ("human", "Topic: {question}\n\nProvide a structured research summary with relevant article links.")
-])
-
-code_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", "You are a helpful AI coding assistant. You can use tools to help you. Write a code correctly. Test your code and give workable code."),
-        ("human", "Question: {question}\nIf there is no code to write, say this is not a code writing question."),
-    ]
-)
-
-writing_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", "You are a **writing assistant**. Explain things clearly or rewrite text in a more understandable way."),
-        ("human", "User request: {question}\nExplain, rephrase or elaborate in a strict and correct way."),
-    ]
-)
-
-router_prompt = ChatPromptTemplate.from_messages(
-    [
-        ("system", "You are a router between three agents: 'science reasearch', 'coding' and 'writing'. Decide which agent is more suitable for the user question.\n- Use 'science reasearch' if there are names of science litrature, research themes\n- Use 'coding' for writing code.\n- Use 'writing' for explanations, rewriting, conceptual questions.\n\nRespond with a JSON object containing 'next_agent' (either 'science reaserch', 'coding' or 'writing') and 'reason' (a short explanation)."),
-        ("human", "User question: {question}\n\nRespond in JSON format: {{\"next_agent\": \"science research\" or \"coding\" or \"writing\", \"reason\": \"explanation\"}}"),
-    ]
-)
-science_research_agent = science_research_prompt | llm | StrOutputParser()
-code_agent = code_prompt | llm | StrOutputParser()
-writing_agent = writing_prompt | llm | StrOutputParser()
 
 class RoutingDecision(BaseModel):
     """LLM output schema for router."""
     next_agent: str = Field(
-        description="Which agent should answer: 'science reserch','coding' or 'writer'."
+        description="Which agent should answer: 'science research', 'coding' or 'writing'."
     )
     reason: str = Field(description="Short explanation of the decision.")
 
 
-json_parser = JsonOutputParser(pydantic_object=RoutingDecision)
-router_chain = router_prompt | llm | json_parser
+# Display names of agents in logs
+AGENT_DISPLAY_NAMES = {
+    AgentType.RESEARCH: "SCIENCE RESEARCH",
+    AgentType.CODING: "CODER",
+    AgentType.WRITING: "WRITING",
+}
+
+
+@lru_cache(maxsize=None)
+def get_llm_client():
+    """Модель: общий клиент с пулом соединений (см. llm_provider.py)."""
+    from llm_provider import get_llm
+    return get_llm()
+
+
+@lru_cache(maxsize=None)
+def get_prompts() -> Dict[str, Any]:
+    """Промпты агентов и маршрутизатора."""
+    from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+
+    # Session history (session_memory.py) sits between the system prompt and the question,
+    # so the system prompt + summary prefix stays byte-identical across turns
+    history = MessagesPlaceholder("history", optional=True)
+
+    science_research_prompt = ChatPromptTemplate.from_messages([
+        ("system", "You are a scientific research assistant. Your task is to find relevant research articles on a given topic and provide summaries and links."),
+        history,
+        ("human", "Topic: {question}\n\nSources from the local arXiv index:\n{literature}\n\nProvide a structured research summary. Cite only the sources listed above, by number [n] with their arXiv link.")
+    ])
+
+    code_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", "You are a helpful AI coding assistant. You can use tools to help you. Write a code correctly. Test your code and give workable code."),
+            history,
+            ("human", "Question: {question}\nIf there is no code to write, say this is not a code writing question."),
+        ]
+    )
+
+    writing_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", "You are a **writing assistant**. Explain things clearly or rewrite text in a more understandable way."),
+            history,
+            ("human", "User request: {question}\nExplain, rephrase or elaborate in a strict and correct way."),
+        ]
+    )
+
+    router_prompt = ChatPromptTemplate.from_messages(
+        [
+            ("system", "You are a router between three agents: 'science research', 'coding' and 'writing'. Decide which agent is more suitable for the user question.\n- Use 'science research' if there are names of science literature, research themes\n- Use 'coding' for writing code.\n- Use 'writing' for explanations, rewriting, conceptual questions.\n\nRespond with a JSON object containing 'next_agent' (either 'science research', 'coding' or 'writing') and 'reason' (a short explanation)."),
+            ("human", "User question: {question}\n\nRespond in JSON format: {{\"next_agent\": \"science research\" or \"coding\" or \"writing\", \"reason\": \"explanation\"}}"),
+        ]
+    )
+    return {
+        "science_research": science_research_prompt,
+        "code": code_prompt,
+        "writing": writing_prompt,
+        "router": router_prompt,
+    }
+
+
+@lru_cache(maxsize=None)
+def get_response_cache():
+    """Кэш ответов (LRU в памяти + SQLite), отключается RESPONSE_CACHE_ENABLED=0."""
+    from response_cache import cache_from_env
+    return cache_from_env()
+
+
+@lru_cache(maxsize=None)
+def get_agents() -> Dict[AgentType, Any]:
+    """Цепочки специализированных агентов."""
+    from literature_index import literature_version, with_literature
+    from response_cache import cached
+    from thinking import ThinkFilter, with_thinking
+
+    llm = get_llm_client()
+    prompts = get_prompts()
+    cache = get_response_cache()
+
+    # Each agent gets its thinking policy (thinking.py); <think> blocks are stripped from the stream
+    def chain(prompt, agent_type: AgentType):
+        return prompt | with_thinking(llm, agent_type.value) | ThinkFilter()
+
+    # The research agent is grounded on top-k records of the local arXiv index (literature_index.py)
+    research_chain = with_literature(chain(prompts["science_research"], AgentType.RESEARCH))
+    return {
+        AgentType.RESEARCH: cached(research_chain, cache, "science research", prompts["science_research"], MODEL_NAME,
+                                   literature_version),
+        AgentType.CODING: cached(chain(prompts["code"], AgentType.CODING), cache, "coding", prompts["code"], MODEL_NAME),
+        AgentType.WRITING: cached(chain(prompts["writing"], AgentType.WRITING), cache, "writing", prompts["writing"], MODEL_NAME),
+    }
+
 
-def multi_agent_answer(question: str, verbose: bool = True, log_callback=None) -> str:
-    """Top-level function: router -> specialized agent."""
+@lru_cache(maxsize=None)
+def get_router_chain():
+    from langchain_core.output_parsers import JsonOutputParser
+    from langchain_core.runnables import RunnableLambda
+    from response_cache import cached
+    from thinking import ThinkFilter, with_thinking
+
+    router_prompt = get_prompts()["router"]
+    json_parser = JsonOutputParser(pydantic_object=RoutingDecision)
+    # The router answers without reasoning; stray <think> blocks never reach the JSON parser
+    chain = router_prompt | with_thinking(get_llm_client(), "router") | ThinkFilter() | json_parser
+
+    async def decide(inputs: Dict[str, Any], config) -> Dict[str, Any]:
+        # Runs only on a cache miss, so cached answers are not logged as new training samples
+        decision = await chain.ainvoke(inputs, config)
+        await _alog_routing_decision(inputs["question"], decision)
+        return decision
+
+    return cached(RunnableLambda(decide), get_response_cache(), "router", router_prompt, MODEL_NAME)
+
+
+@lru_cache(maxsize=None)
+def get_streaming_router():
+    """Router that stops generation as soon as next_agent is decoded (ROUTER_MODE=stream)."""
+    from streaming_router import StreamingRouter
+    from thinking import with_thinking
+    return StreamingRouter(with_thinking(get_llm_client(), "router"), get_prompts()["router"], get_response_cache(), MODEL_NAME,
+                           on_decision=_alog_routing_decision)
+
+
+@lru_cache(maxsize=None)
+def get_task_graph_runner():
+    """Composite queries (research + code) are decomposed into a DAG and run as a LangGraph StateGraph."""
+    from task_graph import TaskGraphRunner
+    return TaskGraphRunner(get_agents(), get_llm_client())
+
+
+@lru_cache(maxsize=None)
+def get_learned_router():
+    """Локальный маршрутизатор (обучается командой `python learned_router.py train`)."""
+    from learned_router import load_learned_router
+    return load_learned_router()
+
+
+# Обратная совместимость: прежние модульные объекты доступны как атрибуты и создаются при первом обращении
+_LAZY_ATTRIBUTES = {
+    "llm": get_llm_client,
+    "science_research_prompt": lambda: get_prompts()["science_research"],
+    "code_prompt": lambda: get_prompts()["code"],
+    "writing_prompt": lambda: get_prompts()["writing"],
+    "router_prompt": lambda: get_prompts()["router"],
+    "response_cache": get_response_cache,
+    "science_research_agent": lambda: get_agents()[AgentType.RESEARCH],
+    "code_agent": lambda: get_agents()[AgentType.CODING],
+    "writing_agent": lambda: get_agents()[AgentType.WRITING],
+    "router_chain": get_router_chain,
+    "streaming_router": get_streaming_router,
+    "task_graph_runner": get_task_graph_runner,
+    "learned_router": get_learned_router,
+}
+
+
+def __getattr__(name: str):
+    factory = _LAZY_ATTRIBUTES.get(name)
+    if factory is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    return factory()
+
+
+def _local_decision(question: str):
+    """Решение локального маршрутизатора, если он уверен; иначе None."""
+    router = get_learned_router()
+    if router is None:
+        return None
+    from learned_router import LEARNED_ROUTER_THRESHOLD
+    local_decision = router.predict(question)
+    if local_decision.confidence >= LEARNED_ROUTER_THRESHOLD:
+        return RoutingDecision(
+            next_agent=ROUTER_LABELS[local_decision.agent],
+            reason=f"Local router (confidence {local_decision.confidence:.2f})"
+        )
+    return None
+
+
+def _parse_router_output(decision_dict) -> RoutingDecision:
+    # Convert dict to RoutingDecision object if needed
+    with get_tracer().span("parsing"):
+        if isinstance(decision_dict, dict):
+            return RoutingDecision(**decision_dict)
+        return decision_dict
+
+
+async def _alog_routing_decision(question: str, decision: Dict[str, Any]) -> None:
+    """Appends a fresh LLM routing decision to the learned router's training log (file I/O off the loop)."""
+    next_agent = decision.get("next_agent", "") if isinstance(decision, dict) else ""
+    if match_agent_label(next_agent) is None:
+        return  # an unrecognized label would only teach the learned router noise
+    from learned_router import alog_routing_decision
+    await alog_routing_decision(question, next_agent, decision.get("reason", ""))
+
+
+def _fallback_decision(question: str, error: Exception, log) -> RoutingDecision:
+    # Fallback: if parsing fails, try to extract agent from raw response
+    log(f"[Router] Error parsing decision: {error}")
+    log("[Router] Using fallback: checking if question contains science research keywords...")
+    # Keyword-based fallback: one pass over the question with the shared automaton
+    keyword_decision = get_keyword_router().route(question)
+    return RoutingDecision(
+        next_agent=ROUTER_LABELS[keyword_decision.agent],
+        reason=f"Fallback: keywords {keyword_decision.matched} (confidence {keyword_decision.confidence:.2f})"
+    )
+
+
+async def _allm_decision(question: str) -> RoutingDecision:
+    """LLM router: streaming parse with early exit, or the full JSON reply with ROUTER_MODE=json.
+
+    The reply is a few tokens, so with several endpoints the request is hedged on a second replica.
+    """
+    from endpoint_pool import hedging
+
+    with hedging():
+        if ROUTER_MODE == "json":
+            return _parse_router_output(await get_router_chain().ainvoke({"question": question}, stage_config("router")))
+        return _parse_router_output(await get_streaming_router().aroute(question, stage_config("router")))
+
+
+def route_question(question: str, log) -> RoutingDecision:
+    """Router stage: local model -> LLM router -> keyword fallback."""
+    with get_tracer().span("routing") as span:
+        decision = _local_decision(question)
+        span["router"] = "local"
+        if decision is None:
+            span["router"] = "llm"
+            try:
+                decision = run_sync(_allm_decision(question))
+            except Exception as e:
+                span["router"] = "keywords"
+                decision = _fallback_decision(question, e, log)
+        span["next_agent"] = decision.next_agent
+
+    log(f"[Router] next_agent = {decision.next_agent!r}")
+    log(f"[Router] reason    = {decision.reason}\\n")
+    return decision
+
+
+async def aroute_question(question: str, log) -> RoutingDecision:
+    """Async version of route_question."""
+    with get_tracer().span("routing") as span:
+        decision = _local_decision(question)
+        span["router"] = "local"
+        if decision is None:
+            span["router"] = "llm"
+            try:
+                decision = await _allm_decision(question)
+            except Exception as e:
+                span["router"] = "keywords"
+                decision = _fallback_decision(question, e, log)
+        span["next_agent"] = decision.next_agent
+
+    log(f"[Router] next_agent = {decision.next_agent!r}")
+    log(f"[Router] reason    = {decision.reason}\\n")
+    return decision
+
+
+def select_agent(decision: RoutingDecision):
+    """Returns (agent chain, agent display name, tracing stage) for a routing decision."""
+    agent_type = match_agent_label(decision.next_agent) or AgentType.WRITING
+    return get_agents()[agent_type], AGENT_DISPLAY_NAMES[agent_type], agent_stage(agent_type)
+
+
+async def _sandbox_logs(agent_name: str, answer: str) -> List[str]:
+    """Runs Python blocks of a coder answer in the sandbox and returns log lines with the outcome."""
+    if agent_name != AGENT_DISPLAY_NAMES[AgentType.CODING]:
+        return []
+    report = await averify_code(answer)
+    if report is None:
+        return []
+    return [f"[Sandbox] {report.summary()}"] + [f"[Sandbox] issue: {issue}" for issue in report.issues]
+
+
+def _history(memory: Optional[MemoryContext], log) -> List[Any]:
+    """Session history messages (session_memory.py); empty without a session or its history."""
+    if memory is None:
+        return []
+    log(f"[Memory] {memory.describe()}")
+    return memory.messages
+
+
+def _agent_input(question: str, history: List[Any]) -> Dict[str, Any]:
+    return {"question": question, "history": history} if history else {"question": question}
+
+
+def multi_agent_answer(question: str, verbose: bool = True, log_callback=None, session_id: Optional[str] = None) -> str:
+    """Top-level function: router -> specialized agent.
+
+    With session_id the agent sees the conversation so far and the answer is remembered.
+    """
     def log(message):
         if log_callback is not None:
             log_callback(message)
         elif verbose:
             print(message)
 
-    try:
-        decision_dict = router_chain.invoke({"question": question})
-        # Convert dict to RoutingDecision object if needed
-        if isinstance(decision_dict, dict):
-            decision = RoutingDecision(**decision_dict)
-        else:
-            decision = decision_dict
-    except Exception as e:
-        # Fallback: if parsing fails, try to extract agent from raw response
-        log(f"[Router] Error parsing decision: {e}")
-        log("[Router] Using fallback: checking if question contains science research keywords...")
-        # Simple keyword-based fallback
-        science_keywords = [ "science", "research", "search", "science research"]
-        coding_keywords = ["a code", "Python", "C++", "C#", "coding", "programme"]
-        if any(keyword in question.lower() for keyword in science_keywords):
-            decision = RoutingDecision(next_agent="science research", reason="Fallback: detected science litrature keywords")
-        elif any(keyword in question.lower() for keyword in coding_keywords):
-            decision = RoutingDecision(next_agent="coding", reason="Fallback: default to coding agent")
-        else:
-            decision = RoutingDecision(next_agent="writing", reason="Fallback: default to writing agent")
-    
-    log(f"[Router] next_agent = {decision.next_agent!r}")
-    log(f"[Router] reason    = {decision.reason}\\n")
-
-    if decision.next_agent.lower().strip() == "science research":
-        answer = science_research_agent.invoke({"question": question})
-        agent_name = "SCIENCE RESEARCH"
+    history = _history(memory_context(session_id), log)
+    if is_composite(question):
+        log("[Router] composite query -> task graph")
+        answer = run_sync(get_task_graph_runner().arun(question, log, history))["answer"]
+        log("[TASK GRAPH ANSWER]")
+        log(answer)
+        remember_turn(session_id, question, answer)
+        return answer
 
-    elif decision.next_agent.lower().strip() == 'coding':
-        answer = code_agent.invoke({"question": question})
-        agent_name = "CODER"
-    else:
-        answer = writing_agent.invoke({"question": question})
-        agent_name = "WRITING"
+    decision = route_question(question, log)
+    agent, agent_name, stage = select_agent(decision)
+    with get_tracer().span(stage):
+        answer = agent.invoke(_agent_input(question, history), stage_config(stage))
+    remember_turn(session_id, question, answer)
 
     log(f"[{agent_name} AGENT ANSWER]")
     log(answer)
-    return answer
\ No newline at end of file
+    for message in run_sync(_sandbox_logs(agent_name, answer)):
+        log(message)
+    return answer
+
+
+async def astream_multi_agent_answer(question: str, session_id: Optional[str] = None) -> AsyncIterator[StreamEvent]:
+    """Streaming version of multi_agent_answer: router logs and answer tokens as they arrive.
+
+    Yields StreamEvent("log", ...) for router/agent logs, StreamEvent("token", ...) for answer
+    chunks and finally StreamEvent("answer", full_answer).
+    """
+    logs = []
+    # Session memory lives in SQLite shared by service workers: reads and writes go through a thread
+    history = _history(await amemory_context(session_id), logs.append)
+    if is_composite(question):
+        logs.append("[Router] composite query -> task graph")
+        result = await get_task_graph_runner().arun(question, logs.append, history)
+        for message in logs:
+            yield StreamEvent("log", message)
+        yield StreamEvent("log", "[TASK GRAPH ANSWER]")
+        yield StreamEvent("token", result["answer"])
+        await aremember_turn(session_id, question, result["answer"])
+        yield StreamEvent("answer", result["answer"])
+        return
+
+    decision = await aroute_question(question, logs.append)
+    for message in logs:
+        yield StreamEvent("log", message)
+
+    agent, agent_name, stage = select_agent(decision)
+    yield StreamEvent("log", f"[{agent_name} AGENT ANSWER]")
+    chunks = []
+    with get_tracer().span(stage, streaming=True):
+        stream = agent.astream(_agent_input(question, history), stage_config(stage))
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield StreamEvent("token", chunk)
+        finally:
+            # Cancellation or an abandoned consumer closes the model stream and aborts the HTTP request
+            await stream.aclose()
+    answer = "".join(chunks)
+    await aremember_turn(session_id, question, answer)
+    for message in await _sandbox_logs(agent_name, answer):
+        yield StreamEvent("log", message)
+    yield StreamEvent("answer", answer)
+
+
+async def astream_multi_agent_answer_batch(questions: List[str], max_concurrency: int = 8) -> AsyncIterator[BatchResult]:
+    """Batch version of multi_agent_answer: yields BatchResult items as soon as they complete.
+
+    All questions are routed first, then grouped by agent: each agent chain answers its
+    whole group with one abatch_as_completed call. One semaphore bounds the number of
+    in-flight LLM requests: routing takes a slot per question, each group holds its share
+    of max_concurrency (split_concurrency) while its batch runs. The LLM scheduler serves
+    batch calls after interactive ones.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def route(index: int, question: str):
+        async with semaphore:
+            try:
+                with scheduling(priority=Priority.BATCH):
+                    return index, await aroute_question(question, lambda message: None)
+            except Exception as e:
+                return index, e
+
+    groups: Dict[str, List[int]] = {}
+    agents_by_name: Dict[str, Any] = {}
+    for index, decision in await asyncio.gather(*(route(i, q) for i, q in enumerate(questions))):
+        if isinstance(decision, Exception):
+            yield BatchResult(index=index, question=questions[index], error=f"Routing failed: {decision}")
+            continue
+        agent, agent_name, stage = select_agent(decision)
+        agents_by_name[agent_name] = (agent, stage)
+        groups.setdefault(agent_name, []).append(index)
+
+    async def run_group(agent_name: str, indices: List[int], quota: int) -> AsyncIterator[BatchResult]:
+        agent, stage = agents_by_name[agent_name]
+        inputs = [{"question": questions[i]} for i in indices]
+        config = dict(stage_config(stage), max_concurrency=quota)
+        async with acquire_many(semaphore, quota):
+            with scheduling(priority=Priority.BATCH), get_tracer().span(stage, batch=True, size=len(indices)):
+                answers = agent.abatch_as_completed(inputs, config, return_exceptions=True)
+                async for position, answer in answers:
+                    index = indices[position]
+                    if isinstance(answer, Exception):
+                        yield BatchResult(index=index, question=questions[index], agent=agent_name, error=str(answer))
+                    else:
+                        yield BatchResult(index=index, question=questions[index], agent=agent_name, answer=answer)
+
+    quotas = split_concurrency([len(indices) for indices in groups.values()], max_concurrency)
+    streams = [run_group(name, indices, quota) for (name, indices), quota in zip(groups.items(), quotas)]
+    async for result in merge_as_completed(streams):
+        yield result
+
+
+async def amulti_agent_answer_batch(questions: List[str], max_concurrency: int = 8) -> List[BatchResult]:
+    """Runs the whole batch and returns results in input order."""
+    results = [None] * len(questions)
+    async for result in astream_multi_agent_answer_batch(questions, max_concurrency=max_concurrency):
+        results[result.index] = result
+    return results
+
+
+def multi_agent_answer_batch(questions: List[str], max_concurrency: int = 8) -> List[BatchResult]:
+    """Blocking batch entry point; results keep the order of `questions`."""
+    return run_sync(amulti_agent_answer_batch(questions, max_concurrency=max_concurrency))
@@ -1,9 +1,40 @@
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, AsyncIterator, Optional
 from enum import Enum
 from pydantic import BaseModel, Field
-from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
 import json
+import asyncio
+import time
+from keyword_router import get_keyword_router, is_composite
+from streaming import StreamEvent
+from batching import BatchResult, acquire_many, split_concurrency
+from tracing import agent_stage, get_tracer, stage_config
+from code_sandbox import averify_code
+from llm_scheduler import Priority, scheduling
+from session_memory import amemory_context, aremember_turn
+
+# Сообщения промпта критика; сам ChatPromptTemplate собирается в конструкторе координатора,
+# чтобы импорт модуля не тянул langchain
+CRITIC_MESSAGES = [
+    ("system", """Ты - строгий рецензент ответов ассистента.
+    Оцени, насколько ответ решает запрос пользователя: полнота, корректность, структура.
+    Верни только JSON: {{"score": число от 0 до 1, "issues": ["конкретное замечание", ...]}}.
+    Если замечаний нет, верни пустой список issues."""),
+    ("human", "Запрос: {question}\n\nОтвет:\n{answer}")
+]
+
+# Сколько символов ответа видит критик: оценка должна оставаться дешёвой
+CRITIC_MAX_ANSWER_CHARS = 6000
+CRITIC_MAX_TOKENS = 256
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (≈4 символа на токен) для учёта бюджета"""
+    return max(1, len(text) // 4) if text else 0
+
+
+class BudgetExceeded(Exception):
+    """Исчерпан бюджет запроса по токенам или времени"""
+
 
 class AgentType(str, Enum):
     RESEARCH = "research"
@@ -28,80 +59,359 @@ class ReActState(BaseModel):
     is_complete: bool = False
     final_answer: Optional[str] = None
     reasoning_chain: List[str] = Field(default_factory=list)
+    tokens_used: int = 0
+    elapsed_seconds: float = 0.0
+    stop_reason: Optional[str] = None
+    # Память диалога (session_memory.py): сессия и размер истории в промпте агента
+    session_id: Optional[str] = None
+    context_tokens: int = 0
 
 class ReActCoordinator:
-    def __init__(self, llm_client, agents_dict: Dict[AgentType, Any]):
+    def __init__(self, llm_client, agents_dict: Dict[AgentType, Any],
+                 quality_threshold: float = 0.8,
+                 max_tokens_per_query: Optional[int] = None,
+                 max_seconds_per_query: Optional[float] = None):
         self.llm = llm_client
         self.agents = agents_dict
         self.max_iterations = 5
+        self.quality_threshold = quality_threshold
+        self.max_tokens_per_query = max_tokens_per_query
+        self.max_seconds_per_query = max_seconds_per_query
+        from langchain_core.prompts import ChatPromptTemplate
+        from langchain_core.output_parsers import JsonOutputParser
+        from thinking import ThinkFilter, with_thinking
         
-    def analyze_and_choose_agent(self, query: str) -> AgentType:
-        """Анализирует запрос и выбирает подходящего агента"""
-        query_lower = query.lower()
+        # Критик отвечает без рассуждений: иначе они съели бы CRITIC_MAX_TOKENS
+        critic_llm = with_thinking(self.llm, "critic").bind(max_tokens=CRITIC_MAX_TOKENS)
+        self.critic_chain = ChatPromptTemplate.from_messages(CRITIC_MESSAGES) | critic_llm | ThinkFilter() | JsonOutputParser()
+        self._task_graph = None
         
-        # Ключевые слова для каждого агента
-        research_keywords = ['research', 'статья', 'статьи', 'научн', 'arxiv', 'исследован', 'обзор', 'анализ', 'science', 'research']
-        coding_keywords = ['код', 'програм', 'алгоритм', 'python', 'java', 'c++', 'функция', 'библиотека', 'импорт']
+    @property
+    def task_graph(self):
+        """Исполнитель DAG подзадач; langgraph импортируется только при первом составном запросе"""
+        if self._task_graph is None:
+            from task_graph import TaskGraphRunner
+            self._task_graph = TaskGraphRunner(self.agents, self.llm)
+        return self._task_graph
         
-        # Проверяем наличие ключевых слов
-        if any(keyword in query_lower for keyword in research_keywords):
-            return AgentType.RESEARCH
-        elif any(keyword in query_lower for keyword in coding_keywords):
-            return AgentType.CODING
-        else:
-            return AgentType.WRITING
+    def analyze_and_choose_agent(self, query: str) -> AgentType:
+        """Анализирует запрос и выбирает подходящего агента"""
+        decision = get_keyword_router().route(query)
+        return AgentType(decision.agent.value)
+    
+    async def critique(self, query: str, answer: str, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """Дешёвая оценка ответа критиком: {"score": float, "issues": [str]}"""
+        inputs = {"question": query, "answer": answer[:CRITIC_MAX_ANSWER_CHARS]}
+        with get_tracer().span("critic"):
+            result = await asyncio.wait_for(self.critic_chain.ainvoke(inputs, stage_config("critic")), timeout)
+        score = min(max(float(result.get("score", 0.0)), 0.0), 1.0)
+        issues = [str(issue) for issue in result.get("issues", []) if str(issue).strip()]
+        return {"score": score, "issues": issues}
     
-    async def run_react_loop(self, query: str) -> ReActState:
+    @staticmethod
+    def build_refine_query(query: str, answer: str, issues: List[str]) -> str:
+        """Повторный запрос несёт отклонённый ответ (та же часть, что видел критик) и замечания,
+        а не всю историю итераций"""
+        excerpt = answer[:CRITIC_MAX_ANSWER_CHARS]
+        if len(answer) > CRITIC_MAX_ANSWER_CHARS:
+            excerpt += "\n[…ответ обрезан…]"
+        deltas = "\n".join(f"- {issue}" for issue in issues)
+        return (
+            f"{query}\n\nПредыдущая версия ответа была отклонена:\n<<<\n{excerpt}\n>>>\n\n"
+            f"Исправь в ней замечания:\n{deltas}"
+        )
+    
+    async def run_react_loop(self, query: str, session_id: Optional[str] = None, first_answer: Any = None) -> ReActState:
         """Основной ReAct Loop с выбором агента"""
+        state = None
+        async for event in self.stream_react_loop(query, session_id, first_answer=first_answer):
+            if event.type == "state":
+                state = event.payload
+        return state
+    
+    async def stream_react_loop(self, query: str, session_id: Optional[str] = None,
+                                first_answer: Any = None) -> AsyncIterator[StreamEvent]:
+        """ReAct Loop в потоковом режиме: шаги рассуждений и токены ответа по мере генерации,
+        последним событием идёт "state" с итоговым ReActState.
+        
+        С session_id агент видит историю сессии, а ответ запоминается для следующих запросов.
+        first_answer — уже полученный ответ агента на первой итерации (или его исключение):
+        iter_batch запрашивает первые итерации пакетом по группам агентов"""
+        started = time.monotonic()
+        deadline = started + self.max_seconds_per_query if self.max_seconds_per_query else None
         
         # 1. Анализируем запрос и выбираем агента
-        selected_agent = self.analyze_and_choose_agent(query)
+        with get_tracer().span("routing", router="keywords") as span:
+            selected_agent = self.analyze_and_choose_agent(query)
+            span["next_agent"] = selected_agent.value
         
         # 2. Создаем состояние с выбранным агентом
         state = ReActState(
             original_query=query,
             current_query=query,
             selected_agent=selected_agent,  
-            current_iteration=1,
+            current_iteration=0,
             max_iterations=self.max_iterations,
-            is_complete=True,
             final_answer=f"Ответ от агента {selected_agent.value} на запрос: {query}\n\nВыбран агент: {selected_agent.value}",
             reasoning_chain=[
                 f"Шаг 1: Анализ запроса: '{query[:100]}...'",
                 f"Шаг 2: Выбор агента: {selected_agent.value}",
-                "Шаг 3: Выполнение запроса агентом", 
-                "Шаг 4: Получение ответа на запрос",
-                "Шаг 5: Анализ ответа",
-                "Шаг 6.1: Если ответ требует улучшения передаём его в Шаг 2",
-                "Шаг 6.2: Если ответ удовлетворяет ИЛИ получен пустой ответ, то передаём ответ в WRITER node и выводим ответ пользователю"
-            ]
+            ],
+            session_id=session_id,
         )
+        # История сессии одна на все итерации: префикс промпта агента между ними не меняется
+        memory = await amemory_context(session_id)
+        if memory is not None:
+            state.context_tokens = memory.tokens
+            state.reasoning_chain.append(f"Шаг 3: {memory.describe()}")
+        for step in state.reasoning_chain:
+            yield StreamEvent("log", step)
         
-        # 3. Получаем ответ от выбранного агента
-        try:
-            agent = self.agents[selected_agent]
-            agent_response = await agent.ainvoke({"question": query})
+        # Составной запрос (исследование + код) исполняется как DAG подзадач
+        history = memory.messages if memory is not None else []
+        if is_composite(query):
+            async for event in self._stream_task_graph(query, state, started, history):
+                yield event
+            return
+        
+        def remaining_seconds() -> Optional[float]:
+            if deadline is None:
+                return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise BudgetExceeded("лимит времени на запрос исчерпан")
+            return remaining
+        
+        def charge(tokens: int) -> None:
+            state.tokens_used += tokens
+            if self.max_tokens_per_query and state.tokens_used >= self.max_tokens_per_query:
+                raise BudgetExceeded("лимит токенов на запрос исчерпан")
+        
+        agent = self.agents[selected_agent]
+        agent_input = {"history": history} if history else {}
+        best: Optional[AgentResponse] = None
+        best_rank = None
+        while state.current_iteration < state.max_iterations:
+            state.current_iteration += 1
+            yield StreamEvent("iteration", payload=state.current_iteration)
+            chunks = []
+            try:
+                # 3. Получаем ответ от выбранного агента (потоково)
+                charge(estimate_tokens(state.current_query) + state.context_tokens)
+                stage = agent_stage(selected_agent)
+                # Первую итерацию пакетного запуска iter_batch уже получил одним abatch на группу
+                if state.current_iteration == 1 and first_answer is not None:
+                    if isinstance(first_answer, Exception):
+                        raise first_answer
+                    chunks.append(first_answer)
+                    yield StreamEvent("token", first_answer)
+                else:
+                    with get_tracer().span(stage, iteration=state.current_iteration):
+                        stream = agent.astream(dict(agent_input, question=state.current_query), stage_config(stage)).__aiter__()
+                        try:
+                            while True:
+                                try:
+                                    chunk = await asyncio.wait_for(stream.__anext__(), remaining_seconds())
+                                except StopAsyncIteration:
+                                    break
+                                chunks.append(chunk)
+                                yield StreamEvent("token", chunk)
+                        finally:
+                            # Отмена, таймаут или уход потребителя закрывают поток модели — HTTP-запрос прерывается
+                            await stream.aclose()
+                agent_response = "".join(chunks)
+                charge(estimate_tokens(agent_response))
+                
+                # 4. Пустой ответ улучшать бессмысленно
+                if not agent_response.strip():
+                    state.stop_reason = "empty_answer"
+                    break
+                
+                # 4.1 Код из ответа coding-агента запускается в песочнице, ошибки идут в issues
+                verification = None
+                if selected_agent == AgentType.CODING:
+                    verification = await averify_code(agent_response, remaining_seconds())
+                    if verification is not None:
+                        state.reasoning_chain.append(f"Итерация {state.current_iteration}: песочница — {verification.summary()}")
+                        yield StreamEvent("log", state.reasoning_chain[-1])
+                
+                # 5. Анализ ответа критиком
+                try:
+                    critique = await self.critique(query, agent_response, remaining_seconds())
+                except (BudgetExceeded, asyncio.TimeoutError):
+                    raise
+                except Exception as e:
+                    # Без оценки критика уточнять нечего — принимаем ответ как есть
+                    critique = {"score": 0.0, "issues": [f"Критик недоступен: {e}"], "failed": True}
+                charge(estimate_tokens(query) + estimate_tokens(agent_response[:CRITIC_MAX_ANSWER_CHARS]) + CRITIC_MAX_TOKENS)
+            except (BudgetExceeded, asyncio.TimeoutError) as e:
+                reason = str(e) or "лимит времени на запрос исчерпан"
+                state.stop_reason = "budget"
+                state.reasoning_chain.append(f"Итерация {state.current_iteration}: остановка — {reason}")
+                yield StreamEvent("log", state.reasoning_chain[-1])
+                if best is None and chunks:
+                    best = AgentResponse(content="".join(chunks), agent_type=selected_agent, issues=[reason])
+                    state.agent_responses.append(best)
+                    yield StreamEvent("response", payload=best)
+                break
+            except Exception as e:
+                # Если произошла ошибка, возвращаем сообщение об ошибке
+                error_message = f"Ошибка при обработке запроса агентом {selected_agent.value}: {str(e)}"
+                state.agent_responses.append(AgentResponse(
+                    content=error_message,
+                    agent_type=selected_agent,
+                    is_complete=False,
+                    issues=[str(e)],
+                    confidence_score=0.0
+                ))
+                yield StreamEvent("response", payload=state.agent_responses[-1])
+                state.stop_reason = "error"
+                yield StreamEvent("log", error_message)
+                break
             
-            # 4. Добавляем ответ агента
-            state.agent_responses.append(AgentResponse(
+            sandbox_issues = verification.issues if verification is not None else []
+            issues = sandbox_issues + critique["issues"]
+            response = AgentResponse(
                 content=agent_response,
                 agent_type=selected_agent,
-                is_complete=True,
-                confidence_score=0.85
-            ))
-            
-            # 5. Обновляем финальный ответ
-            state.final_answer = agent_response
+                # Код, упавший в песочнице, не принимается даже при высокой оценке критика
+                is_complete=critique["score"] >= self.quality_threshold and not sandbox_issues,
+                issues=issues,
+                confidence_score=critique["score"]
+            )
+            state.agent_responses.append(response)
+            # Завершённая итерация — отдельное событие (журнал запусков пишет её сразу)
+            yield StreamEvent("response", payload=response)
+            # Лучший ответ: сначала прошедший песочницу, затем по оценке критика
+            rank = (not sandbox_issues, response.confidence_score)
+            if best is None or best_rank is None or rank > best_rank:
+                best, best_rank = response, rank
+            state.reasoning_chain.append(
+                f"Итерация {state.current_iteration}: оценка критика {critique['score']:.2f}, замечаний: {len(issues)}"
+            )
+            yield StreamEvent("log", state.reasoning_chain[-1])
             
+            # 6.1 Ответ удовлетворяет порогу качества — ранняя остановка
+            if response.is_complete:
+                state.stop_reason = "quality_threshold"
+                break
+            if critique.get("failed") or not issues:
+                state.stop_reason = "critic_failed" if critique.get("failed") else "no_issues"
+                break
+            # 6.2 Иначе уточняем запрос: отклонённый ответ и замечания критика и песочницы
+            state.current_query = self.build_refine_query(query, agent_response, issues)
+        else:
+            state.stop_reason = "max_iterations"
+        
+        # Финальный ответ — лучший по оценке критика
+        if best is not None:
+            state.final_answer = best.content
+        elif state.agent_responses:
+            state.final_answer = state.agent_responses[-1].content
+        state.is_complete = True
+        state.elapsed_seconds = round(time.monotonic() - started, 3)
+        state.reasoning_chain.append(
+            f"Итог: {state.current_iteration} итераций, ~{state.tokens_used} токенов, "
+            f"{state.elapsed_seconds:.1f} с, причина остановки: {state.stop_reason}"
+        )
+        yield StreamEvent("log", state.reasoning_chain[-1])
+        if state.agent_responses and state.stop_reason != "error":
+            # Реплика запоминается до события "state": следующий запрос сессии её уже видит
+            await aremember_turn(state.session_id, query, state.final_answer)
+        yield StreamEvent("state", payload=state)
+    
+    async def _stream_task_graph(self, query: str, state: ReActState, started: float,
+                                 history: Optional[List[Any]] = None) -> AsyncIterator[StreamEvent]:
+        """Декомпозиция запроса в DAG и параллельное исполнение независимых подзадач"""
+        logs: List[str] = []
+        state.current_iteration = 1
+        yield StreamEvent("iteration", payload=state.current_iteration)
+        try:
+            with get_tracer().span("task_graph"):
+                result = await self.task_graph.arun(query, logs.append, history)
+            for task in result["plan"].tasks:
+                state.agent_responses.append(AgentResponse(
+                    content=result["results"][task.id],
+                    agent_type=task.agent,
+                    is_complete=True
+                ))
+            for response in state.agent_responses:
+                yield StreamEvent("response", payload=response)
+            state.final_answer = result["answer"]
+            state.tokens_used += estimate_tokens(query) + sum(estimate_tokens(text) for text in result["results"].values())
+            state.stop_reason = "task_graph"
         except Exception as e:
-            # Если произошла ошибка, возвращаем сообщение об ошибке
-            state.final_answer = f"Ошибка при обработке запроса агентом {selected_agent.value}: {str(e)}"
-            state.agent_responses.append(AgentResponse(
-                content=state.final_answer,
-                agent_type=selected_agent,
-                is_complete=False,
-                issues=[str(e)],
-                confidence_score=0.0
-            ))
+            state.final_answer = f"Ошибка при выполнении составного запроса: {str(e)}"
+            state.stop_reason = "error"
+            logs.append(state.final_answer)
+        state.reasoning_chain.extend(logs)
+        for message in logs:
+            yield StreamEvent("log", message)
+        yield StreamEvent("token", state.final_answer)
+        state.is_complete = True
+        state.elapsed_seconds = round(time.monotonic() - started, 3)
+        if state.stop_reason != "error":
+            await aremember_turn(state.session_id, query, state.final_answer)
+        yield StreamEvent("state", payload=state)
+    
+    async def iter_batch(self, queries: List[str], max_concurrency: int = 8) -> AsyncIterator[BatchResult]:
+        """Пакетный ReAct Loop: результаты отдаются по мере готовности.
+        
+        Запросы сначала маршрутизируются, и первая итерация каждой группы агента идёт одним
+        agent.abatch_as_completed; критик и уточнения продолжают каждый запрос отдельно,
+        составные запросы исполняются графом подзадач. Семафор ограничивает число
+        одновременных запросов к LLM (группа держит свою долю слотов, пока идёт её пакет),
+        а планировщик LLM пропускает интерактивные запросы вперёд пакета"""
+        semaphore = asyncio.Semaphore(max_concurrency)
+        results: asyncio.Queue = asyncio.Queue()
+        tasks: List[asyncio.Task] = []
         
-        return state
\ No newline at end of file
+        async def run_one(index: int, query: str, first_answer: Any = None) -> None:
+            async with semaphore:
+                try:
+                    with scheduling(priority=Priority.BATCH):
+                        state = await self.run_react_loop(query, first_answer=first_answer)
+                    result = BatchResult(index=index, question=query, agent=state.selected_agent.value, answer=state)
+                except Exception as e:
+                    # Ошибка одного запроса не должна ронять весь пакет
+                    result = BatchResult(index=index, question=query, error=str(e))
+            await results.put(result)
+        
+        async def first_iterations(agent_type: AgentType, indices: List[int], quota: int) -> None:
+            stage = agent_stage(agent_type)
+            inputs = [{"question": queries[i]} for i in indices]
+            config = dict(stage_config(stage), max_concurrency=quota)
+            pending = set(indices)
+            try:
+                async with acquire_many(semaphore, quota):
+                    with scheduling(priority=Priority.BATCH), get_tracer().span(stage, batch=True, size=len(indices)):
+                        answers = self.agents[agent_type].abatch_as_completed(inputs, config, return_exceptions=True)
+                        async for position, answer in answers:
+                            pending.discard(indices[position])
+                            tasks.append(asyncio.create_task(run_one(indices[position], queries[indices[position]], answer)))
+            except Exception as e:
+                for index in pending:
+                    tasks.append(asyncio.create_task(run_one(index, queries[index], e)))
+        
+        groups: Dict[AgentType, List[int]] = {}
+        for index, query in enumerate(queries):
+            if is_composite(query):
+                tasks.append(asyncio.create_task(run_one(index, query)))
+            else:
+                groups.setdefault(self.analyze_and_choose_agent(query), []).append(index)
+        quotas = split_concurrency([len(indices) for indices in groups.values()], max_concurrency)
+        for (agent_type, indices), quota in zip(groups.items(), quotas):
+            tasks.append(asyncio.create_task(first_iterations(agent_type, indices, quota)))
+        try:
+            for _ in queries:
+                yield await results.get()
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    async def run_batch(self, queries: List[str], max_concurrency: int = 8) -> List[BatchResult]:
+        """Пакетный ReAct Loop с сохранением порядка запросов"""
+        results = [None] * len(queries)
+        async for result in self.iter_batch(queries, max_concurrency=max_concurrency):
+            results[result.index] = result
+        return results
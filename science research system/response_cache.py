@@ -0,0 +1,293 @@
+# response_cache.py
+"""Двухуровневый кэш ответов агентов: LRU в памяти + SQLite на диске."""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional, Tuple
+
+from langchain_core.runnables import Runnable, RunnableConfig
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """Приводит вопрос к каноническому виду: регистр, пробелы, финальная пунктуация."""
+    return _WHITESPACE_RE.sub(" ", question.lower()).strip().rstrip("?!.;:").strip()
+
+
+def prompt_fingerprint(prompt: Any) -> str:
+    """Хэш шаблона промпта: изменение промпта автоматически инвалидирует кэш."""
+    return hashlib.sha256(repr(prompt).encode("utf-8")).hexdigest()[:16]
+
+
+class ResponseCache:
+    """LRU-кэш в памяти поверх SQLite с TTL и ограничением по размеру."""
+
+    def __init__(
+        self,
+        path: Optional[str] = "response_cache.sqlite3",
+        max_memory_items: int = 256,
+        max_disk_items: int = 10_000,
+        ttl_seconds: float = 24 * 3600,
+    ):
+        self.path = path
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.ttl_seconds = ttl_seconds
+        self._memory: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "writes": 0, "evictions": 0}
+        self._db: Optional[sqlite3.Connection] = None
+        self._disk_items = 0
+        self._evict_slack = max(1, max_disk_items // 20)
+        if path:
+            # Streamlit обслуживает сессии из разных потоков, доступ сериализуется через self._lock
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses(accessed)")
+            self._db.commit()
+            # Полная чистка (TTL и лимит размера) — раз в _evict_slack записей; сразу после открытия
+            # кэш может превышать max_disk_items не больше чем на этот запас
+            (self._disk_items,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+
+    @staticmethod
+    def make_key(question: str, agent_type: str, prompt_hash: str, model_name: str, context_version: str = "") -> str:
+        parts = [normalize_question(question), agent_type, prompt_hash, model_name]
+        if context_version:
+            parts.append(context_version)
+        raw = "\x1f".join(parts)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        now = time.time()
+        found, value = self._get_memory(key, now)
+        return value if found else self._get_disk(key, now)
+
+    async def aget(self, key: str) -> Optional[Any]:
+        """get для event loop: попадание в память — сразу, чтение SQLite — в потоке."""
+        now = time.time()
+        found, value = self._get_memory(key, now)
+        if found:
+            return value
+        if self._db is None:
+            return self._get_disk(key, now)
+        return await asyncio.to_thread(self._get_disk, key, now)
+
+    def set(self, key: str, value: Any) -> None:
+        now = time.time()
+        self._set_memory(key, now, value)
+        self._set_disk(key, now, value)
+
+    async def aset(self, key: str, value: Any) -> None:
+        """set для event loop: память обновляется сразу, запись в SQLite — в потоке."""
+        now = time.time()
+        self._set_memory(key, now, value)
+        if self._db is not None:
+            await asyncio.to_thread(self._set_disk, key, now, value)
+
+    def _get_memory(self, key: str, now: float) -> Tuple[bool, Optional[Any]]:
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                created, value = entry
+                if now - created <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return True, value
+                del self._memory[key]
+            if self._db is None:
+                self._stats["misses"] += 1
+        return False, None
+
+    def _get_disk(self, key: str, now: float) -> Optional[Any]:
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                if now - row[1] <= self.ttl_seconds:
+                    self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                    self._db.commit()
+                    value = json.loads(row[0])
+                    self._remember(key, row[1], value)
+                    self._stats["disk_hits"] += 1
+                    return value
+                # Просроченные строки удаляет периодическая чистка (_evict_disk)
+            self._stats["misses"] += 1
+            return None
+
+    def _set_memory(self, key: str, now: float, value: Any) -> None:
+        with self._lock:
+            self._remember(key, now, value)
+            self._stats["writes"] += 1
+
+    def _set_disk(self, key: str, now: float, value: Any) -> None:
+        if self._db is None:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now),
+            )
+            # Счётчик — верхняя оценка числа строк (перезапись ключа тоже считается);
+            # чистка идёт, когда он выходит за лимит с запасом, а не на каждую запись
+            self._disk_items += 1
+            if self._disk_items > self.max_disk_items + self._evict_slack:
+                self._evict_disk(now)
+            self._db.commit()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self._db.commit()
+                self._disk_items = 0
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_items"] = len(self._memory)
+        hits = stats["memory_hits"] + stats["disk_hits"]
+        lookups = hits + stats["misses"]
+        stats["hits"] = hits
+        stats["hit_rate"] = hits / lookups if lookups else 0.0
+        return stats
+
+    def _remember(self, key: str, created: float, value: Any) -> None:
+        self._memory[key] = (created, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+            self._stats["evictions"] += 1
+
+    def _evict_disk(self, now: float) -> None:
+        self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+        (count,) = self._db.execute("SELECT COUNT(*) FROM responses").fetchone()
+        overflow = count - self.max_disk_items
+        if overflow > 0:
+            self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed LIMIT ?)",
+                (overflow,),
+            )
+            self._stats["evictions"] += overflow
+        self._disk_items = min(count, self.max_disk_items)
+
+
+class CachedRunnable(Runnable[Dict[str, Any], Any]):
+    """Обёртка над цепочкой агента: отвечает из кэша, если такой вопрос уже задавали."""
+
+    def __init__(self, runnable: Runnable, cache: ResponseCache, agent_type: str, prompt_hash: str, model_name: str,
+                 context_version: Optional[Callable[[], str]] = None):
+        self.runnable = runnable
+        self.cache = cache
+        self.agent_type = agent_type
+        self.prompt_hash = prompt_hash
+        self.model_name = model_name
+        # Версия данных, которые цепочка подмешивает в промпт сама (индекс литературы): часть ключа
+        self.context_version = context_version
+
+    def _key(self, inputs: Dict[str, Any]) -> Optional[str]:
+        # С историей сессии (session_memory.py) ответ зависит не только от вопроса — мимо кэша
+        if inputs.get("history"):
+            return None
+        version = self.context_version() if self.context_version is not None else ""
+        return self.cache.make_key(inputs["question"], self.agent_type, self.prompt_hash, self.model_name, version)
+
+    def invoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        key = self._key(input)
+        if key is None:
+            return self.runnable.invoke(input, config, **kwargs)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        result = self.runnable.invoke(input, config, **kwargs)
+        self.cache.set(key, result)
+        return result
+
+    async def ainvoke(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Any:
+        key = self._key(input)
+        if key is None:
+            return await self.runnable.ainvoke(input, config, **kwargs)
+        cached = await self.cache.aget(key)
+        if cached is not None:
+            return cached
+        result = await self.runnable.ainvoke(input, config, **kwargs)
+        await self.cache.aset(key, result)
+        return result
+
+    def stream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[Any]:
+        key = self._key(input)
+        if key is None:
+            yield from self.runnable.stream(input, config, **kwargs)
+            return
+        cached = self.cache.get(key)
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        for chunk in self.runnable.stream(input, config, **kwargs):
+            chunks.append(chunk)
+            yield chunk
+        self._store_streamed(key, chunks)
+
+    async def astream(self, input: Dict[str, Any], config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[Any]:
+        key = self._key(input)
+        cached = await self.cache.aget(key) if key is not None else None
+        if cached is not None:
+            yield cached
+            return
+        chunks = []
+        stream = self.runnable.astream(input, config, **kwargs)
+        try:
+            async for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            # Закрытие обёртки закрывает и поток модели (отмена запуска, ранний выход)
+            await stream.aclose()
+        if key is not None and _complete_text(chunks):
+            await self.cache.aset(key, "".join(chunks))
+
+    def _store_streamed(self, key: str, chunks: list) -> None:
+        if _complete_text(chunks):
+            self.cache.set(key, "".join(chunks))
+
+
+def _complete_text(chunks: list) -> bool:
+    # Кэшируем только полностью полученные текстовые ответы
+    return bool(chunks) and all(isinstance(chunk, str) for chunk in chunks)
+
+
+def cached(runnable: Runnable, cache: Optional[ResponseCache], agent_type: str, prompt: Any, model_name: str,
+           context_version: Optional[Callable[[], str]] = None) -> Runnable:
+    """Оборачивает цепочку в кэш, если кэш включён.
+
+    context_version — версия контекста, который цепочка добавляет к вопросу сама (например,
+    literature_version для research-агента): при её смене прежние ответы не используются.
+    """
+    if cache is None:
+        return runnable
+    return CachedRunnable(runnable, cache, agent_type, prompt_fingerprint(prompt), model_name, context_version)
+
+
+def cache_from_env() -> Optional[ResponseCache]:
+    """Кэш по переменным окружения RESPONSE_CACHE_*; RESPONSE_CACHE_ENABLED=0 отключает его."""
+    if os.getenv("RESPONSE_CACHE_ENABLED", "1") == "0":
+        return None
+    return ResponseCache(
+        path=os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3") or None,
+        max_memory_items=int(os.getenv("RESPONSE_CACHE_MEMORY_ITEMS", "256")),
+        max_disk_items=int(os.getenv("RESPONSE_CACHE_DISK_ITEMS", "10000")),
+        ttl_seconds=float(os.getenv("RESPONSE_CACHE_TTL", str(24 * 3600))),
+    )
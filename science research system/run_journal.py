@@ -0,0 +1,248 @@
+# run_journal.py
+"""Журнал запусков: append-only записи в SQLite вместо истории в памяти сессии.
+
+Каждая завершённая итерация ReAct (событие "response") и итог запуска ("state"/"answer")
+пишутся отдельной записью сразу по готовности; тело записи — JSON, сжатый zlib.
+Запуски индексируются по сессии и хэшу нормализованного запроса. Сессия Streamlit хранит
+только лёгкий RunHandle, а экспорт читает записи курсором и отдаёт JSONL частями —
+память процесса не растёт с длиной истории.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional
+
+from streaming import StreamEvent
+
+RUN_JOURNAL_PATH = os.getenv("RUN_JOURNAL_PATH", "run_journal.sqlite3")
+# Запуски старше срока удаляются при открытии журнала; 0 — хранить всё
+RUN_JOURNAL_TTL_DAYS = float(os.getenv("RUN_JOURNAL_TTL_DAYS", "30"))
+EXPORT_CHUNK_BYTES = 64 * 1024
+_EXPORT_BATCH_ROWS = 64
+
+
+def query_hash(query: str) -> str:
+    from response_cache import normalize_question
+
+    return hashlib.sha256(normalize_question(query).encode("utf-8")).hexdigest()[:16]
+
+
+def _pack(data: Dict[str, Any]) -> bytes:
+    return zlib.compress(json.dumps(data, ensure_ascii=False).encode("utf-8"))
+
+
+def _unpack(blob: bytes) -> Dict[str, Any]:
+    return json.loads(zlib.decompress(blob).decode("utf-8"))
+
+
+@dataclass
+class RunHandle:
+    """Всё, что сессия держит о запуске: идентификатор и сводка для боковой панели."""
+    run_id: str
+    iterations: int = 0
+    last_score: Optional[float] = None
+    tokens_used: int = 0
+    elapsed_seconds: float = 0.0
+    stop_reason: Optional[str] = None
+
+    @classmethod
+    def from_state(cls, run_id: str, state: Any) -> "RunHandle":
+        return cls(
+            run_id=run_id,
+            iterations=state.current_iteration,
+            last_score=state.agent_responses[-1].confidence_score if state.agent_responses else None,
+            tokens_used=state.tokens_used,
+            elapsed_seconds=state.elapsed_seconds,
+            stop_reason=state.stop_reason,
+        )
+
+
+class RunJournal:
+    """Append-only журнал в SQLite; записи запуска только добавляются, запуски удаляются целиком по сроку."""
+
+    def __init__(self, path: str = RUN_JOURNAL_PATH, ttl_days: float = RUN_JOURNAL_TTL_DAYS):
+        self.path = path
+        self._lock = threading.Lock()
+        # Streamlit и сервис пишут из разных потоков, доступ сериализуется через self._lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # В режиме WAL запись без fsync на каждый commit; при сбое теряются лишь последние записи
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS runs ("
+            "run_id TEXT PRIMARY KEY, session TEXT NOT NULL, query_hash TEXT NOT NULL, "
+            "query TEXT NOT NULL, mode TEXT NOT NULL, started REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            "run_id TEXT NOT NULL, seq INTEGER NOT NULL, kind TEXT NOT NULL, created REAL NOT NULL, "
+            "data BLOB NOT NULL, PRIMARY KEY (run_id, seq))"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_session ON runs(session, started)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS runs_query ON runs(query_hash, started)")
+        self._db.commit()
+        self._seq: Dict[str, int] = {}
+        if ttl_days > 0:
+            self.prune(time.time() - ttl_days * 86400)
+
+    def start(self, session: str, query: str, mode: str = "react", run_id: Optional[str] = None) -> str:
+        run_id = run_id or uuid.uuid4().hex
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO runs (run_id, session, query_hash, query, mode, started) VALUES (?, ?, ?, ?, ?, ?)",
+                (run_id, session, query_hash(query), query, mode, time.time()),
+            )
+            self._db.commit()
+            self._seq[run_id] = 0
+        return run_id
+
+    def append(self, run_id: str, kind: str, data: Dict[str, Any]) -> None:
+        blob = _pack(data)
+        with self._lock:
+            seq = self._seq.get(run_id, 0) + 1
+            self._db.execute(
+                "INSERT INTO records (run_id, seq, kind, created, data) VALUES (?, ?, ?, ?, ?)",
+                (run_id, seq, kind, time.time(), blob),
+            )
+            self._db.commit()
+            self._seq[run_id] = seq
+
+    def finish(self, run_id: str, kind: str, data: Dict[str, Any]) -> None:
+        """Последняя запись запуска: счётчик записей больше не нужен."""
+        self.append(run_id, kind, data)
+        with self._lock:
+            self._seq.pop(run_id, None)
+
+    def session_runs(self, session: str, limit: int = 50) -> List[Dict[str, Any]]:
+        """Последние запуски сессии (только заголовки) — от новых к старым."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT run_id, query, mode, started FROM runs WHERE session = ? ORDER BY started DESC LIMIT ?",
+                (session, limit),
+            ).fetchall()
+        return [{"run_id": r[0], "query": r[1], "mode": r[2], "started": r[3]} for r in rows]
+
+    def find_runs(self, query: str, limit: int = 50) -> List[str]:
+        """Запуски с тем же (нормализованным) запросом из всех сессий."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT run_id FROM runs WHERE query_hash = ? ORDER BY started DESC LIMIT ?", (query_hash(query), limit)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def iter_records(self, run_id: str) -> Iterator[Dict[str, Any]]:
+        """Записи запуска по порядку; читаются пачками, а не целиком."""
+        last_seq = 0
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT seq, kind, created, data FROM records WHERE run_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                    (run_id, last_seq, _EXPORT_BATCH_ROWS),
+                ).fetchall()
+            for seq, kind, created, data in rows:
+                yield dict(_unpack(data), kind=kind, created=created)
+            if len(rows) < _EXPORT_BATCH_ROWS:
+                return
+            last_seq = rows[-1][0]
+
+    def export(self, run_ids: Iterable[str]) -> Iterator[bytes]:
+        """JSONL-экспорт запусков частями по ~EXPORT_CHUNK_BYTES: заголовок запуска, затем его записи."""
+        buffer = bytearray()
+        for run_id in run_ids:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT session, query, mode, started FROM runs WHERE run_id = ?", (run_id,)
+                ).fetchone()
+            if row is None:
+                continue
+            header = {"kind": "run", "run_id": run_id, "session": row[0], "query": row[1], "mode": row[2], "started": row[3]}
+            buffer += json.dumps(header, ensure_ascii=False).encode("utf-8") + b"\n"
+            for record in self.iter_records(run_id):
+                buffer += json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+                if len(buffer) >= EXPORT_CHUNK_BYTES:
+                    yield bytes(buffer)
+                    buffer.clear()
+        if buffer:
+            yield bytes(buffer)
+
+    def prune(self, before: float) -> int:
+        """Удаляет запуски, начатые раньше before, вместе с их записями."""
+        with self._lock:
+            stale = "SELECT run_id FROM runs WHERE started < ?"
+            self._db.execute(f"DELETE FROM records WHERE run_id IN ({stale})", (before,))
+            removed = self._db.execute("DELETE FROM runs WHERE started < ?", (before,)).rowcount
+            self._db.commit()
+        return removed
+
+
+def journal_from_env() -> Optional[RunJournal]:
+    """Журнал по RUN_JOURNAL_PATH; пустой путь отключает журнал."""
+    return RunJournal(RUN_JOURNAL_PATH) if RUN_JOURNAL_PATH else None
+
+
+def _final_record(event: StreamEvent) -> Dict[str, Any]:
+    if event.type == "answer":
+        return {"final_answer": event.content}
+    state = event.payload
+    return {
+        "query": state.original_query,
+        "agent": state.selected_agent.value,
+        "iterations": state.current_iteration,
+        "tokens_used": state.tokens_used,
+        "elapsed_seconds": state.elapsed_seconds,
+        "stop_reason": state.stop_reason,
+        "final_answer": state.final_answer,
+        "reasoning_chain": state.reasoning_chain,
+    }
+
+
+async def _settled(task: "asyncio.Future") -> bool:
+    """Дожидается записи заголовка запуска; False — записать его не удалось."""
+    try:
+        await task
+    except Exception:
+        return False
+    return True
+
+
+async def journaled(stream: AsyncIterator[StreamEvent], journal: RunJournal, session: str, query: str,
+                    mode: str = "react") -> AsyncIterator[StreamEvent]:
+    """Пропускает события потока, записывая в журнал итерации и итог; первым событием идёт "run" с run_id.
+
+    Запуск, прерванный отменой или ошибкой, закрывается записью "stopped". Записи (INSERT и
+    COMMIT под блокировкой журнала) идут в потоке, как и экспорт: event loop их не ждёт.
+    """
+    run_id = uuid.uuid4().hex
+    # Заголовок запуска пишется и при отмене во время записи: shield не даёт отмене прервать его
+    started = asyncio.ensure_future(asyncio.to_thread(journal.start, session, query, mode, run_id))
+    iteration = 0
+    finished = False
+    try:
+        await asyncio.shield(started)
+        yield StreamEvent("run", payload=run_id)
+        async for event in stream:
+            if event.type == "iteration":
+                iteration = event.payload
+            elif event.type == "response":
+                record = dict(event.payload.model_dump(mode="json"), iteration=iteration)
+                await asyncio.to_thread(journal.append, run_id, "iteration", record)
+            elif event.type in ("state", "answer"):
+                await asyncio.to_thread(journal.finish, run_id, "final", _final_record(event))
+                finished = True
+            yield event
+    finally:
+        # Закрытие обёртки закрывает и поток запуска (отмена, уход потребителя)
+        await stream.aclose()
+        if not finished:
+            # Ошибка записи заголовка уже дошла до вызывающего из shield выше (или запуск прерван
+            # раньше): здесь она не должна подменять исходное исключение
+            if await _settled(started):
+                # Повторная отмена прерывает лишь ожидание: запись в потоке всё равно завершится
+                await asyncio.to_thread(journal.finish, run_id, "stopped", {"iteration": iteration})
@@ -0,0 +1,491 @@
+# service.py
+"""Headless HTTP-сервис мульти-агентной системы на aiohttp.
+
+Эндпоинты (тело запроса и ответ — JSON):
+- POST /v1/route          {"question"} → решение маршрутизатора
+- POST /v1/answer         {"question", "mode": "multi_agent" | "react", ...} → ответ целиком
+- POST /v1/answer/stream  то же; ответ — SSE-события StreamEvent по мере генерации
+- POST /v1/batch          {"questions": [...], "mode", "max_concurrency"} → результаты в порядке вопросов
+- GET  /v1/runs?session=  запуски сессии из журнала (run_journal.py)
+- GET  /v1/runs/export?session= | ?run_id=  JSONL-экспорт журнала, отдаётся частями
+- GET / DELETE /v1/memory?session=  память диалога сессии (session_memory.py): сводка / очистка
+- GET  /health, GET /metrics (Prometheus)
+
+Loop aiohttp становится общим loop llm_provider: LLM-клиент с пулом соединений,
+планировщик, пул реплик и песочница общие для всех запросов процесса. Запрос, у которого
+истёк SERVICE_REQUEST_TIMEOUT или клиент отключился, отменяется вместе с HTTP-запросами к модели.
+
+Запуск: python service.py --port 8080 [--workers 4]
+Streamlit-приложения становятся тонкими клиентами, если задан AGENT_SERVICE_URL.
+"""
+import argparse
+import asyncio
+import copy
+import json
+import os
+import signal
+from contextlib import nullcontext
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, AsyncIterator, Awaitable, Callable, Dict, List, Literal, Optional, Type, TypeVar
+
+from pydantic import BaseModel, Field, ValidationError
+
+from streaming import StreamEvent, consume
+
+if TYPE_CHECKING:  # aiohttp импортируется при запуске сервиса, тонкому клиенту он не нужен
+    from aiohttp import web
+
+SERVICE_HOST = os.getenv("SERVICE_HOST", "0.0.0.0")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8080"))
+SERVICE_WORKERS = int(os.getenv("SERVICE_WORKERS", "1"))
+# Предел времени на запрос целиком (маршрутизация, все итерации ReAct, песочница)
+SERVICE_REQUEST_TIMEOUT = float(os.getenv("SERVICE_REQUEST_TIMEOUT", "300"))
+# Сколько ждать завершения начатых запросов при остановке, прежде чем отменить их
+SERVICE_SHUTDOWN_TIMEOUT = float(os.getenv("SERVICE_SHUTDOWN_TIMEOUT", "30"))
+SERVICE_MAX_BATCH = int(os.getenv("SERVICE_MAX_BATCH", "256"))
+# Наибольшее число запусков в ответе GET /v1/runs
+SERVICE_MAX_RUNS = 1000
+# Адрес сервиса для тонких клиентов (app.py, app_with_react.py); пусто — всё исполняется в процессе
+AGENT_SERVICE_URL = os.getenv("AGENT_SERVICE_URL", "").rstrip("/")
+# Адрес сервиса, по которому к нему обращается браузер (ссылка на выгрузку журнала)
+AGENT_SERVICE_PUBLIC_URL = os.getenv("AGENT_SERVICE_PUBLIC_URL", AGENT_SERVICE_URL).rstrip("/")
+# Порт выгрузки журнала у Streamlit-приложения без сервиса (0 — выключено) и её адрес для браузера
+EXPORT_PORT = int(os.getenv("EXPORT_PORT", "0"))
+EXPORT_PUBLIC_URL = os.getenv("EXPORT_PUBLIC_URL", f"http://localhost:{EXPORT_PORT}").rstrip("/")
+
+Mode = Literal["multi_agent", "react"]
+M = TypeVar("M", bound=BaseModel)
+
+
+class RouteRequest(BaseModel):
+    question: str = Field(min_length=1)
+    session: Optional[str] = None
+
+
+class AnswerRequest(BaseModel):
+    question: str = Field(min_length=1)
+    mode: Mode = "multi_agent"
+    session: Optional[str] = None
+    # Параметры ReAct; не заданные берутся из общего координатора
+    max_iterations: Optional[int] = Field(None, ge=1, le=10)
+    quality_threshold: Optional[float] = Field(None, ge=0, le=1)
+    max_tokens: Optional[int] = Field(None, ge=1)
+    max_seconds: Optional[float] = Field(None, gt=0)
+
+
+class BatchRequest(BaseModel):
+    questions: List[str] = Field(min_length=1, max_length=SERVICE_MAX_BATCH)
+    mode: Mode = "multi_agent"
+    session: Optional[str] = None
+    max_concurrency: int = Field(8, ge=1, le=64)
+
+
+class _RequestError(Exception):
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.headers = headers
+
+
+def _session_scope(session: Optional[str]):
+    # Сессия клиента: планировщик LLM чередует запросы разных сессий
+    from llm_scheduler import scheduling
+
+    return scheduling(session=session) if session else nullcontext()
+
+
+def _jsonable(value: Any) -> Any:
+    return value.model_dump(mode="json") if isinstance(value, BaseModel) else value
+
+
+def _event_data(event: StreamEvent) -> Dict[str, Any]:
+    return {"content": event.content, "payload": _jsonable(event.payload)}
+
+
+def _sse(event_type: str, data: Dict[str, Any]) -> bytes:
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+def _as_request_error(error: BaseException) -> _RequestError:
+    from llm_scheduler import SchedulerOverloaded
+
+    if isinstance(error, _RequestError):
+        return error
+    if isinstance(error, asyncio.TimeoutError):
+        return _RequestError(504, f"Request did not finish within {SERVICE_REQUEST_TIMEOUT:g} s")
+    if isinstance(error, SchedulerOverloaded):
+        return _RequestError(503, str(error), {"Retry-After": "1"})
+    return _RequestError(500, f"{type(error).__name__}: {error}")
+
+
+def _coordinator(app: "web.Application", body: AnswerRequest):
+    """Копия общего координатора с параметрами запроса: агенты и критик общие, настройки — свои."""
+    coordinator = copy.copy(app["coordinator"])
+    if body.max_iterations is not None:
+        coordinator.max_iterations = body.max_iterations
+    if body.quality_threshold is not None:
+        coordinator.quality_threshold = body.quality_threshold
+    if body.max_tokens is not None:
+        coordinator.max_tokens_per_query = body.max_tokens
+    if body.max_seconds is not None:
+        coordinator.max_seconds_per_query = body.max_seconds
+    return coordinator
+
+
+def _events(app: "web.Application", body: AnswerRequest) -> AsyncIterator[StreamEvent]:
+    if body.mode == "react":
+        stream = _coordinator(app, body).stream_react_loop(body.question, body.session)
+    else:
+        from multi_agent_system import astream_multi_agent_answer
+
+        # С session ответ учитывает историю диалога сессии (session_memory.py)
+        stream = astream_multi_agent_answer(body.question, body.session)
+    if app["journal"] is None:
+        return stream
+    from run_journal import journaled
+
+    # Первое событие — "run" с run_id запуска в журнале
+    return journaled(stream, app["journal"], body.session or "default", body.question, body.mode)
+
+
+async def _parse(request: "web.Request", model: Type[M]) -> M:
+    try:
+        return model.model_validate(await request.json())
+    except json.JSONDecodeError as e:
+        raise _RequestError(400, f"Invalid JSON: {e}")
+    except ValidationError as e:
+        raise _RequestError(400, str(e))
+
+
+def _endpoint(model: Type[M]) -> Callable[[Callable[["web.Request", M], Awaitable[Any]]], Callable]:
+    """JSON-эндпоинт: разбор тела, сессия планировщика, таймаут запроса и ответ об ошибке."""
+    def decorate(handler: Callable[["web.Request", M], Awaitable[Any]]) -> Callable:
+        async def endpoint(request: "web.Request") -> "web.Response":
+            from aiohttp import web
+
+            try:
+                body = await _parse(request, model)
+                with _session_scope(body.session):
+                    result = await asyncio.wait_for(handler(request, body), SERVICE_REQUEST_TIMEOUT)
+            except Exception as e:
+                error = _as_request_error(e)
+                return web.json_response({"error": str(error)}, status=error.status, headers=error.headers)
+            return web.json_response(result, dumps=lambda data: json.dumps(data, ensure_ascii=False))
+
+        return endpoint
+
+    return decorate
+
+
+@_endpoint(RouteRequest)
+async def route(request: "web.Request", body: RouteRequest) -> Dict[str, Any]:
+    from multi_agent_system import aroute_question
+
+    logs: List[str] = []
+    decision = await aroute_question(body.question, logs.append)
+    return dict(decision.model_dump(), logs=logs)
+
+
+@_endpoint(AnswerRequest)
+async def answer(request: "web.Request", body: AnswerRequest) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"answer": None, "logs": []}
+
+    def collect(event: StreamEvent) -> None:
+        if event.type == "run":
+            result["run_id"] = event.payload
+        elif event.type == "log":
+            result["logs"].append(event.content)
+        elif event.type == "answer":
+            result["answer"] = event.content
+        elif event.type == "state":
+            result["answer"] = event.payload.final_answer
+            result["state"] = _jsonable(event.payload)
+
+    await consume(_events(request.app, body), collect)
+    return result
+
+
+@_endpoint(BatchRequest)
+async def batch(request: "web.Request", body: BatchRequest) -> Dict[str, Any]:
+    if body.mode == "react":
+        results = await request.app["coordinator"].run_batch(body.questions, max_concurrency=body.max_concurrency)
+    else:
+        from multi_agent_system import amulti_agent_answer_batch
+
+        results = await amulti_agent_answer_batch(body.questions, max_concurrency=body.max_concurrency)
+    return {"results": [
+        {"index": r.index, "question": r.question, "agent": r.agent, "answer": _jsonable(r.answer), "error": r.error}
+        for r in results
+    ]}
+
+
+async def answer_stream(request: "web.Request") -> "web.StreamResponse":
+    """SSE: события StreamEvent (event: log/token/iteration/answer/state, data: JSON), в конце — done или error."""
+    from aiohttp import web
+    try:
+        body = await _parse(request, AnswerRequest)
+    except _RequestError as e:
+        return web.json_response({"error": str(e)}, status=e.status)
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache",
+                                           "X-Accel-Buffering": "no"})
+    await response.prepare(request)
+
+    async def send(event: StreamEvent) -> None:
+        await response.write(_sse(event.type, _event_data(event)))
+
+    try:
+        with _session_scope(body.session):
+            await asyncio.wait_for(consume(_events(request.app, body), send), SERVICE_REQUEST_TIMEOUT)
+        await response.write(_sse("done", {}))
+    except ConnectionResetError:
+        # Клиент отключился: запуск уже отменён, писать некуда
+        return response
+    except Exception as e:
+        error = _as_request_error(e)
+        await response.write(_sse("error", {"error": str(error), "status": error.status}))
+    await response.write_eof()
+    return response
+
+
+async def runs(request: "web.Request") -> "web.Response":
+    from aiohttp import web
+
+    journal = request.app["journal"]
+    session = request.query.get("session")
+    if journal is None or not session:
+        return web.json_response({"error": "journal is disabled" if journal is None else "session is required"},
+                                 status=404 if journal is None else 400)
+    try:
+        limit = int(request.query.get("limit", "50"))
+    except ValueError:
+        limit = 0
+    if not 1 <= limit <= SERVICE_MAX_RUNS:
+        return web.json_response({"error": f"limit must be an integer from 1 to {SERVICE_MAX_RUNS}"}, status=400)
+    return web.json_response({"runs": await asyncio.to_thread(journal.session_runs, session, limit)})
+
+
+async def export_runs(request: "web.Request") -> "web.StreamResponse":
+    """JSONL запусков сессии (от старых к новым) или одного запуска; чтение журнала — в потоке, частями."""
+    from aiohttp import web
+
+    journal = request.app["journal"]
+    session, run_id = request.query.get("session"), request.query.get("run_id")
+    if journal is None or not (session or run_id):
+        return web.json_response({"error": "journal is disabled" if journal is None else "session or run_id is required"},
+                                 status=404 if journal is None else 400)
+    if run_id:
+        run_ids = [run_id]
+    else:
+        run_ids = [run["run_id"] for run in reversed(await asyncio.to_thread(journal.session_runs, session))]
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson",
+                                           "Content-Disposition": 'attachment; filename="runs.jsonl"'})
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+    chunks = journal.export(run_ids)
+    while True:
+        chunk = await asyncio.to_thread(next, chunks, None)
+        if chunk is None:
+            break
+        await response.write(chunk)
+    await response.write_eof()
+    return response
+
+
+async def memory(request: "web.Request") -> "web.Response":
+    """GET — размер памяти диалога сессии, DELETE — очистка (кнопка «Очистить» тонкого клиента)."""
+    from aiohttp import web
+    from session_memory import get_session_memory
+
+    store, session = get_session_memory(), request.query.get("session")
+    if store is None or not session:
+        return web.json_response({"error": "session memory is disabled" if store is None else "session is required"},
+                                 status=404 if store is None else 400)
+    if request.method == "DELETE":
+        await asyncio.to_thread(store.forget, session)
+        return web.json_response({"session": session, "forgotten": True})
+    state = await asyncio.to_thread(store.state, session)
+    return web.json_response({"session": session, "turns": len(state.turns), "turn_tokens": state.turn_tokens,
+                              "summary": state.summary, "summary_version": state.version})
+
+
+async def health(request: "web.Request") -> "web.Response":
+    from aiohttp import web
+    from llm_provider import LLM_SCHEDULER
+
+    data: Dict[str, Any] = {"status": "ok", "pid": os.getpid()}
+    if LLM_SCHEDULER:
+        from llm_scheduler import get_scheduler
+
+        data["scheduler"] = get_scheduler().snapshot()
+    return web.json_response(data)
+
+
+async def metrics(request: "web.Request") -> "web.Response":
+    from aiohttp import web
+    from tracing import get_tracer
+
+    return web.Response(text=get_tracer().registry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+
+async def _on_startup(app: "web.Application") -> None:
+    from agent_factory import AgentFactory
+    from code_sandbox import SANDBOX_ENABLED, available_sandbox_pool
+    from llm_provider import adopt_event_loop, get_llm
+    from multi_agent_system import get_response_cache
+    from react_coordinator import ReActCoordinator
+    from run_journal import journal_from_env
+
+    adopt_event_loop(asyncio.get_running_loop())
+    llm = get_llm()
+    app["journal"] = journal_from_env()
+    app["coordinator"] = ReActCoordinator(llm, AgentFactory(llm, cache=get_response_cache()).get_all_agents())
+    if SANDBOX_ENABLED:
+        # Прогрев исполнителей песочницы до первого запроса; loop при этом не блокируется.
+        # Без изоляции пул не создаётся, и код агентов не выполняется
+        await asyncio.to_thread(available_sandbox_pool)
+
+
+async def _on_cleanup(app: "web.Application") -> None:
+    from code_sandbox import get_sandbox_pool
+
+    if get_sandbox_pool.cache_info().currsize:
+        get_sandbox_pool().close()
+
+
+def make_app() -> "web.Application":
+    from aiohttp import web
+
+    app = web.Application(client_max_size=4 * 1024 * 1024)
+    app.router.add_post("/v1/route", route)
+    app.router.add_post("/v1/answer", answer)
+    app.router.add_post("/v1/answer/stream", answer_stream)
+    app.router.add_post("/v1/batch", batch)
+    app.router.add_get("/v1/runs", runs)
+    app.router.add_get("/v1/runs/export", export_runs)
+    app.router.add_get("/v1/memory", memory)
+    app.router.add_delete("/v1/memory", memory)
+    app.router.add_get("/health", health)
+    app.router.add_get("/metrics", metrics)
+    app.on_startup.append(_on_startup)
+    app.on_cleanup.append(_on_cleanup)
+    return app
+
+
+def serve(host: str = SERVICE_HOST, port: int = SERVICE_PORT, reuse_port: bool = False) -> None:
+    """Один процесс сервиса; SIGINT/SIGTERM — мягкая остановка с ожиданием начатых запросов."""
+    from aiohttp import web
+
+    # handler_cancellation: отключение клиента отменяет обработчик, а с ним и вызовы модели
+    web.run_app(make_app(), host=host, port=port, reuse_port=reuse_port,
+                shutdown_timeout=SERVICE_SHUTDOWN_TIMEOUT, handler_cancellation=True)
+
+
+def serve_workers(workers: int, host: str = SERVICE_HOST, port: int = SERVICE_PORT) -> None:
+    """Несколько процессов на одном порту (SO_REUSEPORT): ядро распределяет соединения.
+
+    У каждого процесса свой loop, LLM-клиент, планировщик и песочница; LLM_MAX_IN_FLIGHT
+    и лимиты скорости действуют на процесс. Сигнал остановки пересылается всем процессам.
+    """
+    import multiprocessing
+
+    # Исполнители песочницы делят процессоры между воркерами, если размер пула не задан явно
+    os.environ.setdefault("SANDBOX_WORKERS", str(max(1, (os.cpu_count() or 2) // workers)))
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=serve, args=(host, port, True), name=f"service-worker-{i}")
+                 for i in range(workers)]
+    for process in processes:
+        process.start()
+
+    def forward(signum, frame) -> None:
+        for process in processes:
+            if process.is_alive() and process.pid is not None:
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+
+
+@lru_cache(maxsize=None)
+def _remote_client():
+    import httpx
+
+    # Один клиент на процесс в общем фоновом loop: соединения к сервису переиспользуются
+    return httpx.AsyncClient(timeout=httpx.Timeout(SERVICE_REQUEST_TIMEOUT + 30, connect=10.0))
+
+
+async def astream_remote(request: Dict[str, Any], base_url: str = AGENT_SERVICE_URL) -> AsyncIterator[StreamEvent]:
+    """Тонкий клиент: события /v1/answer/stream как StreamEvent; итоговое состояние ReAct — ReActState.
+
+    Отмена запуска (start_run) закрывает соединение, и сервис отменяет запрос у себя.
+    """
+    event_type = "message"
+    async with _remote_client().stream("POST", f"{base_url}/v1/answer/stream", json=request) as response:
+        if response.status_code != 200:
+            await response.aread()
+            raise RuntimeError(f"Agent service returned {response.status_code}: {response.text}")
+        async for line in response.aiter_lines():
+            if line.startswith("event:"):
+                event_type = line[len("event:"):].strip()
+            elif line.startswith("data:"):
+                data = json.loads(line[len("data:"):])
+                if event_type == "error":
+                    raise RuntimeError(f"Agent service error: {data.get('error')}")
+                if event_type == "done":
+                    return
+                payload = data.get("payload")
+                if event_type == "state":
+                    from react_coordinator import ReActState
+
+                    payload = ReActState.model_validate(payload)
+                elif event_type == "response":
+                    from react_coordinator import AgentResponse
+
+                    payload = AgentResponse.model_validate(payload)
+                yield StreamEvent(event_type, data.get("content", ""), payload)
+
+
+def export_url(session: str, base_url: str = AGENT_SERVICE_PUBLIC_URL) -> str:
+    """Ссылка на JSONL-выгрузку журнала сессии: браузер скачивает её с сервиса потоком, минуя Streamlit."""
+    from urllib.parse import urlencode
+
+    return f"{base_url}/v1/runs/export?{urlencode({'session': session})}"
+
+
+async def start_export_server(journal: Any, port: int = EXPORT_PORT, host: str = "0.0.0.0"):
+    """Только GET /v1/runs/export над журналом процесса — для приложения, работающего без сервиса.
+    Запускать в общем фоновом event loop, как start_metrics_server."""
+    from aiohttp import web
+
+    app = web.Application()
+    app["journal"] = journal
+    app.router.add_get("/v1/runs/export", export_runs)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+def remote_forget(session: str, base_url: str = AGENT_SERVICE_URL) -> None:
+    """Тонкий клиент: очищает память диалога сессии на сервисе."""
+    import httpx
+
+    httpx.delete(f"{base_url}/v1/memory", params={"session": session}, timeout=10.0).raise_for_status()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Headless HTTP-сервис мульти-агентной системы")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--workers", type=int, default=SERVICE_WORKERS)
+    args = parser.parse_args()
+    if args.workers > 1:
+        serve_workers(args.workers, args.host, args.port)
+    else:
+        serve(args.host, args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+# session_memory.py
+"""Память диалога сессии с жёстким бюджетом токенов и фоновым сжатием старых реплик.
+
+Память сессии — краткое содержание (summary) и последние реплики целиком. В промпт агента
+она попадает между системным промптом и вопросом (плейсхолдер {history}):
+
+    system-промпт агента | содержание разговора | последние реплики | текущий вопрос
+
+Пока содержание не меняется, префикс «system + содержание + прежние реплики» у соседних
+запросов побайтно совпадает, и prefix cache сервера (vLLM) переиспользует его prefill.
+Когда реплики занимают больше 3/4 бюджета, самые старые сворачиваются в содержание фоновой
+задачей в общем event loop — ответ пользователю её не ждёт. Сжатие идёт пачкой, до половины
+бюджета, поэтому содержание (и с ним префикс) меняется редко. До конца сжатия в промпт
+попадают только новые реплики, которые укладываются в бюджет.
+
+Память хранится в SQLite (SESSION_MEMORY_PATH), общей для воркеров сервиса и перезапусков
+Streamlit; пустой путь — только в памяти процесса. SESSION_MEMORY_ENABLED=0 отключает память.
+"""
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:  # langchain импортируется лениво, при первом обращении к памяти
+    from langchain_core.messages import BaseMessage
+
+SESSION_MEMORY_ENABLED = os.getenv("SESSION_MEMORY_ENABLED", "1") == "1"
+SESSION_MEMORY_PATH = os.getenv("SESSION_MEMORY_PATH", "session_memory.sqlite3")
+# Бюджет истории в промпте: содержание + последние реплики
+MEMORY_MAX_TOKENS = int(os.getenv("MEMORY_MAX_TOKENS", "2048"))
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "384"))
+# Длиннее этого реплика хранится обрезанной: один большой ответ не вытесняет всю историю
+MEMORY_TURN_TOKENS = int(os.getenv("MEMORY_TURN_TOKENS", "512"))
+# Сессии без обращений дольше срока удаляются при открытии; 0 — хранить всё
+MEMORY_TTL_DAYS = float(os.getenv("MEMORY_TTL_DAYS", "7"))
+# Оценка токенов по символам, как estimate_tokens в react_coordinator
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARK = " […]"
+
+SUMMARY_PREFIX = "Краткое содержание предыдущего разговора с пользователем:\n"
+SUMMARIZER_MESSAGES = [
+    ("system", """Ты ведёшь краткое содержание диалога пользователя с ассистентом.
+    Дополни текущее содержание новыми репликами: сохрани темы, найденные статьи и ссылки,
+    названия, принятые решения, имена функций и классов из кода и открытые вопросы.
+    Пиши сжато, не длиннее {words} слов, без вступлений и без пересказа кода целиком."""),
+    ("human", "Текущее содержание:\n{summary}\n\nНовые реплики:\n{turns}")
+]
+
+logger = logging.getLogger(__name__)
+
+
+def _tokens(text: str) -> int:
+    return max(1, len(text) // CHARS_PER_TOKEN) if text else 0
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[:limit - len(TRUNCATION_MARK)].rstrip() + TRUNCATION_MARK
+
+
+@dataclass
+class Turn:
+    seq: int
+    question: str
+    answer: str
+
+    @property
+    def tokens(self) -> int:
+        return _tokens(self.question) + _tokens(self.answer)
+
+
+@dataclass
+class SessionState:
+    """Снимок памяти сессии; version растёт при каждой смене содержания."""
+    summary: str = ""
+    version: int = 0
+    turns: List[Turn] = field(default_factory=list)
+
+    @property
+    def turn_tokens(self) -> int:
+        return sum(turn.tokens for turn in self.turns)
+
+
+@dataclass
+class MemoryContext:
+    """История для промпта: сообщения и их оценка в токенах."""
+    messages: List["BaseMessage"]
+    tokens: int
+    turns: int
+    summarized: bool
+
+    def describe(self) -> str:
+        summary = "с содержанием" if self.summarized else "без содержания"
+        return f"память сессии: {self.turns} реплик {summary}, ~{self.tokens} токенов"
+
+
+class SessionMemory:
+    """Память сессий в SQLite; изменения идут транзакциями, поэтому память общая для процессов."""
+
+    def __init__(self, llm=None, path: Optional[str] = SESSION_MEMORY_PATH, max_tokens: int = MEMORY_MAX_TOKENS,
+                 summary_tokens: int = MEMORY_SUMMARY_TOKENS, turn_tokens: int = MEMORY_TURN_TOKENS,
+                 ttl_days: float = MEMORY_TTL_DAYS):
+        self._llm = llm
+        self.max_tokens = max_tokens
+        self.summary_tokens = summary_tokens
+        self.turn_tokens = turn_tokens
+        # Бюджет реплик — всё, что не занято содержанием
+        self.turn_budget = max(max_tokens - summary_tokens, turn_tokens)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path or ":memory:", check_same_thread=False, isolation_level=None)
+        if path:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions ("
+            "session TEXT PRIMARY KEY, summary TEXT NOT NULL, version INTEGER NOT NULL, "
+            "turns TEXT NOT NULL, next_seq INTEGER NOT NULL, updated REAL NOT NULL)"
+        )
+        self._compacting: Set[str] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self._summarizer = None
+        if ttl_days > 0:
+            self.prune(time.time() - ttl_days * 86400)
+
+    # --- хранилище ---
+
+    def _read(self, session: str) -> Tuple[SessionState, int]:
+        row = self._db.execute(
+            "SELECT summary, version, turns, next_seq FROM sessions WHERE session = ?", (session,)
+        ).fetchone()
+        if row is None:
+            return SessionState(), 1
+        turns = [Turn(*turn) for turn in json.loads(row[2])]
+        return SessionState(summary=row[0], version=row[1], turns=turns), row[3]
+
+    def _write(self, session: str, state: SessionState, next_seq: int) -> None:
+        turns = json.dumps([[turn.seq, turn.question, turn.answer] for turn in state.turns], ensure_ascii=False)
+        self._db.execute(
+            "INSERT OR REPLACE INTO sessions (session, summary, version, turns, next_seq, updated) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (session, state.summary, state.version, turns, next_seq, time.time()),
+        )
+
+    def state(self, session: str) -> SessionState:
+        with self._lock:
+            return self._read(session)[0]
+
+    def forget(self, session: str) -> None:
+        with self._lock:
+            self._db.execute("DELETE FROM sessions WHERE session = ?", (session,))
+
+    def prune(self, before: float) -> int:
+        """Удаляет сессии, не обновлявшиеся с момента before."""
+        with self._lock:
+            return self._db.execute("DELETE FROM sessions WHERE updated < ?", (before,)).rowcount
+
+    # --- промпт ---
+
+    def context(self, session: str) -> MemoryContext:
+        """История сессии для плейсхолдера {history}, не длиннее max_tokens."""
+        from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+        state = self.state(session)
+        messages: List[Any] = []
+        tokens = 0
+        if state.summary:
+            # Отдельное сообщение сразу после системного промпта: меняется только при сжатии
+            messages.append(SystemMessage(SUMMARY_PREFIX + state.summary))
+            tokens = _tokens(SUMMARY_PREFIX + state.summary)
+        # Самые новые реплики, которые помещаются в бюджет; старые ждут фонового сжатия
+        window: List[Turn] = []
+        for turn in reversed(state.turns):
+            if tokens + turn.tokens > self.max_tokens:
+                break
+            window.append(turn)
+            tokens += turn.tokens
+        for turn in reversed(window):
+            messages.extend([HumanMessage(turn.question), AIMessage(turn.answer)])
+        return MemoryContext(messages=messages, tokens=tokens, turns=len(window), summarized=bool(state.summary))
+
+    # --- запись и сжатие ---
+
+    def remember(self, session: str, question: str, answer: str) -> None:
+        """Добавляет реплику и, если реплики переросли бюджет, запускает фоновое сжатие."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                state, next_seq = self._read(session)
+                state.turns.append(Turn(next_seq, _truncate(question.strip(), self.turn_tokens),
+                                        _truncate(answer.strip(), self.turn_tokens)))
+                # Если сжатие долго не удаётся (модель недоступна), старейшие реплики отбрасываются
+                while len(state.turns) > 1 and state.turn_tokens > 2 * self.turn_budget:
+                    state.turns.pop(0)
+                self._write(session, state, next_seq + 1)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        if state.turn_tokens > self.turn_budget * 3 // 4:
+            self._schedule_compaction(session)
+
+    def _schedule_compaction(self, session: str) -> None:
+        from llm_provider import get_background_loop
+
+        # Пустой контекст: сжатие не наследует отмену и сессию планировщика вызвавшего запуска
+        get_background_loop().call_soon_threadsafe(self._start_compaction, session, context=contextvars.Context())
+
+    def _start_compaction(self, session: str) -> None:
+        if session in self._compacting:
+            return
+        self._compacting.add(session)
+        task = asyncio.get_running_loop().create_task(self._compact(session))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def _fold(self, state: SessionState) -> List[Turn]:
+        """Старейшие реплики, после сворачивания которых остальные занимают не больше половины бюджета."""
+        remaining = state.turn_tokens
+        folded: List[Turn] = []
+        for turn in state.turns[:-1]:
+            if remaining <= self.turn_budget // 2:
+                break
+            folded.append(turn)
+            remaining -= turn.tokens
+        return folded
+
+    @property
+    def summarizer(self):
+        if self._summarizer is None:
+            from langchain_core.prompts import ChatPromptTemplate
+            from thinking import ThinkFilter, with_thinking
+
+            llm = self._llm
+            if llm is None:
+                from llm_provider import get_llm
+                llm = get_llm()
+            # Содержание пишется без рассуждений и не длиннее своего бюджета
+            model = with_thinking(llm, "summarizer").bind(max_tokens=self.summary_tokens)
+            self._summarizer = ChatPromptTemplate.from_messages(SUMMARIZER_MESSAGES) | model | ThinkFilter()
+        return self._summarizer
+
+    async def _compact(self, session: str) -> None:
+        from llm_scheduler import Priority, scheduling
+        from tracing import get_tracer, stage_config
+
+        try:
+            state = await asyncio.to_thread(self.state, session)
+            folded = self._fold(state)
+            if not folded:
+                return
+            turns = "\n\n".join(f"Пользователь: {turn.question}\nАссистент: {turn.answer}" for turn in folded)
+            inputs = {"summary": state.summary or "(пусто)", "turns": turns, "words": self.summary_tokens // 2}
+            with scheduling(session=session, priority=Priority.BATCH), get_tracer().span("memory", turns=len(folded)):
+                summary = await self.summarizer.ainvoke(inputs, stage_config("memory"))
+            summary = _truncate(summary.strip(), self.summary_tokens)
+            if summary:
+                await asyncio.to_thread(self._apply, session, state.version, folded[-1].seq, summary)
+        except Exception:
+            # Реплики остаются несжатыми; следующая реплика сессии повторит попытку
+            logger.exception("Session memory compaction failed for %s", session)
+        finally:
+            self._compacting.discard(session)
+
+    def _apply(self, session: str, version: int, last_seq: int, summary: str) -> None:
+        """Заменяет свёрнутые реплики содержанием, если за время сжатия его не поменял другой процесс."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                state, next_seq = self._read(session)
+                if state.version == version:
+                    state.summary = summary
+                    state.version += 1
+                    state.turns = [turn for turn in state.turns if turn.seq > last_seq]
+                    self._write(session, state, next_seq)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+
+@lru_cache(maxsize=None)
+def get_session_memory() -> Optional[SessionMemory]:
+    """Общая память сессий процесса; None, если SESSION_MEMORY_ENABLED=0."""
+    return SessionMemory() if SESSION_MEMORY_ENABLED else None
+
+
+def memory_context(session_id: Optional[str]) -> Optional[MemoryContext]:
+    """История сессии для промпта; None без сессии, с отключённой памятью или пустой историей."""
+    memory = get_session_memory() if session_id else None
+    if memory is None:
+        return None
+    context = memory.context(session_id)
+    return context if context.messages else None
+
+
+def remember_turn(session_id: Optional[str], question: str, answer: Optional[str]) -> None:
+    memory = get_session_memory() if session_id else None
+    if memory is not None and answer and answer.strip():
+        memory.remember(session_id, question, answer)
+
+
+async def amemory_context(session_id: Optional[str]) -> Optional[MemoryContext]:
+    """memory_context для async-кода: SQLite читается в потоке, и ожидание блокировки БД
+    другим воркером не останавливает event loop."""
+    if not session_id:
+        return None
+    return await asyncio.to_thread(memory_context, session_id)
+
+
+async def aremember_turn(session_id: Optional[str], question: str, answer: Optional[str]) -> None:
+    if session_id:
+        await asyncio.to_thread(remember_turn, session_id, question, answer)
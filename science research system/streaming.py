@@ -0,0 +1,185 @@
+# streaming.py
+"""События потоковой выдачи агентов и мост async-генераторов в синхронный Streamlit.
+
+Запуски (start_run) — отменяемые задачи фонового loop с ключом сессии: cancel_run или новый
+запуск той же сессии отменяет задачу, asyncio.CancelledError доходит до ожидающего
+ainvoke/astream, и HTTP-запрос к модели прерывается, а не догенерирует ненужный ответ.
+"""
+import asyncio
+import concurrent.futures
+import contextvars
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional
+
+from llm_provider import get_background_loop
+
+_EXHAUSTED = object()
+
+
+@dataclass
+class StreamEvent:
+    """Событие потока: "log" — шаг рассуждений/лог, "token" — фрагмент ответа,
+    "response" — завершённая итерация ReAct, "state" — итог."""
+    type: str
+    content: str = ""
+    payload: Any = None
+
+
+def iterate_sync(stream: AsyncIterator[Any]) -> Iterator[Any]:
+    """Отдаёт элементы async-генератора по мере поступления в синхронном коде (скрипт Streamlit).
+
+    Генератор исполняется в общем фоновом event loop, поэтому пул HTTP-соединений
+    LLM-клиента переиспользуется между запросами.
+    """
+    loop = get_background_loop()
+
+    async def next_item() -> Any:
+        try:
+            return await stream.__anext__()
+        except StopAsyncIteration:
+            return _EXHAUSTED
+
+    try:
+        while True:
+            item = asyncio.run_coroutine_threadsafe(next_item(), loop).result()
+            if item is _EXHAUSTED:
+                break
+            yield item
+    finally:
+        asyncio.run_coroutine_threadsafe(stream.aclose(), loop).result()
+
+
+# Обработчики отмены текущего запуска. Список общий для всех задач запуска: langchain
+# исполняет шаги цепочки в дочерних задачах с копией контекста, и ссылка на список копируется
+_cancel_callbacks: contextvars.ContextVar[Optional[List[Callable[[], Awaitable[None]]]]] = contextvars.ContextVar(
+    "run_cancel_callbacks", default=None)
+
+
+def on_run_cancel(callback: Callable[[], Awaitable[None]]) -> Callable[[], None]:
+    """Регистрирует корутину, которую запуск выполнит при отмене; возвращает функцию снятия.
+
+    Нужно для потоков, приостановленных на yield в момент отмены: langchain не закрывает
+    их при исключении, и без обработчика HTTP-запрос к модели остался бы открытым.
+    Вне запуска (start_run, consume) — no-op.
+    """
+    callbacks = _cancel_callbacks.get()
+    if callbacks is None:
+        return lambda: None
+    callbacks.append(callback)
+
+    def remove() -> None:
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    return remove
+
+
+async def consume(stream: AsyncIterator[Any], sink: Callable[[Any], Optional[Awaitable[None]]]) -> None:
+    """Передаёт события потока в sink (обычную функцию или корутину) в рамках одного запуска.
+
+    При отмене выполняются обработчики on_run_cancel, затем CancelledError пробрасывается;
+    поток закрывается в любом случае. Используется start_run и HTTP-сервисом (service.py).
+    """
+    callbacks: List[Callable[[], Awaitable[None]]] = []
+    token = _cancel_callbacks.set(callbacks)
+    try:
+        async for event in stream:
+            result = sink(event)
+            if asyncio.iscoroutine(result):
+                await result
+    except asyncio.CancelledError:
+        for callback in list(callbacks):
+            try:
+                await callback()
+            except Exception:
+                pass
+        raise
+    finally:
+        _cancel_callbacks.reset(token)
+        await stream.aclose()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class Run:
+    """Запуск async-генератора событий в фоновом loop; события копятся в очереди для потребителя."""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.events: "queue.Queue[Any]" = queue.Queue()
+        self.future: Optional[concurrent.futures.Future] = None
+        self.cancelled = False
+
+    async def _pump(self, stream: AsyncIterator[Any]) -> None:
+        try:
+            await consume(stream, self.events.put)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        except Exception as e:
+            self.events.put(_Failure(e))
+        finally:
+            with _runs_lock:
+                if _runs.get(self.key) is self:
+                    del _runs[self.key]
+
+    @property
+    def done(self) -> bool:
+        return self.future is not None and self.future.done()
+
+    def cancel(self) -> None:
+        # Отмена concurrent-future переносится на задачу в loop: CancelledError в текущем await
+        if self.future is not None and not self.future.done():
+            self.cancelled = True
+            self.future.cancel()
+
+
+_runs: Dict[str, Run] = {}
+_runs_lock = threading.Lock()
+
+
+def start_run(key: str, stream: AsyncIterator[Any]) -> Run:
+    """Запускает поток событий как задачу фонового loop; прежний запуск с тем же ключом отменяется.
+
+    contextvars вызывающего потока (например, scheduling() планировщика LLM) копируются в задачу.
+    """
+    run = Run(key)
+    with _runs_lock:
+        previous = _runs.get(key)
+        _runs[key] = run
+    if previous is not None:
+        previous.cancel()
+    run.future = asyncio.run_coroutine_threadsafe(run._pump(stream), get_background_loop())
+    # Конец потока отмечается и тогда, когда задачу отменили до первого шага
+    run.future.add_done_callback(lambda _: run.events.put(_EXHAUSTED))
+    return run
+
+
+def cancel_run(key: str) -> bool:
+    """Отменяет активный запуск сессии; False — отменять нечего."""
+    with _runs_lock:
+        run = _runs.pop(key, None)
+    if run is None or run.done:
+        return False
+    run.cancel()
+    return True
+
+
+def iterate_run(run: Run) -> Iterator[Any]:
+    """События запуска в синхронном коде. Если потребитель ушёл (перезапуск скрипта Streamlit,
+    исключение при отрисовке), запуск отменяется: его результат всё равно никто не увидит."""
+    try:
+        while True:
+            item = run.events.get()
+            if item is _EXHAUSTED:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        run.cancel()
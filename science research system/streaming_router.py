@@ -0,0 +1,183 @@
+# streaming_router.py
+"""Потоковый LLM-маршрутизатор с ранним выходом.
+
+Ответ маршрутизатора читается по мере генерации: как только значение next_agent
+полностью декодировано, поток закрывается (HTTP-запрос к модели прерывается),
+а метка сводится к AgentType нечётким сопоставлением — опечатки вроде
+"science reaserch" больше не уводят в запасной маршрут по ключевым словам.
+Если эндпоинт поддерживает response_format=json_schema, вывод модели
+ограничивается enum-ом меток, и она выдаёт всего несколько токенов.
+"""
+import difflib
+import json
+import os
+import re
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Optional
+
+from agent_factory import AgentType
+
+if TYPE_CHECKING:
+    from response_cache import ResponseCache
+
+# "stream" — потоковый разбор с ранним выходом; "json" — полный ответ + JsonOutputParser
+ROUTER_MODE = os.getenv("ROUTER_MODE", "stream")
+# "auto" — пробовать json_schema и отключить при отказе эндпоинта; "1"/"0" — принудительно
+ROUTER_STRUCTURED_OUTPUT = os.getenv("ROUTER_STRUCTURED_OUTPUT", "auto")
+LABEL_MATCH_CUTOFF = 0.75
+
+# Канонические метки маршрутизатора для каждого типа агента
+ROUTER_LABELS = {
+    AgentType.RESEARCH: "science research",
+    AgentType.CODING: "coding",
+    AgentType.WRITING: "writing",
+}
+
+LABEL_ALIASES: Dict[str, AgentType] = {
+    "science research": AgentType.RESEARCH,
+    "scientific research": AgentType.RESEARCH,
+    "research": AgentType.RESEARCH,
+    "researcher": AgentType.RESEARCH,
+    "science": AgentType.RESEARCH,
+    "literature": AgentType.RESEARCH,
+    "coding": AgentType.CODING,
+    "code": AgentType.CODING,
+    "coder": AgentType.CODING,
+    "programming": AgentType.CODING,
+    "writing": AgentType.WRITING,
+    "writer": AgentType.WRITING,
+    "explanation": AgentType.WRITING,
+}
+
+_NON_WORD_RE = re.compile(r"[^a-zа-яё]+")
+_NEXT_AGENT_RE = re.compile(r'["\']next_agent["\']\s*:\s*"((?:[^"\\]|\\.)*)"')
+_KEY = "next_agent"
+
+
+def normalize_label(label: str) -> str:
+    return _NON_WORD_RE.sub(" ", label.lower()).strip()
+
+
+def match_agent_label(label: str) -> Optional[AgentType]:
+    """Сводит метку к AgentType: точное совпадение, ближайший алиас, затем отдельные слова метки."""
+    normalized = normalize_label(label)
+    if not normalized:
+        return None
+    if normalized in LABEL_ALIASES:
+        return LABEL_ALIASES[normalized]
+    for candidate in [normalized] + normalized.split():
+        close = difflib.get_close_matches(candidate, LABEL_ALIASES, n=1, cutoff=LABEL_MATCH_CUTOFF)
+        if close:
+            return LABEL_ALIASES[close[0]]
+    return None
+
+
+class NextAgentScanner:
+    """Инкрементальный разбор потока: возвращает next_agent, как только строка значения закрыта.
+
+    Текст до JSON (рассуждения, вступление модели) пропускается; повторно просматривается
+    только хвост буфера, на котором мог начаться ключ.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self._search_from = 0
+
+    def feed(self, chunk: str) -> Optional[str]:
+        self.buffer += chunk
+        match = _NEXT_AGENT_RE.search(self.buffer, self._search_from)
+        if match:
+            return json.loads(f'"{match.group(1)}"')
+        key_start = self.buffer.rfind(_KEY, self._search_from)
+        self._search_from = max(0, key_start - 1 if key_start >= 0 else len(self.buffer) - len(_KEY) - 1)
+        return None
+
+
+def routing_response_format() -> Dict[str, Any]:
+    """JSON Schema для constrained decoding: только next_agent из enum канонических меток."""
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "routing_decision",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {"next_agent": {"type": "string", "enum": list(ROUTER_LABELS.values())}},
+                "required": ["next_agent"],
+                "additionalProperties": False,
+            },
+        },
+    }
+
+
+def _structured_output_unsupported(error: Exception) -> bool:
+    # vLLM/OpenAI-совместимые серверы без guided decoding отвечают 400/422 на response_format
+    return getattr(error, "status_code", None) in (400, 404, 422)
+
+
+class StreamingRouter:
+    """Маршрутизатор поверх общего LLM-клиента; решения кэшируются тем же ключом, что и router_chain."""
+
+    def __init__(self, llm, prompt, cache: Optional["ResponseCache"] = None, model_name: str = "",
+                 structured_output: str = ROUTER_STRUCTURED_OUTPUT,
+                 on_decision: Optional[Callable[[str, Dict[str, str]], Awaitable[None]]] = None):
+        self.prompt = prompt
+        self.plain_chain = prompt | llm
+        self.structured_chain = prompt | llm.bind(response_format=routing_response_format())
+        self.structured = structured_output != "0"
+        self.structured_forced = structured_output == "1"
+        self.cache = cache
+        # Вызывается только для решений, полученных от модели (не из кэша)
+        self.on_decision = on_decision
+        self._cache_tag = None
+        if cache is not None:
+            from response_cache import prompt_fingerprint
+            self._cache_tag = ("router", prompt_fingerprint(prompt), model_name)
+
+    async def aroute(self, question: str, config: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+        """Возвращает {"next_agent": каноническая метка, "reason": ...}; ValueError, если метку не распознать."""
+        key = self.cache.make_key(question, *self._cache_tag) if self.cache is not None else None
+        if key is not None:
+            # Чтение и запись SQLite-уровня кэша идут в потоке: aroute вызывается из event loop
+            cached = await self.cache.aget(key)
+            if cached is not None:
+                return cached
+
+        decision = None
+        if self.structured:
+            try:
+                decision = await self._stream(self.structured_chain, question, config, "structured output")
+            except Exception as e:
+                if self.structured_forced or not _structured_output_unsupported(e):
+                    raise
+                # Эндпоинт не поддерживает response_format — дальше только потоковый разбор
+                self.structured = False
+        if decision is None:
+            decision = await self._stream(self.plain_chain, question, config, "early exit")
+
+        if key is not None:
+            await self.cache.aset(key, decision)
+        if self.on_decision is not None:
+            await self.on_decision(question, decision)
+        return decision
+
+    async def _stream(self, chain, question: str, config: Optional[Dict[str, Any]], mode: str) -> Dict[str, str]:
+        from thinking import ThinkScanner
+
+        scanner = NextAgentScanner()
+        # Рассуждение модели может упоминать next_agent — разбирается только текст вне <think>
+        think = ThinkScanner()
+        label = None
+        stream = chain.astream({"question": question}, config)
+        try:
+            async for chunk in stream:
+                label = scanner.feed(think.feed(chunk.content if isinstance(chunk.content, str) else ""))
+                if label is not None:
+                    break
+        finally:
+            # Ранний выход: закрытие генератора прерывает HTTP-поток, остаток ответа не генерируется
+            await stream.aclose()
+
+        agent = match_agent_label(label) if label is not None else None
+        if agent is None:
+            raise ValueError(f"Router reply has no recognizable next_agent: {scanner.buffer[:200]!r}")
+        return {"next_agent": ROUTER_LABELS[agent], "reason": f"Streaming router ({mode}): {label!r}"}
@@ -0,0 +1,192 @@
+# task_graph.py
+"""Декомпозиция составных запросов в DAG подзадач и его исполнение через LangGraph.
+
+Независимые ветви DAG выполняются в одном супершаге графа параллельно,
+поэтому время ответа близко к самой длинной ветви, а не к сумме всех.
+"""
+import operator
+import re
+from typing import Annotated, Any, Dict, List, Optional
+
+from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langgraph.graph import END, START, StateGraph
+from pydantic import BaseModel, Field
+from typing_extensions import TypedDict
+
+from agent_factory import AgentType
+from keyword_router import get_keyword_router, is_composite  # noqa: F401 (реэкспорт)
+from thinking import ThinkFilter, with_thinking
+from tracing import agent_stage, get_tracer, stage_config
+
+DECOMPOSE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", """You split a user request into sub-tasks for three agents: 'research' (scientific literature),
+'coding' (writing code) and 'writing' (explanations). Keep the plan minimal: one task per agent unless the request
+clearly needs more. A task depends on another only if it needs its result.
+Respond with JSON only: {{"tasks": [{{"id": "t1", "agent": "research", "task": "...", "depends_on": []}}]}}"""),
+    # История сессии (session_memory.py): уточняющий запрос планируется с учётом прежних реплик
+    MessagesPlaceholder("history", optional=True),
+    ("human", "User request: {question}")
+])
+
+# Ссылки на результат предыдущего шага («на основе найденного», «using the results» ...)
+_DEPENDENCY_HINT_RE = re.compile(r"на основе|используя|найденн|из обзора|based on|using the|from the research|found", re.IGNORECASE)
+_SENTENCE_RE = re.compile(r"(?<=[.!?])\s+")
+# id подзадачи становится именем узла графа: без символов, зарезервированных langgraph (":", "|"),
+# и без имён служебных узлов
+_TASK_ID_RE = re.compile(r"^[A-Za-z0-9_-]{1,32}$")
+WRITER_NODE = "writer"
+_RESERVED_IDS = {WRITER_NODE, START, END}
+
+
+class SubTask(BaseModel):
+    id: str
+    agent: AgentType
+    task: str
+    depends_on: List[str] = Field(default_factory=list)
+
+
+class TaskPlan(BaseModel):
+    tasks: List[SubTask]
+
+    def validate_dag(self) -> "TaskPlan":
+        """Проверяет допустимость и уникальность id, существование зависимостей и отсутствие циклов."""
+        ids = [task.id for task in self.tasks]
+        if not ids or len(ids) != len(set(ids)):
+            raise ValueError("Идентификаторы подзадач должны быть уникальны")
+        invalid = [task_id for task_id in ids if task_id in _RESERVED_IDS or not _TASK_ID_RE.match(task_id)]
+        if invalid:
+            raise ValueError(f"Недопустимые идентификаторы подзадач: {invalid}")
+        known = set(ids)
+        for task in self.tasks:
+            missing = set(task.depends_on) - known
+            if missing or task.id in task.depends_on:
+                raise ValueError(f"Некорректные зависимости подзадачи {task.id}: {task.depends_on}")
+        resolved: set = set()
+        pending = {task.id: set(task.depends_on) for task in self.tasks}
+        while pending:
+            ready = [task_id for task_id, deps in pending.items() if deps <= resolved]
+            if not ready:
+                raise ValueError("Зависимости подзадач образуют цикл")
+            for task_id in ready:
+                resolved.add(task_id)
+                del pending[task_id]
+        return self
+
+
+class TaskGraphState(TypedDict):
+    query: str
+    history: List[Any]
+    results: Annotated[Dict[str, str], operator.or_]
+    answer: str
+
+
+def heuristic_plan(query: str) -> TaskPlan:
+    """Запасная декомпозиция без LLM: предложения группируются по агенту из keyword_router."""
+    router = get_keyword_router()
+    tasks: List[SubTask] = []
+    for sentence in filter(None, (part.strip() for part in _SENTENCE_RE.split(query))):
+        agent = router.route(sentence).agent
+        if tasks and tasks[-1].agent == agent:
+            tasks[-1].task += " " + sentence
+            continue
+        depends_on = [task.id for task in tasks] if _DEPENDENCY_HINT_RE.search(sentence) else []
+        tasks.append(SubTask(id=f"t{len(tasks) + 1}", agent=agent, task=sentence, depends_on=depends_on))
+    if not tasks:
+        tasks.append(SubTask(id="t1", agent=router.route(query).agent, task=query))
+    return TaskPlan(tasks=tasks).validate_dag()
+
+
+def _inputs(question: str, history: List[Any]) -> Dict[str, Any]:
+    """Вход агента; пустая история не передаётся, чтобы ответы без неё по-прежнему кэшировались."""
+    return {"question": question, "history": history} if history else {"question": question}
+
+
+class TaskGraphRunner:
+    """Строит по плану StateGraph: узел на подзадачу, рёбра по зависимостям, итоговый узел writer."""
+
+    def __init__(self, agents: Dict[AgentType, Any], llm_client=None):
+        self.agents = agents
+        self.decompose_chain = None
+        if llm_client is not None:
+            # Планировщик отвечает JSON без рассуждений
+            self.decompose_chain = DECOMPOSE_PROMPT | with_thinking(llm_client, "planner") | ThinkFilter() | JsonOutputParser()
+
+    async def plan(self, query: str, log=None, history: Optional[List[Any]] = None) -> TaskPlan:
+        if self.decompose_chain is not None:
+            try:
+                with get_tracer().span("planner"):
+                    plan = await self.decompose_chain.ainvoke(_inputs(query, history or []), stage_config("planner"))
+                return TaskPlan(**plan).validate_dag()
+            except Exception as e:
+                if log is not None:
+                    log(f"[Planner] LLM decomposition failed, using heuristic plan: {e}")
+        return heuristic_plan(query)
+
+    def build_graph(self, plan: TaskPlan):
+        graph = StateGraph(TaskGraphState)
+        tasks_by_id = {task.id: task for task in plan.tasks}
+
+        for task in plan.tasks:
+            graph.add_node(task.id, self._task_node(task, tasks_by_id))
+            if task.depends_on:
+                # Список источников = узел ждёт завершения всех зависимостей
+                graph.add_edge(task.depends_on if len(task.depends_on) > 1 else task.depends_on[0], task.id)
+            else:
+                graph.add_edge(START, task.id)
+
+        graph.add_node(WRITER_NODE, self._writer_node(plan))
+        dependents = {dep for task in plan.tasks for dep in task.depends_on}
+        leaves = [task.id for task in plan.tasks if task.id not in dependents]
+        graph.add_edge(leaves if len(leaves) > 1 else leaves[0], WRITER_NODE)
+        graph.add_edge(WRITER_NODE, END)
+        return graph.compile()
+
+    def _task_node(self, task: SubTask, tasks_by_id: Dict[str, SubTask]):
+        agent = self.agents[task.agent]
+
+        async def run(state: TaskGraphState) -> Dict[str, Any]:
+            question = task.task
+            if task.depends_on:
+                context = "\n\n".join(
+                    f"[{tasks_by_id[dep].task}]\n{state['results'][dep]}" for dep in task.depends_on
+                )
+                question = f"{task.task}\n\nИспользуй результаты предыдущих шагов:\n{context}"
+            stage = agent_stage(task.agent)
+            with get_tracer().span(stage, task=task.id):
+                answer = await agent.ainvoke(_inputs(question, state["history"]), stage_config(stage))
+            return {"results": {task.id: answer}}
+
+        return run
+
+    def _writer_node(self, plan: TaskPlan):
+        writer = self.agents[AgentType.WRITING]
+
+        async def run(state: TaskGraphState) -> Dict[str, Any]:
+            results = state["results"]
+            if len(plan.tasks) == 1:
+                return {"answer": results[plan.tasks[0].id]}
+            sections = "\n\n".join(f"### {task.task}\n{results[task.id]}" for task in plan.tasks)
+            question = (
+                f"Объедини результаты подзадач в один структурированный ответ на запрос: {state['query']}\n"
+                f"Сохрани код и ссылки на источники без изменений.\n\n{sections}"
+            )
+            stage = agent_stage(AgentType.WRITING)
+            with get_tracer().span(stage, task="merge"):
+                answer = await writer.ainvoke(_inputs(question, state["history"]), stage_config(stage))
+            return {"answer": answer}
+
+        return run
+
+    async def arun(self, query: str, log=None, history: Optional[List[Any]] = None) -> Dict[str, Any]:
+        """Возвращает {"plan": TaskPlan, "results": {id: ответ}, "answer": итоговый ответ}.
+
+        history — сообщения памяти сессии: их видят планировщик, агенты подзадач и writer.
+        """
+        history = history or []
+        plan = await self.plan(query, log, history)
+        if log is not None:
+            for task in plan.tasks:
+                log(f"[Planner] {task.id} -> {task.agent.value} (after {task.depends_on or 'start'}): {task.task}")
+        final_state = await self.build_graph(plan).ainvoke({"query": query, "history": history, "results": {}, "answer": ""})
+        return {"plan": plan, "results": final_state["results"], "answer": final_state["answer"]}
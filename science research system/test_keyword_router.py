@@ -0,0 +1,81 @@
+# test_keyword_router.py
+"""Поведение маршрутизатора по ключевым словам: составные запросы и выбор агента."""
+import pytest
+
+from agent_factory import AgentType
+from keyword_router import KeywordAutomaton, get_keyword_router, is_composite
+
+
+@pytest.mark.parametrize("query", [
+    # Общие слова («search», «найди», «review») в вопросе о коде — не литературный поиск
+    "Implement binary search in Python",
+    "Write a Python function to search a list",
+    "Найди ошибку в коде",
+    "Review my Python code",
+    "Сделай анализ кода",
+])
+def test_coding_questions_with_generic_words_are_not_composite(query):
+    assert not is_composite(query)
+    assert get_keyword_router().route(query).agent == AgentType.CODING
+
+
+@pytest.mark.parametrize("query", [
+    "Find recent papers on multi-object tracking. Then write Python code implementing the tracker",
+    "Найди статьи по трекингу объектов и напиши код на Python",
+])
+def test_research_plus_code_is_composite(query):
+    assert is_composite(query)
+
+
+@pytest.mark.parametrize("query, agent", [
+    ("Найди статьи о трансформерах", AgentType.RESEARCH),
+    ("Search arxiv for diffusion models", AgentType.RESEARCH),
+    ("Сделай обзор литературы по GAN", AgentType.RESEARCH),
+    ("Объясни, что такое энтропия", AgentType.WRITING),
+])
+def test_single_agent_queries(query, agent):
+    assert not is_composite(query)
+    assert get_keyword_router().route(query).agent == agent
+
+
+def test_automaton_finds_overlapping_patterns():
+    automaton = KeywordAutomaton()
+    for pattern in ["he", "she", "his", "hers"]:
+        automaton.add(pattern)
+    matches = sorted((position, automaton.pattern(index)) for position, index in automaton.iter_matches("USHERS"))
+    assert matches == [(3, "he"), (3, "she"), (5, "hers")]
+
+
+@pytest.mark.parametrize("query, agent", [
+    # Отрицание снимает балл агента, хотя само слово («код», «литература») в запросе есть
+    ("Объясни сортировку слиянием без кода", AgentType.WRITING),
+    ("Explain quicksort, no code please", AgentType.WRITING),
+    ("Напиши код без обзора литературы", AgentType.CODING),
+])
+def test_negated_keywords(query, agent):
+    decision = get_keyword_router().route(query)
+    assert decision.agent == agent
+    assert not is_composite(query)
+
+
+@pytest.mark.parametrize("query, agent", [
+    # Короткие латинские термины внутри других слов не считаются
+    ("I trust you despite my frustration, explain why", AgentType.WRITING),
+    ("Explain the history of Minnesota", AgentType.WRITING),
+    ("Rewrite this javascript-free page", AgentType.WRITING),
+    ("Write Rust, please", AgentType.CODING),
+    ("What is SOTA in detection?", AgentType.RESEARCH),
+])
+def test_short_latin_terms_match_whole_words(query, agent):
+    assert get_keyword_router().route(query).agent == agent
+
+
+def test_rebuild_does_not_duplicate_matches():
+    automaton = KeywordAutomaton()
+    for pattern in ["he", "she"]:
+        automaton.add(pattern)
+    automaton.build()
+    automaton.add("hers")
+    automaton.build()
+    matches = sorted((position, automaton.pattern(index)) for position, index in automaton.iter_matches("USHERS"))
+    assert matches == [(3, "he"), (3, "she"), (5, "hers")]
@@ -0,0 +1,44 @@
+# test_task_graph.py
+"""План подзадач (task_graph.py): проверка DAG и запасной план при негодном ответе планировщика."""
+import asyncio
+
+import pytest
+from langchain_core.runnables import RunnableLambda
+
+from agent_factory import AgentType
+from task_graph import SubTask, TaskGraphRunner, TaskPlan
+
+QUERY = "Find recent papers on multi-object tracking. Then write Python code implementing the tracker"
+
+
+def _plan(*tasks):
+    return TaskPlan(tasks=[SubTask(id=task_id, agent=AgentType.CODING, task="x", depends_on=deps) for task_id, deps in tasks])
+
+
+@pytest.mark.parametrize("task_id", ["writer", "__start__", "__end__", "a:b", "a|b", "", "t 1"])
+def test_reserved_and_invalid_ids_are_rejected(task_id):
+    with pytest.raises(ValueError):
+        _plan((task_id, [])).validate_dag()
+
+
+@pytest.mark.parametrize("tasks", [
+    [("t1", []), ("t1", [])],
+    [("t1", ["t2"])],
+    [("t1", ["t2"]), ("t2", ["t1"])],
+])
+def test_broken_dependencies_are_rejected(tasks):
+    with pytest.raises(ValueError):
+        _plan(*tasks).validate_dag()
+
+
+def test_planner_ids_that_clash_with_graph_nodes_fall_back_to_heuristic_plan():
+    runner = TaskGraphRunner({agent: None for agent in AgentType})
+    runner.decompose_chain = RunnableLambda(lambda inputs: {"tasks": [
+        {"id": "writer", "agent": "research", "task": "Find papers", "depends_on": []},
+        {"id": "t2", "agent": "coding", "task": "Write code", "depends_on": ["writer"]},
+    ]})
+    logs = []
+    plan = asyncio.run(runner.plan(QUERY, logs.append))
+    assert [task.agent for task in plan.tasks] == [AgentType.RESEARCH, AgentType.CODING]
+    assert logs and "heuristic plan" in logs[0]
+    runner.build_graph(plan)
@@ -0,0 +1,60 @@
+# test_thinking.py
+"""Вырезание блоков <think> из потока ответа (thinking.py)."""
+import pytest
+
+from thinking import ThinkFilter, ThinkScanner, strip_think
+
+ANSWER = "<think>Нужно сравнить два подхода.</think>\n\nОтвет: второй подход быстрее."
+
+
+def _scan(chunks):
+    scanner = ThinkScanner()
+    visible = [scanner.feed(chunk) for chunk in chunks]
+    return "".join(visible) + scanner.flush(), scanner
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 7, len(ANSWER)])
+def test_tags_split_across_chunks(size):
+    text, scanner = _scan([ANSWER[i:i + size] for i in range(0, len(ANSWER), size)])
+    assert text == "Ответ: второй подход быстрее."
+    assert scanner.reasoning_chars == len("Нужно сравнить два подхода.")
+
+
+def test_reasoning_never_leaks_into_visible_chunks():
+    scanner = ThinkScanner()
+    chunks = ["<th", "ink>сек", "рет</th", "ink>ответ"]
+    assert [scanner.feed(chunk) for chunk in chunks] == ["", "", "", "ответ"]
+    assert scanner.flush() == ""
+
+
+def test_text_without_think_passes_through():
+    assert strip_think("a < b и <thin") == "a < b и <thin"
+
+
+def test_unclosed_think_is_not_shown():
+    assert strip_think("<think>рассуждение без конца") == ""
+
+
+def test_filter_streams_without_think():
+    chunks = ["<thi", "nk>план</thi", "nk>\n", "При", "вет"]
+    assert "".join(ThinkFilter().transform(iter(chunks))) == "Привет"
+    assert ThinkFilter().invoke("<think>план</think>Привет") == "Привет"
+
+
+@pytest.mark.parametrize("chunks, reasoning_tokens", [
+    (["<think></think>", "\n\n", "Ответ"], 0),
+    (["<think>", "план", "</think>", "Ответ"], 2),
+    (["<think>план</think>Ответ"], 1),
+])
+def test_tracing_closes_think_block_in_the_same_chunk(chunks, reasoning_tokens):
+    from uuid import uuid4
+
+    from tracing import get_callback_handler
+
+    handler, run_id = get_callback_handler(), uuid4()
+    handler.on_chat_model_start({}, [], run_id=run_id, metadata={"stage": "test"})
+    for chunk in chunks:
+        handler.on_llm_new_token(chunk, run_id=run_id)
+    run = handler._finish(run_id)
+    assert run["think"] == "closed"
+    assert run["reasoning_tokens"] == reasoning_tokens
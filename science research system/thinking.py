@@ -0,0 +1,312 @@
+# thinking.py
+"""Управление рассуждениями qwen3: enable_thinking, бюджет рассуждений и потоковый фильтр <think>.
+
+qwen3 перед ответом пишет рассуждение в блоке <think>…</think>. Для каждой роли задаётся
+политика: маршрутизатор, критик, планировщик, writing-агент и сжатие памяти сессии
+(session_memory.py) отвечают без рассуждений
+(chat_template_kwargs.enable_thinking=false), research и coding рассуждают в пределах бюджета.
+Когда рассуждение превышает бюджет, поток прерывается, и модель дописывает ответ
+продолжением того же сообщения ассистента с закрытым </think> (continue_final_message vLLM).
+ThinkFilter вырезает блоки <think> из потока на лету, не накапливая ответ целиком.
+
+Политика роли переопределяется THINKING_<РОЛЬ>: "off", "on" (без бюджета) или число токенов.
+"""
+import functools
+import operator
+import os
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional
+
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompt_values import PromptValue
+from langchain_core.runnables import Runnable, RunnableConfig
+
+# "auto" — только для моделей qwen3; "1"/"0" — принудительно включить/выключить управление
+THINKING_CONTROL = os.getenv("THINKING_CONTROL", "auto")
+THINK_OPEN, THINK_CLOSE = "<think>", "</think>"
+# Оценка токенов рассуждения по символам, как estimate_tokens в react_coordinator
+CHARS_PER_TOKEN = 4
+# Фраза, которой рекомендуемая для qwen3 схема бюджета обрывает рассуждение
+BUDGET_STOP_NOTE = ("\n\nConsidering the limited time by the user, I have to give the solution "
+                    "based on the thinking directly now.\n")
+
+
+@dataclass(frozen=True)
+class ThinkingPolicy:
+    enabled: bool = False
+    budget: Optional[int] = None  # токенов рассуждения; None — без ограничения
+
+    @classmethod
+    def parse(cls, value: str) -> "ThinkingPolicy":
+        value = value.strip().lower()
+        if value in ("off", "0", "false", "no"):
+            return cls(enabled=False)
+        if value in ("on", "true", "yes"):
+            return cls(enabled=True)
+        return cls(enabled=True, budget=int(value))
+
+
+DEFAULT_POLICIES: Dict[str, ThinkingPolicy] = {
+    "router": ThinkingPolicy(enabled=False),
+    "critic": ThinkingPolicy(enabled=False),
+    "planner": ThinkingPolicy(enabled=False),
+    "writing": ThinkingPolicy(enabled=False),
+    "summarizer": ThinkingPolicy(enabled=False),
+    "research": ThinkingPolicy(enabled=True, budget=1024),
+    "coding": ThinkingPolicy(enabled=True, budget=2048),
+}
+
+
+def thinking_policy(role: str) -> ThinkingPolicy:
+    override = os.getenv(f"THINKING_{role.upper()}")
+    if override:
+        return ThinkingPolicy.parse(override)
+    return DEFAULT_POLICIES.get(role, ThinkingPolicy(enabled=False))
+
+
+def thinking_control_enabled(model_name: str) -> bool:
+    if THINKING_CONTROL == "auto":
+        return "qwen3" in model_name.lower()
+    return THINKING_CONTROL == "1"
+
+
+def _template_kwargs(enabled: bool, **extra: Any) -> Dict[str, Any]:
+    return {"extra_body": dict({"chat_template_kwargs": {"enable_thinking": enabled}}, **extra)}
+
+
+def with_thinking(llm, role: str, model_name: Optional[str] = None):
+    """LLM с политикой рассуждений роли; без управления (не qwen3, THINKING_CONTROL=0) — исходный llm."""
+    if not thinking_control_enabled(model_name or getattr(llm, "model_name", "")):
+        return llm
+    policy = thinking_policy(role)
+    if policy.enabled and policy.budget:
+        return ThinkingBudgetModel(llm, policy.budget)
+    return llm.bind(**_template_kwargs(policy.enabled))
+
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """Длина хвоста text, который может оказаться началом tag в следующем фрагменте."""
+    for length in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:length]):
+            return length
+    return 0
+
+
+class ThinkScanner:
+    """Инкрементальный разбор потока: отделяет текст ответа от блоков <think>…</think>.
+
+    В буфере держится только хвост, который может быть началом тега; текст рассуждения
+    не копится, считается лишь его длина.
+    """
+
+    def __init__(self):
+        self.inside = False
+        self.reasoning_chars = 0
+        self.blocks = 0  # сколько блоков <think> открыто с начала потока
+        self._pending = ""
+        self._strip_leading = False
+
+    @property
+    def reasoning_tokens(self) -> int:
+        return self.reasoning_chars // CHARS_PER_TOKEN
+
+    def feed(self, text: str) -> str:
+        """Возвращает видимую часть фрагмента (возможно, пустую)."""
+        self._pending += text
+        visible: List[str] = []
+        while self._pending:
+            tag = THINK_CLOSE if self.inside else THINK_OPEN
+            index = self._pending.find(tag)
+            if index < 0:
+                keep = _partial_tag_length(self._pending, tag)
+                self._emit(self._pending[:len(self._pending) - keep], visible)
+                self._pending = self._pending[len(self._pending) - keep:]
+                break
+            self._emit(self._pending[:index], visible)
+            self._pending = self._pending[index + len(tag):]
+            self.inside = not self.inside
+            self.blocks += self.inside
+            # Ответ после </think> начинается с пустых строк — их не показываем
+            self._strip_leading = not self.inside
+        return self._visible(visible)
+
+    def flush(self) -> str:
+        """Конец потока: недописанный тег вне рассуждения — обычный текст."""
+        pending, self._pending = self._pending, ""
+        visible: List[str] = []
+        self._emit(pending, visible)
+        return self._visible(visible)
+
+    def _emit(self, segment: str, visible: List[str]) -> None:
+        if self.inside:
+            self.reasoning_chars += len(segment)
+        elif segment:
+            visible.append(segment)
+
+    def _visible(self, visible: List[str]) -> str:
+        text = "".join(visible)
+        if self._strip_leading and text:
+            text = text.lstrip()
+            self._strip_leading = not text
+        return text
+
+
+def strip_think(text: str) -> str:
+    scanner = ThinkScanner()
+    return scanner.feed(text) + scanner.flush()
+
+
+def _text(chunk: Any) -> str:
+    if isinstance(chunk, BaseMessage):
+        return chunk.content if isinstance(chunk.content, str) else ""
+    return chunk
+
+
+class ThinkFilter(StrOutputParser):
+    """StrOutputParser, который на лету вырезает блоки <think>…</think> из ответа модели."""
+
+    def parse(self, text: str) -> str:
+        return strip_think(text)
+
+    def _transform(self, input: Iterator[Any]) -> Iterator[str]:
+        scanner = ThinkScanner()
+        for chunk in input:
+            visible = scanner.feed(_text(chunk))
+            if visible:
+                yield visible
+        tail = scanner.flush()
+        if tail:
+            yield tail
+
+    async def _atransform(self, input: AsyncIterator[Any]) -> AsyncIterator[str]:
+        scanner = ThinkScanner()
+        async for chunk in input:
+            visible = scanner.feed(_text(chunk))
+            if visible:
+                yield visible
+        tail = scanner.flush()
+        if tail:
+            yield tail
+
+
+def _continuation_unsupported(error: Exception) -> bool:
+    # Сервер без continue_final_message отвечает 400/422 на неизвестные параметры
+    return getattr(error, "status_code", None) in (400, 404, 422)
+
+
+def _to_messages(input: Any) -> List[BaseMessage]:
+    if isinstance(input, PromptValue):
+        return input.to_messages()
+    if isinstance(input, str):
+        return [HumanMessage(input)]
+    return list(input)
+
+
+class ThinkingBudgetModel(Runnable):
+    """Модель с рассуждением в пределах бюджета токенов.
+
+    Пока рассуждение укладывается в бюджет, поток идёт без изменений. При превышении HTTP-поток
+    закрывается, а ответ дописывается продолжением: рассуждение закрывается BUDGET_STOP_NOTE
+    и </think>, и модель сразу пишет ответ. Если сервер не поддерживает продолжение,
+    ответ генерируется заново без рассуждений.
+    """
+
+    def __init__(self, llm, budget: int):
+        self.llm = llm
+        self.budget = budget
+        self.thinking = llm.bind(**_template_kwargs(True))
+        self.continuation = llm.bind(**_template_kwargs(True, continue_final_message=True, add_generation_prompt=False))
+        self.fallback = llm.bind(**_template_kwargs(False))
+        self.continuation_supported = True
+
+    @property
+    def model_name(self) -> str:
+        return getattr(self.llm, "model_name", "")
+
+    def bind(self, **kwargs: Any) -> "ThinkingBudgetModel":
+        bound = ThinkingBudgetModel(self.llm.bind(**kwargs), self.budget)
+        bound.continuation_supported = self.continuation_supported
+        return bound
+
+    def _continue(self, messages: List[BaseMessage], seen: List[str]) -> List[BaseMessage]:
+        # Рассуждение обрывается фразой бюджета и закрывается — модель продолжает уже ответом
+        return messages + [AIMessage("".join(seen) + BUDGET_STOP_NOTE + THINK_CLOSE + "\n\n")]
+
+    def _over_budget(self, scanner: ThinkScanner, seen: List[str], chunk: AIMessageChunk) -> bool:
+        """Учитывает фрагмент; True — рассуждение вышло за бюджет, поток пора прервать."""
+        text = _text(chunk)
+        seen.append(text)
+        scanner.feed(text)
+        return scanner.inside and scanner.reasoning_tokens > self.budget
+
+    def invoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> BaseMessage:
+        return functools.reduce(operator.add, self.stream(input, config, **kwargs))
+
+    async def ainvoke(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> BaseMessage:
+        return functools.reduce(operator.add, [chunk async for chunk in self.astream(input, config, **kwargs)])
+
+    def stream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> Iterator[AIMessageChunk]:
+        messages = _to_messages(input)
+        scanner, seen, exceeded = ThinkScanner(), [], False
+        stream = self.thinking.stream(messages, config, **kwargs)
+        try:
+            for chunk in stream:
+                if self._over_budget(scanner, seen, chunk):
+                    exceeded = True
+                    break
+                yield chunk
+        finally:
+            stream.close()
+        if not exceeded:
+            return
+        yield AIMessageChunk(content=BUDGET_STOP_NOTE + THINK_CLOSE + "\n\n")
+        if self.continuation_supported:
+            continued = False
+            try:
+                for chunk in self.continuation.stream(self._continue(messages, seen), config, **kwargs):
+                    continued = True
+                    yield chunk
+                return
+            except Exception as e:
+                if continued or not _continuation_unsupported(e):
+                    raise
+                self.continuation_supported = False
+        yield from self.fallback.stream(messages, config, **kwargs)
+
+    async def astream(self, input: Any, config: Optional[RunnableConfig] = None, **kwargs: Any) -> AsyncIterator[AIMessageChunk]:
+        messages = _to_messages(input)
+        scanner, seen, exceeded = ThinkScanner(), [], False
+        stream = self.thinking.astream(messages, config, **kwargs)
+        try:
+            async for chunk in stream:
+                if self._over_budget(scanner, seen, chunk):
+                    exceeded = True
+                    break
+                yield chunk
+        finally:
+            # Превышение бюджета, отмена или уход потребителя прерывают HTTP-поток модели
+            await stream.aclose()
+        if not exceeded:
+            return
+        yield AIMessageChunk(content=BUDGET_STOP_NOTE + THINK_CLOSE + "\n\n")
+        if self.continuation_supported:
+            continued = False
+            stream = self.continuation.astream(self._continue(messages, seen), config, **kwargs)
+            try:
+                async for chunk in stream:
+                    continued = True
+                    yield chunk
+                return
+            except Exception as e:
+                if continued or not _continuation_unsupported(e):
+                    raise
+                self.continuation_supported = False
+            finally:
+                await stream.aclose()
+        stream = self.fallback.astream(messages, config, **kwargs)
+        try:
+            async for chunk in stream:
+                yield chunk
+        finally:
+            await stream.aclose()
@@ -0,0 +1,346 @@
+# tracing.py
+"""Трассировка стадий обработки запроса: длительности, токены, время до первого токена.
+
+Спаны (routing, agent, critic, parsing, rendering, llm) попадают в скользящие
+гистограммы в памяти (сайдбар Streamlit), в текстовый формат Prometheus
+(`/metrics`) и, если задан TRACE_PATH, построчно в JSONL-файл трасс.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+# Файл трасс; пусто — трассы не пишутся (по умолчанию)
+TRACE_PATH = os.getenv("TRACE_PATH", "")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+ROLLING_WINDOW = int(os.getenv("METRICS_ROLLING_WINDOW", "500"))
+
+logger = logging.getLogger(__name__)
+
+# Границы бакетов гистограмм, секунды
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+class Histogram:
+    """Кумулятивные бакеты для Prometheus + скользящее окно для перцентилей."""
+
+    def __init__(self, buckets: Tuple[float, ...] = DURATION_BUCKETS, window: int = ROLLING_WINDOW):
+        self.buckets = buckets
+        self.bucket_counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.recent: Deque[float] = deque(maxlen=window)
+
+    def observe(self, value: float) -> None:
+        self.count += 1
+        self.total += value
+        self.recent.append(value)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.bucket_counts[index] += 1
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.durations: Dict[str, Histogram] = {}
+        self.ttft: Dict[str, Histogram] = {}
+        self.tokens: Dict[Tuple[str, str], int] = {}
+
+    def observe_duration(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.durations.setdefault(stage, Histogram()).observe(seconds)
+
+    def observe_ttft(self, stage: str, seconds: float) -> None:
+        with self._lock:
+            self.ttft.setdefault(stage, Histogram()).observe(seconds)
+
+    def add_tokens(self, stage: str, kind: str, count: int) -> None:
+        if count:
+            with self._lock:
+                self.tokens[(stage, kind)] = self.tokens.get((stage, kind), 0) + count
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Сводка по стадиям для отображения: число вызовов, p50/p95 (мс), токены."""
+        with self._lock:
+            rows = []
+            for stage, histogram in sorted(self.durations.items()):
+                ttft = self.ttft.get(stage)
+                rows.append({
+                    "stage": stage,
+                    "count": histogram.count,
+                    "p50_ms": _ms(histogram.percentile(50)),
+                    "p95_ms": _ms(histogram.percentile(95)),
+                    "ttft_p50_ms": _ms(ttft.percentile(50)) if ttft else None,
+                    "prompt_tokens": self.tokens.get((stage, "prompt"), 0),
+                    "completion_tokens": self.tokens.get((stage, "completion"), 0),
+                    "reasoning_tokens": self.tokens.get((stage, "reasoning"), 0),
+                })
+            return rows
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            lines: List[str] = []
+            for name, help_text, histograms in (
+                ("agent_stage_duration_seconds", "Duration of request processing stages", self.durations),
+                ("agent_llm_ttft_seconds", "Time to first token of LLM calls", self.ttft),
+            ):
+                lines += [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+                for stage, histogram in sorted(histograms.items()):
+                    for bound, count in zip(histogram.buckets, histogram.bucket_counts):
+                        lines.append(f'{name}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+                    lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{name}_sum{{stage="{stage}"}} {histogram.total}')
+                    lines.append(f'{name}_count{{stage="{stage}"}} {histogram.count}')
+            lines += ["# HELP agent_llm_tokens_total LLM tokens by stage", "# TYPE agent_llm_tokens_total counter"]
+            for (stage, kind), count in sorted(self.tokens.items()):
+                lines.append(f'agent_llm_tokens_total{{stage="{stage}",kind="{kind}"}} {count}')
+            return "\n".join(lines) + "\n"
+
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+class Tracer:
+    def __init__(self, registry: MetricsRegistry, trace_path: Optional[str] = TRACE_PATH):
+        self.registry = registry
+        self.trace_path = trace_path or None
+        # Строки трасс пишет фоновый поток: record вызывается из event loop и не должен ждать диск
+        self._lines: "queue.Queue[str]" = queue.Queue()
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+
+    @contextmanager
+    def span(self, stage: str, **attributes: Any) -> Iterator[Dict[str, Any]]:
+        """Замеряет стадию; в словарь атрибутов можно дописать данные до выхода из блока."""
+        attributes = dict(attributes)
+        started = time.perf_counter()
+        error: Optional[str] = None
+        try:
+            yield attributes
+        except BaseException as e:
+            error = type(e).__name__
+            raise
+        finally:
+            self.observe(stage, time.perf_counter() - started, error=error, **attributes)
+
+    def observe(self, stage: str, duration: float, **attributes: Any) -> None:
+        """Учитывает уже измеренную длительность стадии (когда блок with неудобен)."""
+        self.registry.observe_duration(stage, duration)
+        self.record(stage, duration, **attributes)
+
+    def record(self, stage: str, duration: float, **attributes: Any) -> None:
+        if self.trace_path is None:
+            return
+        record = {"ts": time.time(), "span": stage, "duration_ms": round(duration * 1000, 3)}
+        record.update({key: value for key, value in attributes.items() if value is not None})
+        self._lines.put(json.dumps(record, ensure_ascii=False, default=str))
+        if self._writer is None:
+            self._start_writer()
+
+    def flush(self) -> None:
+        """Ждёт, пока фоновый поток допишет накопленные строки."""
+        if self._writer is not None:
+            self._lines.join()
+
+    def _start_writer(self) -> None:
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_lines, name="trace-writer", daemon=True)
+                self._writer.start()
+                atexit.register(self.flush)
+
+    def _write_lines(self) -> None:
+        while True:
+            lines = [self._lines.get()]
+            # Всё, что накопилось, уходит одной записью
+            while True:
+                try:
+                    lines.append(self._lines.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with open(self.trace_path, "a", encoding="utf-8") as trace_file:
+                    trace_file.write("\n".join(lines) + "\n")
+            except OSError:
+                logger.exception("Failed to write %d trace lines to %s", len(lines), self.trace_path)
+            finally:
+                for _ in lines:
+                    self._lines.task_done()
+
+
+def agent_stage(agent_type: Any) -> str:
+    """Метка стадии агента по его типу (agent:research, agent:coding, agent:writing) — одна во всех путях."""
+    return f"agent:{getattr(agent_type, 'value', agent_type)}"
+
+
+@lru_cache(maxsize=None)
+def get_tracer() -> Tracer:
+    """Общий трассировщик процесса."""
+    return Tracer(MetricsRegistry())
+
+
+@lru_cache(maxsize=None)
+def get_callback_handler():
+    """LangChain callback handler, который пишет спан "llm" на каждый вызов модели.
+
+    Стадия берётся из metadata["stage"] конфигурации вызова (router, agent:research, critic ...).
+    Рассуждение модели (<think>…</think>, см. thinking.py) учитывается отдельно: токены — видом
+    "reasoning" стадии llm:*, время до закрытия </think> — стадией reasoning:*.
+    """
+    from langchain_core.callbacks import BaseCallbackHandler
+
+    from thinking import ThinkScanner
+
+    tracer = get_tracer()
+
+    class TracingCallbackHandler(BaseCallbackHandler):
+        # Вызывается в том же потоке/loop без пула потоков: обработчик дешёвый
+        run_inline = True
+
+        def __init__(self):
+            self._runs: Dict[Any, Dict[str, Any]] = {}
+            self._lock = threading.Lock()
+
+        def on_chat_model_start(self, serialized, messages, *, run_id, metadata=None, **kwargs):
+            self._start(run_id, metadata)
+
+        def on_llm_start(self, serialized, prompts, *, run_id, metadata=None, **kwargs):
+            self._start(run_id, metadata)
+
+        def on_llm_new_token(self, token, *, run_id, **kwargs):
+            reasoning_seconds = None
+            with self._lock:
+                run = self._runs.get(run_id)
+                if run is None:
+                    return
+                first = run["ttft"] is None
+                if first:
+                    run["ttft"] = time.perf_counter() - run["started"]
+                if run["think"] != "closed" and token:
+                    # ThinkScanner находит теги, разрезанные между фрагментами, и оба тега в одном
+                    # фрагменте (пустой <think></think> у qwen3)
+                    scanner = run["scanner"]
+                    inside, reasoning_chars = scanner.inside, scanner.reasoning_chars
+                    scanner.feed(token)
+                    # Один фрагмент потока vLLM — один токен; сам тег <think> в счёт не идёт
+                    run["reasoning_tokens"] += inside or scanner.reasoning_chars > reasoning_chars
+                    if scanner.inside:
+                        run["think"] = "open"
+                    elif scanner.blocks:
+                        run["think"] = "closed"
+                        reasoning_seconds = time.perf_counter() - run["started"]
+            if first:
+                tracer.registry.observe_ttft(run["stage"], run["ttft"])
+            if reasoning_seconds is not None:
+                tracer.observe(f"reasoning:{run['stage'][len('llm:'):]}", reasoning_seconds,
+                               reasoning_tokens=run["reasoning_tokens"])
+
+        def on_llm_end(self, response, *, run_id, **kwargs):
+            run = self._finish(run_id)
+            if run is None:
+                return
+            prompt_tokens, completion_tokens = _token_usage(response)
+            reasoning_tokens = run["reasoning_tokens"] if run["ttft"] is not None else _reasoning_tokens(response, completion_tokens)
+            tracer.registry.add_tokens(run["stage"], "prompt", prompt_tokens)
+            tracer.registry.add_tokens(run["stage"], "completion", completion_tokens)
+            tracer.registry.add_tokens(run["stage"], "reasoning", reasoning_tokens)
+            self._record(run, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                         reasoning_tokens=reasoning_tokens or None)
+
+        def on_llm_error(self, error, *, run_id, **kwargs):
+            run = self._finish(run_id)
+            if run is not None:
+                # Поток, прерванный по бюджету рассуждений, тоже потратил на рассуждение время и токены
+                tracer.registry.add_tokens(run["stage"], "reasoning", run["reasoning_tokens"])
+                if run["think"] == "open":
+                    tracer.observe(f"reasoning:{run['stage'][len('llm:'):]}", time.perf_counter() - run["started"],
+                                   reasoning_tokens=run["reasoning_tokens"], error=type(error).__name__)
+                self._record(run, error=type(error).__name__, reasoning_tokens=run["reasoning_tokens"] or None)
+
+        def _start(self, run_id, metadata):
+            stage = f"llm:{(metadata or {}).get('stage', 'default')}"
+            with self._lock:
+                self._runs[run_id] = {"stage": stage, "started": time.perf_counter(), "ttft": None,
+                                      "think": None, "scanner": ThinkScanner(), "reasoning_tokens": 0}
+
+        def _finish(self, run_id):
+            with self._lock:
+                return self._runs.pop(run_id, None)
+
+        def _record(self, run, **attributes):
+            duration = time.perf_counter() - run["started"]
+            tracer.registry.observe_duration(run["stage"], duration)
+            ttft_ms = round(run["ttft"] * 1000, 3) if run["ttft"] is not None else None
+            tracer.record(run["stage"], duration, ttft_ms=ttft_ms, **attributes)
+
+    return TracingCallbackHandler()
+
+
+def _token_usage(response) -> Tuple[int, int]:
+    """Токены из usage_metadata сообщений (в т.ч. при стриминге) или llm_output провайдера."""
+    prompt_tokens = completion_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+            if usage:
+                prompt_tokens += usage.get("input_tokens", 0)
+                completion_tokens += usage.get("output_tokens", 0)
+    if not (prompt_tokens or completion_tokens):
+        usage = (response.llm_output or {}).get("token_usage") or {}
+        prompt_tokens = usage.get("prompt_tokens", 0) or 0
+        completion_tokens = usage.get("completion_tokens", 0) or 0
+    return prompt_tokens, completion_tokens
+
+
+def _reasoning_tokens(response, completion_tokens: int) -> int:
+    """Токены рассуждения непотокового ответа: из usage, иначе доля символов <think> в completion_tokens."""
+    from thinking import ThinkScanner
+
+    reasoning = visible = 0
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            details = (getattr(message, "usage_metadata", None) or {}).get("output_token_details") or {}
+            if details.get("reasoning"):
+                return details["reasoning"]
+            scanner = ThinkScanner()
+            visible += len(scanner.feed(generation.text or "") + scanner.flush())
+            reasoning += scanner.reasoning_chars
+    if not reasoning:
+        return 0
+    return round(completion_tokens * reasoning / (reasoning + visible))
+
+
+def stage_config(stage: str) -> Dict[str, Any]:
+    """RunnableConfig, помечающий LLM-вызовы цепочки стадией для TracingCallbackHandler."""
+    return {"metadata": {"stage": stage}}
+
+
+async def start_metrics_server(port: int = METRICS_PORT, host: str = "0.0.0.0"):
+    """Prometheus-эндпоинт /metrics на aiohttp; запускать в общем фоновом event loop."""
+    from aiohttp import web
+
+    async def metrics(request):
+        return web.Response(text=get_tracer().registry.render_prometheus(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner